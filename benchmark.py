@@ -0,0 +1,716 @@
+"""Benchmark offline da API (sem YouTube).
+
+Sobe o server_full.py em um subprocesso com um yt-dlp falso (extract_info/download
+respondem com dados sintéticos, com latência configurável) e uma origem HTTP local que
+serve áudio WAV sintético com suporte a Range. Depois gera carga em /search, /info,
+/stream (inteiro e com seeks) e /baixar (músicas avulsas e playlists) e salva
+throughput, latências p50/p95/p99, CPU e RSS do servidor em JSON.
+
+Uso:
+    python benchmark.py run --concurrency 8 --requests 200 --output resultados.json
+    python benchmark.py run --scenarios search,stream_seek --baseline anterior.json
+    python benchmark.py compare anterior.json resultados.json --tolerance 0.10
+
+`compare` (e `run --baseline`) sai com código 1 se algum cenário piorou além da tolerância. Cada cenário
+é medido em --repeat amostras; só conta como regressão o que fica fora da variação entre elas.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import http.client
+import http.server
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import socketserver
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.parse as urllib_parse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ('search', 'info', 'stream', 'stream_seek', 'baixar', 'playlist')
+# Cenários que rodam ffmpeg no servidor: menos requisições por padrão
+SLOW_SCENARIOS = ('baixar', 'playlist')
+SEEK_SPAN = 256 * 1024  # bytes pedidos em cada seek do cenário stream_seek
+
+
+# ---------------------------------------------------------------------------
+# Áudio sintético e origem HTTP local
+# ---------------------------------------------------------------------------
+
+def gerar_wav(seconds, rate=44100, channels=2, freq=440.0):
+    """WAV PCM 16 bits com um tom (um período repetido, rápido de gerar e decodificável pelo ffmpeg)"""
+    period = max(int(rate / freq), 1)
+    one = b''.join(struct.pack('<h', int(12000 * math.sin(2 * math.pi * i / period))) * channels for i in range(period))
+    frames = int(seconds * rate)
+    data = (one * (frames // period + 1))[:frames * channels * 2]
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(data), b'WAVE', b'fmt ', 16, 1, channels, rate,
+                         rate * channels * 2, channels * 2, 16, b'data', len(data))
+    return header + data
+
+
+class _OriginHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._servir(head=True)
+
+    def do_GET(self):
+        self._servir(head=False)
+
+    def _servir(self, head):
+        origin = self.server.origin
+        if not self.path.startswith('/audio/'):
+            self.send_error(404)
+            return
+        body = origin['audio']
+        size = len(body)
+        start, end = 0, size - 1
+        status = 200
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', '').strip())
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start >= size or end < start:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        if origin['ttfb']:
+            time.sleep(origin['ttfb'])
+        self.send_response(status)
+        self.send_header('Content-Type', 'audio/wav')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if head:
+            return
+        view = memoryview(body)[start:end + 1]
+        chunk = 64 * 1024
+        rate = origin['rate']
+        try:
+            for pos in range(0, len(view), chunk):
+                self.wfile.write(view[pos:pos + chunk])
+                if rate:
+                    time.sleep(chunk / rate)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class OriginServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, audio, ttfb=0.0, rate=0):
+        super().__init__(('127.0.0.1', 0), _OriginHandler)
+        self.origin = {'audio': audio, 'ttfb': ttfb, 'rate': rate}
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='bench-origin', daemon=True).start()
+        return self
+
+
+# ---------------------------------------------------------------------------
+# yt-dlp falso (instalado em sys.modules no processo do servidor)
+# ---------------------------------------------------------------------------
+
+class FakeYoutubeDL:
+    """Responde como o yt_dlp.YoutubeDL para as chamadas que o server_full faz, sem rede externa"""
+
+    origin = None
+    latency = 0.0
+    duration = 20
+    size = 0
+    playlist_size = 10
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _video(self, video_id):
+        fmt = {
+            'format_id': '140',
+            'ext': 'wav',
+            'acodec': 'pcm_s16le',
+            'vcodec': 'none',
+            'abr': 1411,
+            'protocol': 'http',
+            'url': f'{self.origin}/audio/{video_id}.wav',
+            'filesize': self.size,
+            'http_headers': {'User-Agent': 'bench'},
+        }
+        return dict(fmt, id=video_id, title=f'Faixa {video_id}', duration=self.duration, formats=[fmt])
+
+    def extract_info(self, url, download=False, process=True):
+        time.sleep(self.latency)
+        if url.startswith('ytsearch'):
+            prefix, _, query = url.partition(':')
+            count = int(prefix[len('ytsearch'):] or 1)
+            slug = re.sub(r'[^A-Za-z0-9]', '', query)[:5].ljust(5, 'x')
+            entries = [{'id': f's{slug}{i:05d}', 'title': f'{query} #{i}', 'duration': self.duration,
+                        'thumbnail': None} for i in range(count)]
+            return {'id': query, 'title': query, 'entries': entries}
+        match = re.search(r'list=([A-Za-z0-9_-]+)', url)
+        if match:
+            list_id = match.group(1)
+            size_match = re.search(r'n(\d+)$', list_id)
+            size = int(size_match.group(1)) if size_match else self.playlist_size
+            tag = hashlib.md5(list_id.encode()).hexdigest()[:6]  # IDs de faixa distintos por playlist
+
+            def entries():
+                for i in range(size):
+                    video_id = f'{tag}{i:05d}'
+                    yield {'id': video_id, 'url': f'https://www.youtube.com/watch?v={video_id}',
+                           'title': f'Faixa {video_id}', 'duration': self.duration}
+            return {'id': list_id, 'title': f'Playlist {list_id}', 'entries': entries() if not process else list(entries())}
+        match = re.search(r'(?:v=|youtu\.be/|shorts/)([A-Za-z0-9_-]{11})', url)
+        return self._video(match.group(1) if match else 'benchvideo0')
+
+    def download(self, urls):
+        """Baixa da origem local para o outtmpl; converte para mp3 se o postprocessor pedir"""
+        for url in urls:
+            info = self.extract_info(url)
+            stem = self.params['outtmpl'].replace('.%(ext)s', '')
+            raw_path = f'{stem}.wav'
+            conn = http.client.HTTPConnection(urllib_parse.urlsplit(self.origin).netloc, timeout=60)
+            try:
+                conn.request('GET', urllib_parse.urlsplit(info['url']).path)
+                with open(raw_path, 'wb') as f:
+                    shutil.copyfileobj(conn.getresponse(), f)
+            finally:
+                conn.close()
+            for hook in self.params.get('progress_hooks') or []:
+                hook({'status': 'finished', 'filename': raw_path})
+            wants_mp3 = any(pp.get('key') == 'FFmpegExtractAudio' for pp in self.params.get('postprocessors') or [])
+            ffmpeg = self.params.get('ffmpeg_location') or shutil.which('ffmpeg')
+            if wants_mp3 and ffmpeg:
+                subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-i', raw_path, '-ab', '128k', f'{stem}.mp3'], check=True)
+                os.remove(raw_path)
+        return 0
+
+
+def instalar_yt_dlp_falso(origin, latency, duration, size, playlist_size):
+    FakeYoutubeDL.origin = origin
+    FakeYoutubeDL.latency = latency
+    FakeYoutubeDL.duration = duration
+    FakeYoutubeDL.size = size
+    FakeYoutubeDL.playlist_size = playlist_size
+    module = types.ModuleType('yt_dlp')
+    module.YoutubeDL = FakeYoutubeDL
+    sys.modules['yt_dlp'] = module
+
+
+def servir(args):
+    """Processo do servidor: yt-dlp falso + server_full (ou server_asgi) na porta pedida"""
+    instalar_yt_dlp_falso(os.environ['BENCH_ORIGIN'], float(os.environ.get('BENCH_EXTRACT_LATENCY', 0)),
+                          int(os.environ.get('BENCH_TRACK_SECONDS', 20)), int(os.environ.get('BENCH_TRACK_BYTES', 0)),
+                          int(os.environ.get('BENCH_PLAYLIST_SIZE', 10)))
+    sys.path.insert(0, ROOT)
+    if args.asgi:
+        import uvicorn
+        import server_asgi
+        uvicorn.run(server_asgi.app, host='127.0.0.1', port=args.port, log_level='warning')
+        return
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import server_full
+
+    class Handler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, como atrás de um proxy de produção
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    make_server('127.0.0.1', args.port, server_full.app, threaded=True, request_handler=Handler).serve_forever()
+
+
+# ---------------------------------------------------------------------------
+# Medição do processo do servidor (Linux: /proc)
+# ---------------------------------------------------------------------------
+
+class ProcessSampler:
+    """CPU (processo + filhos aguardados, ex.: ffmpeg) e pico de RSS do servidor durante um cenário"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self._tick = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self._stop = threading.Event()
+        self.rss_peak = 0
+
+    def _cpu(self):
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            return sum(int(x) for x in fields[11:15]) / self._tick  # utime, stime, cutime, cstime
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def _rss(self):
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.rss_peak = max(self.rss_peak, self._rss() or 0)
+
+    def __enter__(self):
+        self.cpu_start = self._cpu()
+        self.rss_start = self._rss()
+        self.rss_peak = self.rss_start or 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        cpu_end = self._cpu()
+        rss_end = self._rss()
+        self.result = {
+            'cpu_seconds': round(cpu_end - self.cpu_start, 3) if cpu_end is not None and self.cpu_start is not None else None,
+            'rss_start_bytes': self.rss_start,
+            'rss_end_bytes': rss_end,
+            'rss_peak_bytes': max(self.rss_peak, rss_end or 0) or None,
+        }
+        return False
+
+
+# ---------------------------------------------------------------------------
+# Cenários de carga
+# ---------------------------------------------------------------------------
+
+class Client:
+    """Conexão keep-alive por thread com o servidor em teste"""
+
+    def __init__(self, port, timeout=120):
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None, read=True):
+        """Retorna (status, corpo, ttfb_s, bytes)"""
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        for tentativa in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+            start = time.perf_counter()
+            try:
+                self.conn.request(method, path, body=payload, headers=headers)
+                resp = self.conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionError, BrokenPipeError):
+                self.conn.close()
+                self.conn = None
+                if tentativa:
+                    raise
+        ttfb = time.perf_counter() - start
+        data = b''
+        total = 0
+        if read:
+            while True:
+                chunk = resp.read(64 * 1024)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if len(data) < 1024 * 1024:
+                    data += chunk
+        if resp.will_close:
+            self.conn.close()
+            self.conn = None
+        return resp.status, data, ttfb, total
+
+    def json(self, method, path, body=None):
+        status, data, _, _ = self.request(method, path, body)
+        return status, json.loads(data or b'null')
+
+
+def _tarefa(client, link, poll, timeout):
+    status, resposta = client.json('POST', '/baixar', {'link': link})
+    if status != 200:
+        return False
+    if resposta.get('filename'):
+        return True
+    task_id = resposta['task_id']
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        _, snap = client.json('GET', f'/progress/{task_id}')
+        prog = snap.get('progress')
+        if snap.get('filename'):
+            return True
+        if prog == -1 or (isinstance(prog, dict) and prog.get('global') == -1):
+            return False
+        time.sleep(poll)
+    return False
+
+
+def construir_cenario(name, args, run_id):
+    """Retorna op(client, i) -> (ok, ttfb, bytes) para o cenário"""
+    rng = random.Random(args.seed)
+    video_ids = [f'v{run_id:02d}{n:08d}' for n in range(args.keys)]
+    queries = [f'consulta {n}' for n in range(args.keys)]
+    track_bytes = len(gerar_wav(args.track_seconds)) if name == 'stream_seek' else 0
+
+    if name == 'search':
+        def op(client, i):
+            status, _, ttfb, size = client.request('POST', '/search', {'query': rng.choice(queries)})
+            return status == 200, ttfb, size
+    elif name == 'info':
+        def op(client, i):
+            link = f'https://www.youtube.com/watch?v={rng.choice(video_ids)}'
+            status, _, ttfb, size = client.request('POST', '/info', {'link': link})
+            return status == 200, ttfb, size
+    elif name == 'stream':
+        def op(client, i):
+            status, _, ttfb, size = client.request('GET', f'/stream/{rng.choice(video_ids)}')
+            return status in (200, 206), ttfb, size
+    elif name == 'stream_seek':
+        def op(client, i):
+            # Padrão de player: começo do arquivo e depois seeks aleatórios
+            start = 0 if i % 4 == 0 else rng.randrange(0, max(track_bytes - SEEK_SPAN, 1))
+            headers = {'Range': f'bytes={start}-{start + SEEK_SPAN - 1}'}
+            status, _, ttfb, size = client.request('GET', f'/stream/{rng.choice(video_ids)}', headers=headers)
+            return status == 206, ttfb, size
+    elif name == 'baixar':
+        def op(client, i):
+            # IDs novos a cada requisição: mede extração + download + conversão (não o atalho de arquivo pronto)
+            link = f'https://www.youtube.com/watch?v=b{run_id:02d}{i:08d}'
+            return _tarefa(client, link, args.poll, args.task_timeout), None, 0
+    elif name == 'playlist':
+        def op(client, i):
+            link = f'https://www.youtube.com/playlist?list=PL{run_id:02d}x{i:06d}n{args.playlist_size}'
+            return _tarefa(client, link, args.poll, args.task_timeout), None, 0
+    else:
+        raise ValueError(f'cenário desconhecido: {name}')
+    return op
+
+
+def percentil(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = max(int(math.ceil(p / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[k]
+
+
+def _resumo(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        'p50': round(percentil(values, 50), 6),
+        'p95': round(percentil(values, 95), 6),
+        'p99': round(percentil(values, 99), 6),
+        'max': round(values[-1], 6),
+        'mean': round(sum(values) / len(values), 6),
+    }
+
+
+def _fase(op, port, indices, concurrency):
+    """Roda op para cada índice com `concurrency` threads; retorna (latências, ttfbs, contadores)"""
+    contador = iter(indices)
+    lock = threading.Lock()
+    latencies, ttfbs = [], []
+    stats = {'ok': 0, 'errors': 0, 'bytes': 0}
+
+    def worker():
+        client = Client(port)
+        while True:
+            with lock:
+                i = next(contador, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                ok, ttfb, size = op(client, i)
+            except Exception:
+                ok, ttfb, size = False, None, 0
+                client = Client(port)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if ttfb is not None:
+                    ttfbs.append(ttfb)
+                stats['ok' if ok else 'errors'] += 1
+                stats['bytes'] += size
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return latencies, ttfbs, stats
+
+
+def rodar_cenario(name, op, port, pid, total, concurrency, warmup, repeat=1):
+    """Mede `repeat` amostras de `total` requisições; o resumo junta todas e `samples` guarda cada uma
+    (o compare usa a dispersão entre elas para não acusar ruído como regressão)"""
+    if warmup:
+        _fase(op, port, range(warmup), concurrency)
+    latencies, ttfbs = [], []
+    stats = {'ok': 0, 'errors': 0, 'bytes': 0}
+    samples = []
+    wall = 0.0
+    with ProcessSampler(pid) as sampler:
+        for r in range(repeat):
+            first = warmup + r * total
+            start = time.perf_counter()
+            lat, ttfb, st = _fase(op, port, range(first, first + total), concurrency)
+            elapsed = time.perf_counter() - start
+            wall += elapsed
+            latencies += lat
+            ttfbs += ttfb
+            for k in stats:
+                stats[k] += st[k]
+            resumo = _resumo(lat) or {}
+            samples.append({
+                'throughput_rps': round((st['ok'] + st['errors']) / elapsed, 3) if elapsed else None,
+                'latency_p95': resumo.get('p95'),
+                'latency_p99': resumo.get('p99'),
+            })
+    measured = stats['ok'] + stats['errors']
+    return {
+        'requests': measured,
+        'ok': stats['ok'],
+        'errors': stats['errors'],
+        'concurrency': concurrency,
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(measured / wall, 3) if wall else None,
+        'throughput_mbps': round(stats['bytes'] / wall / 1e6, 3) if wall else None,
+        'latency_seconds': _resumo(latencies),
+        'ttfb_seconds': _resumo(ttfbs),
+        'server': sampler.result,
+        'samples': samples,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Execução e comparação
+# ---------------------------------------------------------------------------
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _esperar_servidor(port, proc, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'servidor saiu com código {proc.returncode}')
+        try:
+            status, _, _, _ = Client(port, timeout=2).request('GET', '/health')
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('servidor não respondeu a /health')
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def executar(args):
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            raise SystemExit(f'cenário desconhecido: {name} (opções: {", ".join(SCENARIOS)})')
+    audio = gerar_wav(args.track_seconds)
+    origin = OriginServer(audio, ttfb=args.origin_ttfb, rate=args.origin_rate).start()
+    workdir = tempfile.mkdtemp(prefix='ytapi-bench-')
+    port = _porta_livre()
+    env = dict(os.environ,
+               BENCH_ORIGIN=origin.url,
+               BENCH_EXTRACT_LATENCY=str(args.extract_latency),
+               BENCH_TRACK_SECONDS=str(args.track_seconds),
+               BENCH_TRACK_BYTES=str(len(audio)),
+               BENCH_PLAYLIST_SIZE=str(args.playlist_size),
+               LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'))
+    cmd = [sys.executable, os.path.abspath(__file__), 'serve', '--port', str(port)] + (['--asgi'] if args.asgi else [])
+    server_log = open(os.path.join(workdir, 'server.log'), 'wb')
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=server_log, stderr=subprocess.STDOUT)
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'server': 'asgi' if args.asgi else 'wsgi',
+            'config': {k: v for k, v in vars(args).items() if k not in ('func', 'output', 'baseline')},
+        },
+        'scenarios': {},
+    }
+    try:
+        _esperar_servidor(port, proc)
+        for run_id, name in enumerate(scenarios):
+            if name in SLOW_SCENARIOS and not shutil.which('ffmpeg'):
+                results['scenarios'][name] = {'skipped': 'ffmpeg não encontrado'}
+                print(f'{name}: ignorado (ffmpeg não encontrado)')
+                continue
+            total = args.task_requests if name in SLOW_SCENARIOS else args.requests
+            warmup = 0 if name in SLOW_SCENARIOS else args.warmup
+            op = construir_cenario(name, args, run_id)
+            result = rodar_cenario(name, op, port, proc.pid, total, args.concurrency, warmup, args.repeat)
+            results['scenarios'][name] = result
+            lat = result['latency_seconds'] or {}
+            print(f"{name}: {result['throughput_rps']} req/s, p50={lat.get('p50')}s p95={lat.get('p95')}s "
+                  f"p99={lat.get('p99')}s, erros={result['errors']}, cpu={result['server']['cpu_seconds']}s")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        server_log.close()
+        origin.shutdown()
+        if args.keep_workdir:
+            print(f'Diretório do servidor mantido em {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Resultados salvos em {args.output}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        return 1 if comparar_resultados(baseline, results, args.tolerance) else 0
+    return 0
+
+
+def _amostras(result, metric):
+    """Valores de `metric` em cada amostra do cenário (JSONs antigos, sem `samples`: o valor agregado)"""
+    values = [s.get(metric) for s in result.get('samples') or []]
+    values = [v for v in values if v is not None]
+    if values:
+        return values
+    if metric == 'throughput_rps':
+        value = result.get('throughput_rps')
+    else:
+        value = (result.get('latency_seconds') or {}).get(metric[len('latency_'):])
+    return [value] if value is not None else []
+
+
+def comparar_resultados(baseline, current, tolerance):
+    """Imprime a comparação (medianas das amostras) e retorna a lista de regressões.
+    Só é regressão quando até a melhor amostra atual fica pior que a pior amostra da base além da
+    tolerância: diferenças dentro da variação entre execuções repetidas são tratadas como ruído."""
+    regressoes = []
+    for name, cur in current.get('scenarios', {}).items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base or 'skipped' in base or 'skipped' in cur:
+            continue
+        for metric, higher_is_worse in (('throughput_rps', False), ('latency_p95', True), ('latency_p99', True)):
+            olds, news = _amostras(base, metric), _amostras(cur, metric)
+            if not olds or not news or not min(olds):
+                continue
+            old, new = statistics.median(olds), statistics.median(news)
+            change = (new - old) / old
+            if higher_is_worse:
+                worse = min(news) > max(olds) * (1 + tolerance)
+            else:
+                worse = max(news) < min(olds) * (1 - tolerance)
+            flag = 'REGRESSÃO' if worse else 'ok'
+            print(f'{name:12s} {metric:16s} {old:>12.4f} -> {new:>12.4f} ({change:+.1%}) {flag}')
+            if worse:
+                regressoes.append((name, metric, old, new))
+        if (cur.get('errors') or 0) > (base.get('errors') or 0):
+            print(f"{name:12s} errors           {base.get('errors')} -> {cur.get('errors')} REGRESSÃO")
+            regressoes.append((name, 'errors', base.get('errors'), cur.get('errors')))
+    return regressoes
+
+
+def comparar(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    return 1 if comparar_resultados(baseline, current, args.tolerance) else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark offline da API (yt-dlp falso + origem HTTP local)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='sobe o servidor e gera carga')
+    run.add_argument('--scenarios', default=','.join(SCENARIOS), help='lista separada por vírgulas')
+    run.add_argument('--concurrency', type=int, default=8)
+    run.add_argument('--requests', type=int, default=200, help='requisições medidas por cenário rápido')
+    run.add_argument('--task-requests', type=int, default=10, help='tarefas medidas em baixar/playlist')
+    run.add_argument('--repeat', type=int, default=3, help='amostras por cenário (o compare usa a variação entre elas)')
+    run.add_argument('--warmup', type=int, default=10, help='requisições de aquecimento (não medidas)')
+    run.add_argument('--keys', type=int, default=50, help='vídeos/consultas distintos (controla a taxa de acerto dos caches)')
+    run.add_argument('--playlist-size', type=int, default=5)
+    run.add_argument('--track-seconds', type=int, default=20, help='duração do áudio sintético')
+    run.add_argument('--extract-latency', type=float, default=0.05, help='latência simulada do extract_info (s)')
+    run.add_argument('--origin-ttfb', type=float, default=0.0, help='atraso da origem antes dos headers (s)')
+    run.add_argument('--origin-rate', type=int, default=0, help='limite de banda da origem (bytes/s, 0 = sem limite)')
+    run.add_argument('--poll', type=float, default=0.1, help='intervalo de consulta do /progress (s)')
+    run.add_argument('--task-timeout', type=float, default=300)
+    run.add_argument('--seed', type=int, default=1234)
+    run.add_argument('--asgi', action='store_true', help='usa server_asgi (uvicorn) em vez do servidor WSGI')
+    run.add_argument('--output', default='benchmark_results.json')
+    run.add_argument('--baseline', help='JSON de uma execução anterior para checar regressões')
+    run.add_argument('--tolerance', type=float, default=0.10)
+    run.add_argument('--keep-workdir', action='store_true', help='não apaga o diretório temporário do servidor')
+    run.set_defaults(func=executar)
+
+    cmp_parser = sub.add_parser('compare', help='compara dois JSONs de resultados')
+    cmp_parser.add_argument('baseline')
+    cmp_parser.add_argument('current')
+    cmp_parser.add_argument('--tolerance', type=float, default=0.10)
+    cmp_parser.set_defaults(func=comparar)
+
+    serve = sub.add_parser('serve', help=argparse.SUPPRESS)
+    serve.add_argument('--port', type=int, required=True)
+    serve.add_argument('--asgi', action='store_true')
+    serve.set_defaults(func=servir)
+
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,457 @@
+"""Modo de serviço assíncrono (ASGI) para o proxy /stream.
+
+O proxy /stream/<video_id> roda em asyncio: cada ouvinte é uma corrotina e não
+prende uma thread do Flask durante a música inteira. As demais rotas (e o
+fallback HLS/DASH do /stream) continuam sendo atendidas pelo app Flask de
+server_full.py através de um adaptador WSGI que roda cada requisição em um pool
+de threads próprio (ASGI_WSGI_WORKERS), então um SSE aberto ou um /zip longo não
+seguram as outras rotas.
+
+Uso:
+    uvicorn server_asgi:app --host 0.0.0.0 --port 5000
+ou
+    python server_asgi.py
+"""
+import asyncio
+import json
+import logging
+import os
+import ssl
+import time
+import urllib.parse as urllib_parse
+
+from a2wsgi import WSGIMiddleware
+
+from server_full import (
+    app as flask_app,
+    resolve_audio_format,
+    invalidate_audio_format,
+    FormatNotFound,
+    fonte_em_cache,
+    abrir_range_cache,
+    fechar_range_cache,
+    parse_range,
+    _stream_cache_key,
+    _tamanho_upstream,
+    STREAM_TEE_CACHE,
+    STREAM_TEE_MAX_FILE,
+    UPSTREAM_POOL_SIZE,
+    UPSTREAM_IDLE_TIMEOUT,
+    UPSTREAM_TIMEOUT,
+    UPSTREAM_MAX_REDIRECTS,
+    METRICS,
+)
+
+log = logging.getLogger('ytapi.asgi')
+
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 64 * 1024))
+ASGI_WSGI_WORKERS = int(os.environ.get('ASGI_WSGI_WORKERS', 32))  # threads para as rotas Flask (SSE, /zip, /download...)
+
+wsgi_app = WSGIMiddleware(flask_app, workers=ASGI_WSGI_WORKERS)
+
+
+class AsyncUpstreamError(Exception):
+    def __init__(self, status, reason):
+        super().__init__(f'HTTP Error {status}: {reason}')
+        self.status = status
+
+
+class AsyncUpstreamPool:
+    """Conexões keep-alive assíncronas agrupadas por (scheme, host, port)"""
+
+    def __init__(self, max_idle=UPSTREAM_POOL_SIZE, idle_timeout=UPSTREAM_IDLE_TIMEOUT, timeout=UPSTREAM_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}  # { key: [(last_used, reader, writer), ...] }
+        self._ssl = ssl.create_default_context()
+
+    async def _open(self, key):
+        scheme, host, port = key
+        return await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=self._ssl if scheme == 'https' else None),
+            self.timeout,
+        )
+
+    def _acquire_idle(self, key):
+        now = time.time()
+        idle = self._idle.get(key, [])
+        while idle:
+            last_used, reader, writer = idle.pop()
+            if now - last_used < self.idle_timeout and not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    def release(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) >= self.max_idle or writer.is_closing():
+            writer.close()
+            return
+        idle.append((time.time(), reader, writer))
+
+    async def _send(self, key, path, headers, fresh=False):
+        conn = None if fresh else self._acquire_idle(key)
+        reused = conn is not None
+        reader, writer = conn if reused else await self._open(key)
+        lines = [f'GET {path} HTTP/1.1', f'Host: {key[1]}']
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        try:
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if not status_line:
+                raise ConnectionResetError('upstream fechou a conexão')
+        except ConnectionError:
+            writer.close()
+            if not reused:
+                raise
+            # Conexão ociosa foi fechada pelo servidor: tenta de novo com uma nova
+            return await self._send(key, path, headers, fresh=True)
+        return reader, writer, status_line
+
+    async def request(self, url, headers=None):
+        with METRICS.cronometro('upstream_open'):
+            return await self._request(url, headers)
+
+    async def _request(self, url, headers=None):
+        headers = dict(headers or {})
+        headers.setdefault('Connection', 'keep-alive')
+        headers.setdefault('User-Agent', 'Mozilla/5.0')
+        for _ in range(UPSTREAM_MAX_REDIRECTS + 1):
+            parsed = urllib_parse.urlsplit(url)
+            scheme = parsed.scheme.lower()
+            key = (scheme, parsed.hostname, parsed.port or (443 if scheme == 'https' else 80))
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+
+            reader, writer, status_line = await self._send(key, path, headers)
+            parts = status_line.decode('latin-1').split(' ', 2)
+            status = int(parts[1])
+            reason = parts[2].strip() if len(parts) > 2 else ''
+            resp_headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                resp_headers[name.strip().lower()] = value.strip()
+
+            upstream = AsyncUpstreamResponse(self, key, reader, writer, status, resp_headers)
+            if status in (301, 302, 303, 307, 308) and resp_headers.get('location'):
+                url = urllib_parse.urljoin(url, resp_headers['location'])
+                await upstream.close()
+                continue
+            if status >= 400:
+                await upstream.close()
+                raise AsyncUpstreamError(status, reason)
+            return upstream
+        raise AsyncUpstreamError(508, 'Redirecionamentos demais no upstream')
+
+
+class AsyncUpstreamResponse:
+    def __init__(self, pool, key, reader, writer, status, headers):
+        self._pool = pool
+        self._key = key
+        self._reader = reader
+        self._writer = writer
+        self.status = status
+        self.headers = headers
+        self._chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        self._chunk_left = 0
+        length = headers.get('content-length')
+        self._remaining = int(length) if length is not None and not self._chunked else None
+        self._done = status in (204, 304) or self._remaining == 0
+        self._closed = False
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def getcode(self):
+        return self.status
+
+    async def read(self, amt):
+        """Lê até `amt` bytes do corpo; b'' no fim"""
+        if self._done:
+            return b''
+        if self._chunked:
+            if self._chunk_left == 0:
+                size_line = await asyncio.wait_for(self._reader.readline(), self._pool.timeout)
+                self._chunk_left = int(size_line.split(b';')[0].strip() or b'0', 16)
+                if self._chunk_left == 0:
+                    # trailers até a linha em branco
+                    while (await self._reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    self._done = True
+                    return b''
+            data = await asyncio.wait_for(self._reader.read(min(amt, self._chunk_left)), self._pool.timeout)
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await self._reader.readline()  # CRLF após o chunk
+            return data
+        if self._remaining is None:
+            data = await asyncio.wait_for(self._reader.read(amt), self._pool.timeout)
+            if not data:
+                self._done = True
+            return data
+        data = await asyncio.wait_for(self._reader.read(min(amt, self._remaining)), self._pool.timeout)
+        if not data:
+            raise ConnectionResetError('upstream encerrou antes do fim do corpo')
+        self._remaining -= len(data)
+        if self._remaining == 0:
+            self._done = True
+        return data
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        reusable = self._remaining is not None or self._chunked
+        reusable = reusable and self.headers.get('connection', '').lower() != 'close'
+        if reusable and not self._done and self._remaining is not None and self._remaining <= 64 * 1024:
+            # Cliente desconectou no meio: drena o resto se for pequeno
+            try:
+                while not self._done:
+                    await self.read(self._remaining)
+            except Exception:
+                reusable = False
+        if reusable and self._done:
+            self._pool.release(self._key, self._reader, self._writer)
+        else:
+            self._writer.close()
+
+
+UPSTREAM_POOL = AsyncUpstreamPool()
+
+
+def _cors_headers(scope):
+    origin = None
+    for name, value in scope.get('headers', []):
+        if name == b'origin':
+            origin = value
+    if origin:
+        return [(b'access-control-allow-origin', origin), (b'access-control-allow-credentials', b'true'), (b'vary', b'Origin')]
+    return [(b'access-control-allow-origin', b'*')]
+
+
+async def _send_json(send, scope, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + _cors_headers(scope),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _abrir_upstream(video_id, url, headers):
+    try:
+        return await UPSTREAM_POOL.request(url, headers=headers)
+    except AsyncUpstreamError as e:
+        # URL assinada expirou/foi revogada: descarta do cache para a próxima tentativa
+        if e.status in (403, 404, 410):
+            invalidate_audio_format(video_id)
+        raise
+
+
+async def _repassar_com_tee(upstream, rc, offset):
+    """Blocos do corpo do upstream; com `rc`, cada um é gravado no cache tee a partir de `offset`"""
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            chunk = await upstream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            if rc is not None:
+                await loop.run_in_executor(None, rc.gravar, offset, chunk)
+            offset += len(chunk)
+            yield chunk
+    finally:
+        await upstream.close()
+
+
+async def _ler_do_cache(rc, start, end):
+    """Blocos de [start, end] já gravados no cache tee (leitura do disco fora do event loop)"""
+    loop = asyncio.get_running_loop()
+    blocos = rc.ler(start, end)
+    while True:
+        chunk = await loop.run_in_executor(None, next, blocos, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+async def _enviar(scope, receive, send, video_id, status, headers, partes):
+    """Envia a resposta com os blocos de `partes` (gerador assíncrono de (origem, blocos)), com backpressure:
+    só lê o próximo bloco depois que o send() do anterior foi aceito. Para ao desconectar o cliente."""
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    enviados = {}
+    METRICS.inc('ytapi_active_streams')
+    try:
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers + _cors_headers(scope)})
+        async for origem, blocos in partes:
+            try:
+                async for chunk in blocos:
+                    if disconnected.is_set():
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    enviados[origem] = enviados.get(origem, 0) + len(chunk)
+            finally:
+                await blocos.aclose()
+            if disconnected.is_set():
+                break
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+    except Exception as e:
+        log.info("Stream interrompido para %s: %s", video_id, e)
+    finally:
+        await partes.aclose()
+        METRICS.dec('ytapi_active_streams')
+        for origem, total in enviados.items():
+            METRICS.inc('ytapi_stream_bytes_total', total, source=origem)
+        watcher.cancel()
+
+
+def _headers_upstream(upstream):
+    return [(name.encode(), upstream.getheader(name).encode('latin-1'))
+            for name in ('content-range', 'accept-ranges', 'content-length') if upstream.getheader(name)]
+
+
+async def _stream_com_tee(scope, receive, send, video_id, chosen, range_header):
+    """Versão assíncrona de server_full._stream_com_tee: trechos já gravados saem do disco, os que faltam
+    vêm do upstream e ficam gravados no mesmo cache tee usado pelo Flask"""
+    loop = asyncio.get_running_loop()
+    content_type = chosen.get('content_type', 'audio/mpeg').encode()
+    stream_url = chosen['url']
+    rc = await loop.run_in_executor(None, abrir_range_cache, _stream_cache_key(video_id, chosen.get('format_id')))
+    try:
+        if rc.complete:
+            # Faixa inteira no disco: o Flask serve com Range/ETag
+            return await wsgi_app(scope, receive, send)
+        if rc.size is None:
+            # Primeiro acesso: o tamanho total só é conhecido pela resposta do upstream
+            METRICS.inc('ytapi_cache_lookups_total', cache='stream_tee', result='miss')
+            upstream = await _abrir_upstream(video_id, stream_url, {'Range': range_header} if range_header else {})
+            offset, total = _tamanho_upstream(upstream)
+            if offset is not None and total <= STREAM_TEE_MAX_FILE:
+                await loop.run_in_executor(None, rc.definir_tamanho, total)
+
+            async def partes():
+                yield 'upstream', _repassar_com_tee(upstream, rc if rc.size is not None else None, offset or 0)
+
+            headers = [(b'content-type', content_type)] + _headers_upstream(upstream)
+            try:
+                return await _enviar(scope, receive, send, video_id, upstream.status, headers, partes())
+            finally:
+                await upstream.close()
+
+        byte_range = parse_range(range_header, rc.size)
+        if byte_range == 'unsatisfiable':
+            await send({'type': 'http.response.start', 'status': 416,
+                        'headers': [(b'content-range', f'bytes */{rc.size}'.encode())] + _cors_headers(scope)})
+            return await send({'type': 'http.response.body', 'body': b''})
+        start, end = byte_range or (0, rc.size - 1)
+        segmentos = rc.segmentos(start, end)
+        METRICS.inc('ytapi_cache_lookups_total', cache='stream_tee',
+                    result='partial' if any(not local for _, _, local in segmentos) else 'hit')
+
+        async def partes():
+            for a, b, local in segmentos:
+                if local:
+                    yield 'tee_cache', _ler_do_cache(rc, a, b)
+                    continue
+                upstream = await _abrir_upstream(video_id, stream_url, {'Range': f'bytes={a}-{b}'})
+                if _tamanho_upstream(upstream)[0] != a:
+                    await upstream.close()
+                    raise IOError(f'upstream ignorou o Range bytes={a}-{b}')
+                yield 'upstream', _repassar_com_tee(upstream, rc, a)
+
+        headers = [(b'content-type', content_type), (b'accept-ranges', b'bytes'),
+                   (b'content-length', str(end - start + 1).encode())]
+        if byte_range:
+            headers.append((b'content-range', f'bytes {start}-{end}/{rc.size}'.encode()))
+        return await _enviar(scope, receive, send, video_id, 206 if byte_range else 200, headers, partes())
+    finally:
+        await loop.run_in_executor(None, fechar_range_cache, rc)
+
+
+async def stream_video_audio(scope, receive, send, video_id):
+    """Versão assíncrona de server_full.stream_video_audio (mesmo contrato de URL e headers)"""
+    query = urllib_parse.parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    url = (query.get('url') or [None])[0] or f'https://www.youtube.com/watch?v={video_id}'
+    loop = asyncio.get_running_loop()
+    try:
+        # extract_info é bloqueante: roda fora do event loop (o cache de formatos evita na maioria das vezes)
+        chosen = await loop.run_in_executor(None, resolve_audio_format, video_id, url)
+    except FormatNotFound as e:
+        return await _send_json(send, scope, 404, {'error': str(e)})
+    except Exception as e:
+        log.error("Erro no stream proxy: %s", e)
+        return await _send_json(send, scope, 500, {'error': str(e)})
+
+    if not chosen.get('streamable'):
+        # Fallback HLS/DASH (conversão ao vivo + cache em disco) fica com o Flask
+        return await wsgi_app(scope, receive, send)
+    if fonte_em_cache(video_id, chosen.get('format_id')):
+        # Faixa inteira no cache tee do Flask: servida do disco, com Range/ETag
+        return await wsgi_app(scope, receive, send)
+
+    range_header = None
+    for name, value in scope.get('headers', []):
+        if name == b'range':
+            range_header = value.decode('latin-1')
+    try:
+        if STREAM_TEE_CACHE:
+            return await _stream_com_tee(scope, receive, send, video_id, chosen, range_header)
+        upstream = await _abrir_upstream(video_id, chosen['url'], {'Range': range_header} if range_header else {})
+    except Exception as e:
+        log.error("Erro no stream proxy: %s", e)
+        return await _send_json(send, scope, 500, {'error': str(e)})
+
+    async def partes():
+        yield 'upstream', _repassar_com_tee(upstream, None, 0)
+
+    headers = [(b'content-type', chosen.get('content_type', 'audio/mpeg').encode())] + _headers_upstream(upstream)
+    try:
+        await _enviar(scope, receive, send, video_id, upstream.status, headers, partes())
+    finally:
+        await upstream.close()
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    path = scope.get('path', '')
+    if scope['type'] == 'http' and scope.get('method') == 'GET' and path.startswith('/stream/'):
+        video_id = path[len('/stream/'):]
+        if video_id and '/' not in video_id:
+            return await stream_video_audio(scope, receive, send, video_id)
+    return await wsgi_app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(os.environ.get("PORT", 5000))
+    host = "0.0.0.0" if os.environ.get("PRODUCTION") else "127.0.0.1"
+
+    log.info("Iniciando servidor ASGI na porta %s", port)
+    log.info("Host: %s", host)
+
+    uvicorn.run(app, host=host, port=port)
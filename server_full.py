@@ -1,154 +1,3228 @@
-from flask import Flask, request, send_file, jsonify, Response
+from flask import Flask, request, jsonify, Response, g
 import yt_dlp
 import os
 import uuid
 from flask_cors import CORS
 import threading
 import time
-import urllib.request as urllib_request
+import urllib.error as urllib_error
+import urllib.parse as urllib_parse
+import http.client as http_client
 from flask import stream_with_context
 import shutil
+import tempfile
+import io
 import subprocess
 import re
+import json
+import sys
+import itertools
+import contextlib
+import logging
+import email.utils
 import zipfile
+import sqlite3
 import concurrent.futures
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
 DOWNLOAD_FOLDER = 'downloads'
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 
-progress = {}
-# Simple in-memory search cache: { query_normalized: (timestamp, results) }
-SEARCH_CACHE = {}
-SEARCH_CACHE_TTL = 300  # seconds
+# Logs com nível (LOG_LEVEL=DEBUG mostra os detalhes por requisição, desligados por padrão)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+log = logging.getLogger('ytapi')
+
+# Métricas expostas em /metrics (formato texto do Prometheus)
+METRICS_STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metrics:
+    """Registro mínimo de contadores, gauges e histogramas com labels.
+    Valores que já existem em outros lugares (filas, pools, caches) entram por coletores chamados em cada scrape.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # { nome: (tipo, ajuda, buckets) }
+        self._values = {}  # { nome: { labels: valor } }
+        self._hists = {}  # { nome: { labels: [contagens por bucket, soma, total] } }
+        self._collectors = []
+
+    def _register(self, kind, name, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, buckets)
+        if kind == 'histogram':
+            self._hists[name] = {}
+        else:
+            self._values[name] = {}
+
+    def counter(self, name, help_text):
+        self._register('counter', name, help_text)
+
+    def gauge(self, name, help_text):
+        self._register('gauge', name, help_text)
+
+    def histogram(self, name, help_text, buckets=METRICS_STAGE_BUCKETS):
+        self._register('histogram', name, help_text, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def dec(self, name, value=1, **labels):
+        self.inc(name, -value, **labels)
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self._meta[name][2]
+        with self._lock:
+            hist = self._hists[name].get(key)
+            if hist is None:
+                hist = self._hists[name][key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @contextlib.contextmanager
+    def cronometro(self, stage):
+        """Mede a duração do bloco no histograma de estágios (conta também quando o bloco falha)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('ytapi_stage_duration_seconds', time.perf_counter() - start, stage=stage)
+
+    def coletor(self, fn):
+        """fn() -> [(nome, tipo, ajuda, [(labels, valor), ...]), ...]"""
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items]
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in self._meta.items():
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+                if kind == 'histogram':
+                    for labels, (counts, total, count) in self._hists[name].items():
+                        for bound, bucket_count in zip(buckets, counts):
+                            lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {bucket_count}')
+                        lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {count}')
+                        lines.append(f'{name}_sum{self._labels(labels)} {total}')
+                        lines.append(f'{name}_count{self._labels(labels)} {count}')
+                else:
+                    for labels, value in self._values[name].items():
+                        lines.append(f'{name}{self._labels(labels)} {value}')
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                log.warning("Erro no coletor de métricas %s: %s", getattr(collector, '__name__', collector), e)
+                continue
+            for name, kind, help_text, samples in families:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+                for labels, value in samples:
+                    lines.append(f'{name}{self._labels(sorted(labels.items()))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+METRICS.histogram('ytapi_stage_duration_seconds', 'Duração de cada estágio (extração, download, conversão, zip, upstream)')
+METRICS.histogram('ytapi_http_request_duration_seconds', 'Tempo até a resposta HTTP (sem o corpo em streaming)')
+METRICS.counter('ytapi_http_responses_total', 'Respostas HTTP por rota e status')
+METRICS.counter('ytapi_cache_lookups_total', 'Consultas aos caches de formato e de stream em disco')
+METRICS.counter('ytapi_stream_bytes_total', 'Bytes entregues pelo /stream (proxy do upstream ou arquivo)')
+METRICS.gauge('ytapi_active_streams', 'Respostas do /stream em andamento')
+METRICS.counter('ytapi_outputs_total', 'Arquivos gerados pelo /baixar por perfil e modo (copy = sem reencode)')
+METRICS.counter('ytapi_prefetch_total', 'Itens aquecidos pelo /prefetch por resultado')
+
+# Backend do estado compartilhado (progresso das tarefas e caches de /search e /info).
+# 'memory' (padrão) mantém tudo no processo. Para rodar com vários workers/nós:
+#   STATE_BACKEND=sqlite:///caminho/estado.sqlite3  (workers na mesma máquina)
+#   STATE_BACKEND=redis://host:6379/0               (qualquer servidor compatível com Redis; requer o pacote redis)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+STATE_SYNC_INTERVAL = float(os.environ.get('STATE_SYNC_INTERVAL', 0.5))  # seconds entre publicações do progresso
+
+
+class MemoryStateBackend:
+    """Estado só deste processo: { (ns, chave): (expira, valor) }"""
+    compartilhado = False
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, ns, key):
+        with self._lock:
+            entry = self._data.get((ns, key))
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= time.time():
+                del self._data[(ns, key)]
+                return None
+            return entry[1]
+
+    def set(self, ns, key, value, ttl=None):
+        with self._lock:
+            self._data[(ns, key)] = (time.time() + ttl if ttl else None, value)
+
+    def delete(self, ns, key):
+        with self._lock:
+            self._data.pop((ns, key), None)
+
+    def limpar(self):
+        now = time.time()
+        with self._lock:
+            for k in [k for k, (expira, _) in self._data.items() if expira is not None and expira <= now]:
+                del self._data[k]
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'keys': len(self._data)}
+
+
+class SQLiteStateBackend:
+    """Estado em um arquivo SQLite (modo WAL) visível para todos os processos da máquina"""
+    compartilhado = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        pasta = os.path.dirname(os.path.abspath(path))
+        os.makedirs(pasta, exist_ok=True)
+        with self._conn() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS estado ('
+                ' ns TEXT NOT NULL, chave TEXT NOT NULL, valor TEXT NOT NULL, expira REAL,'
+                ' PRIMARY KEY (ns, chave))'
+            )
+
+    def _conn(self):
+        # Uma conexão por thread: sqlite3 não compartilha conexões entre threads com segurança
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, ns, key):
+        row = self._conn().execute(
+            'SELECT valor FROM estado WHERE ns = ? AND chave = ? AND (expira IS NULL OR expira > ?)',
+            (ns, key, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, ns, key, value, ttl=None):
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO estado (ns, chave, valor, expira) VALUES (?, ?, ?, ?)',
+                (ns, key, json.dumps(value), time.time() + ttl if ttl else None),
+            )
+
+    def delete(self, ns, key):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM estado WHERE ns = ? AND chave = ?', (ns, key))
+
+    def limpar(self):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM estado WHERE expira IS NOT NULL AND expira <= ?', (time.time(),))
+
+    def stats(self):
+        total = self._conn().execute('SELECT COUNT(*) FROM estado').fetchone()[0]
+        return {'backend': 'sqlite', 'path': self.path, 'keys': total}
+
+
+class RedisStateBackend:
+    """Estado em um servidor compatível com Redis (chaves '<prefixo><ns>:<chave>', valores JSON, TTL nativo)"""
+    compartilhado = True
+
+    def __init__(self, url, prefix=None):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('STATE_BACKEND=redis:// requer o pacote redis (pip install redis)')
+        self.url = url
+        self.prefix = prefix if prefix is not None else os.environ.get('STATE_REDIS_PREFIX', 'ytapi:')
+        self._redis = redis.Redis.from_url(url)
+
+    def _key(self, ns, key):
+        return f'{self.prefix}{ns}:{key}'
+
+    def get(self, ns, key):
+        raw = self._redis.get(self._key(ns, key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, ns, key, value, ttl=None):
+        self._redis.set(self._key(ns, key), json.dumps(value), ex=max(int(ttl), 1) if ttl else None)
+
+    def delete(self, ns, key):
+        self._redis.delete(self._key(ns, key))
+
+    def limpar(self):
+        pass  # o próprio servidor expira as chaves
+
+    def stats(self):
+        return {'backend': 'redis', 'host': urllib_parse.urlsplit(self.url).hostname, 'prefix': self.prefix}
+
+
+def criar_backend_estado(url):
+    if not url or url == 'memory':
+        return MemoryStateBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteStateBackend(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStateBackend(url)
+    raise ValueError(f'STATE_BACKEND não suportado: {url}')
+
+
+STATE = criar_backend_estado(STATE_BACKEND)
+
+# Progresso das tarefas do /baixar, com limite de tamanho e expiração das tarefas concluídas
+TASK_STORE_MAX = int(os.environ.get('TASK_STORE_MAX', 5000))
+TASK_TTL = int(os.environ.get('TASK_TTL', 3600))  # seconds após concluir
+
+
+class TaskStore(MutableMapping):
+    """Dicionário { task_id: progresso, '<task_id>_filename': nome } que descarta tarefas concluídas
+    há mais de `ttl` segundos e, acima de `max_tasks`, as concluídas mais antigas primeiro.
+    Com um backend compartilhado, as tarefas deste processo são publicadas nele e as dos
+    outros workers são lidas de lá (somente leitura).
+    """
+
+    def __init__(self, max_tasks=TASK_STORE_MAX, ttl=TASK_TTL, backend=None):
+        self.max_tasks = max_tasks
+        self.ttl = ttl
+        self.backend = backend if backend is not None and backend.compartilhado else None
+        self._data = {}
+        self._finished_at = {}  # { task_id: quando foi vista concluída pela primeira vez }
+        self._publicado = {}  # { chave: último JSON publicado no backend }
+        self._finais = set()  # chaves já publicadas como concluídas
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def task_id_of(key):
+        return key[:-len('_filename')] if key.endswith('_filename') else key
+
+    def is_finished(self, task_id):
+        prog = self._data.get(task_id)
+        if isinstance(prog, dict):
+            return prog.get('global') in (100, -1)
+        return prog in (100, -1)
+
+    def local(self, task_id):
+        """True se a tarefa roda (ou rodou) neste processo"""
+        return task_id in self._data
+
+    def _remoto(self, key):
+        if self.backend is None:
+            return None
+        try:
+            return self.backend.get('task', key)
+        except Exception as e:
+            log.warning("Erro ao ler tarefa do backend de estado: %s", e)
+            return None
+
+    def meta_remota(self, task_id):
+        """Metadados publicados pelo worker dono da tarefa ({} se não houver)"""
+        entry = self._remoto(task_id)
+        return (entry or {}).get('meta') or {}
+
+    def __getitem__(self, key):
+        try:
+            return self._data[key]
+        except KeyError:
+            entry = self._remoto(key)
+            if entry is None:
+                raise
+            return entry['valor']
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            novo = key not in self._data
+            self._data[key] = value
+            self._finais.discard(key)
+        if novo and len(self._data) > self.max_tasks * 2:
+            self.purge()
+        self.publicar(key)
+        notificar_tarefa()
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+            self._publicado.pop(key, None)
+            self._finais.discard(key)
+        if self.backend is not None:
+            try:
+                self.backend.delete('task', key)
+            except Exception as e:
+                log.warning("Erro ao remover tarefa do backend de estado: %s", e)
+
+    def publicar(self, key):
+        """Publica no backend o valor atual da chave, se mudou desde a última publicação"""
+        if self.backend is None:
+            return
+        task_id = self.task_id_of(key)
+        entry = {'valor': self._data.get(key)}
+        if entry['valor'] is None:
+            return
+        if key == task_id:
+            entry['meta'] = meta_tarefa(task_id)
+        try:
+            payload = json.dumps(entry, sort_keys=True)
+        except RuntimeError:
+            return  # dicionário alterado por outra thread durante a serialização; vai na próxima sincronização
+        if self._publicado.get(key) == payload:
+            return
+        # Tarefas em andamento também expiram, para não sobrarem se o worker morrer
+        ttl = self.ttl if self.is_finished(task_id) else self.ttl * 24
+        try:
+            self.backend.set('task', key, entry, ttl)
+            self._publicado[key] = payload
+            if self.is_finished(task_id):
+                self._finais.add(key)  # concluída: daqui em diante só muda via __setitem__
+        except Exception as e:
+            log.warning("Erro ao publicar tarefa no backend de estado: %s", e)
+
+    def sincronizar(self):
+        """Publica as mudanças feitas direto nos dicionários de progresso (ex.: percentual das músicas).
+        Retorna os task_ids deste processo ainda em andamento."""
+        ativas = []
+        for key in list(self._data):
+            if key in self._finais:
+                continue
+            self.publicar(key)
+            task_id = self.task_id_of(key)
+            if key == task_id and not self.is_finished(task_id):
+                ativas.append(task_id)
+        return ativas
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def _drop(self, task_id):
+        self._data.pop(task_id, None)
+        self._data.pop(f"{task_id}_filename", None)
+        for key in (task_id, f"{task_id}_filename"):
+            self._publicado.pop(key, None)
+            self._finais.discard(key)
+        self._finished_at.pop(task_id, None)
+        PLAYLIST_STATE.pop(task_id, None)
+        SCHEDULER.forget(task_id)
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            task_ids = [k for k in self._data if not k.endswith('_filename')]
+            for task_id in task_ids:
+                if self.is_finished(task_id):
+                    self._finished_at.setdefault(task_id, now)
+                else:
+                    self._finished_at.pop(task_id, None)
+            for task_id, finished_at in list(self._finished_at.items()):
+                if now - finished_at > self.ttl:
+                    self._drop(task_id)
+            excesso = len([k for k in self._data if not k.endswith('_filename')]) - self.max_tasks
+            if excesso > 0:
+                for task_id, _ in sorted(self._finished_at.items(), key=lambda item: item[1])[:excesso]:
+                    self._drop(task_id)
+
+
+progress = TaskStore(backend=STATE)
+# Estado das playlists em andamento: { task_id: {'restantes', 'arquivos', 'lock', 'zip_stream'} }
+PLAYLIST_STATE = {}
+TASK_COND = threading.Condition()
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 300))  # seconds
+SEARCH_CACHE_STALE_TTL = int(os.environ.get('SEARCH_CACHE_STALE_TTL', 3600))  # serve vencido enquanto atualiza
+SEARCH_CACHE_MAX = int(os.environ.get('SEARCH_CACHE_MAX', 2000))
 
 def get_ffmpeg_path():
     """Detecta automaticamente o caminho do FFmpeg"""
     # Primeiro, tenta encontrar no PATH
     ffmpeg_cmd = shutil.which('ffmpeg')
     if ffmpeg_cmd:
-        print(f"FFmpeg encontrado no PATH: {ffmpeg_cmd}")
+        log.info("FFmpeg encontrado no PATH: %s", ffmpeg_cmd)
         return ffmpeg_cmd
     
     # Depois, tenta encontrar localmente (Windows)
     local_ffmpeg = os.path.join(os.path.dirname(__file__), 'ffmpeg.exe')
     if os.path.isfile(local_ffmpeg):
-        print(f"FFmpeg encontrado localmente: {local_ffmpeg}")
+        log.info("FFmpeg encontrado localmente: %s", local_ffmpeg)
         return local_ffmpeg
     
     # Se não encontrou, avisa
-    print("AVISO: FFmpeg não encontrado! Downloads podem falhar.")
+    log.warning("FFmpeg não encontrado! Downloads podem falhar.")
+    return None
+
+# Detecta FFmpeg na inicialização
+FFMPEG_PATH = get_ffmpeg_path()
+
+# Pool de instâncias YoutubeDL já inicializadas, por perfil de opções.
+# Criar um YoutubeDL a cada requisição refaz o registro de extratores, o parse das opções,
+# o cookie jar e o opener HTTP; aqui as instâncias são reaproveitadas (uma por vez, não são thread-safe)
+# e recicladas depois de YDL_POOL_MAX_USES usos.
+YDL_PROFILES = {
+    'search': {'quiet': True, 'skip_download': True, 'extract_flat': True},
+    'playlist': {'quiet': True, 'extract_flat': 'in_playlist', 'lazy_playlist': True},
+    'info': {'quiet': True},
+    'download': {'format': 'bestaudio/best', 'quiet': True, 'noplaylist': True, 'extract_flat': False},
+}
+YDL_POOL_SIZE = int(os.environ.get('YDL_POOL_SIZE', 4))  # instâncias por perfil
+YDL_POOL_MAX_USES = int(os.environ.get('YDL_POOL_MAX_USES', 200))  # recicla depois de N extrações
+YDL_POOL_WAIT = float(os.environ.get('YDL_POOL_WAIT', 5))  # espera por uma instância livre antes de criar uma avulsa
+
+
+class ExtractorPool:
+    def __init__(self, profiles, size=YDL_POOL_SIZE, max_uses=YDL_POOL_MAX_USES, wait=YDL_POOL_WAIT):
+        self.profiles = profiles
+        self.size = size
+        self.max_uses = max_uses
+        self.wait = wait
+        self._cond = threading.Condition()
+        self._idle = {name: [] for name in profiles}  # { perfil: [[ydl, usos], ...] }
+        self._created = {name: 0 for name in profiles}
+        self._counters = {name: {'created': 0, 'reused': 0, 'recycled': 0, 'overflow': 0} for name in profiles}
+
+    def _new(self, profile):
+        return [yt_dlp.YoutubeDL(dict(self.profiles[profile])), 0]
+
+    @staticmethod
+    def _close(slot):
+        try:
+            slot[0].__exit__(None, None, None)
+        except Exception:
+            pass
+
+    def _checkout(self, profile):
+        deadline = time.time() + self.wait
+        with self._cond:
+            while True:
+                idle = self._idle[profile]
+                if idle:
+                    self._counters[profile]['reused'] += 1
+                    return idle.pop(), True
+                if self._created[profile] < self.size:
+                    self._created[profile] += 1
+                    self._counters[profile]['created'] += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # Todas ocupadas (ex.: playlists longas paginando): instância avulsa, descartada no fim
+                    self._counters[profile]['overflow'] += 1
+                    return self._new(profile), False
+                self._cond.wait(remaining)
+        try:
+            return self._new(profile), True
+        except Exception:
+            with self._cond:
+                self._created[profile] -= 1
+                self._cond.notify()
+            raise
+
+    def _checkin(self, profile, slot, pooled, ok):
+        slot[1] += 1
+        if not pooled:
+            self._close(slot)
+            return
+        if ok and slot[1] < self.max_uses:
+            with self._cond:
+                self._idle[profile].append(slot)
+                self._cond.notify()
+            return
+        # Erro no meio da extração ou uso máximo atingido: troca por uma instância nova na próxima vez
+        self._close(slot)
+        with self._cond:
+            self._created[profile] -= 1
+            self._counters[profile]['recycled'] += 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def usar(self, profile):
+        """Empresta uma instância YoutubeDL do perfil; devolve ao pool na saída do bloco"""
+        slot, pooled = self._checkout(profile)
+        ok = False
+        try:
+            yield slot[0]
+            ok = True
+        finally:
+            self._checkin(profile, slot, pooled, ok)
+
+    def aquecer(self):
+        """Cria uma instância de cada perfil antes da primeira requisição"""
+        for profile in self.profiles:
+            try:
+                with self.usar(profile):
+                    pass
+            except Exception as e:
+                log.warning("Falha ao aquecer extrator '%s': %s", profile, e)
+
+    def stats(self):
+        with self._cond:
+            return {
+                profile: dict(self._counters[profile], idle=len(self._idle[profile]), live=self._created[profile])
+                for profile in self.profiles
+            }
+
+
+EXTRACTORS = ExtractorPool(YDL_PROFILES)
+threading.Thread(target=EXTRACTORS.aquecer, name='ydl-warmup', daemon=True).start()
+
+# Cache de formatos de áudio resolvidos para /stream: { video_id: entry }
+# entry = {'url', 'ext', 'protocol', 'content_type', 'format_id', 'abr', 'streamable', 'expires'}
+# Falhas ficam em cache por pouco tempo: { video_id: {'error': msg, 'expires': ts} }
+FORMAT_CACHE = OrderedDict()
+FORMAT_CACHE_LOCK = threading.Lock()
+FORMAT_CACHE_MAX = int(os.environ.get('FORMAT_CACHE_MAX', 512))
+FORMAT_CACHE_DEFAULT_TTL = int(os.environ.get('FORMAT_CACHE_DEFAULT_TTL', 3600))  # seconds, quando a URL não traz expire=
+FORMAT_CACHE_EXPIRY_MARGIN = int(os.environ.get('FORMAT_CACHE_EXPIRY_MARGIN', 60))  # expira antes da URL assinada
+FORMAT_CACHE_NEGATIVE_TTL = int(os.environ.get('FORMAT_CACHE_NEGATIVE_TTL', 30))
+FORMAT_INFLIGHT = {}  # { video_id: Future } extrações em andamento, guardado por FORMAT_CACHE_LOCK
+
+
+class FormatNotFound(Exception):
+    """Nenhum formato de áudio utilizável para o vídeo"""
+
+
+def content_type_for_ext(ext):
+    ext = (ext or '').lower()
+    if ext in ['m4a', 'mp4']:
+        return 'audio/mp4'
+    if ext in ['webm', 'opus']:
+        return 'audio/webm'
+    return 'audio/mpeg'
+
+
+def is_streamable_protocol(proto):
+    proto = (proto or '').lower()
+    # Exclui HLS (m3u8) e DASH fragmentado
+    return 'm3u8' not in proto and 'dash' not in proto and 'fragmented' not in proto
+
+
+def url_expiry(stream_url):
+    """Lê o timestamp `expire` da URL assinada do googlevideo (query ou path)"""
+    if not stream_url:
+        return None
+    try:
+        parsed = urllib_parse.urlparse(stream_url)
+        values = urllib_parse.parse_qs(parsed.query).get('expire')
+        if values:
+            return int(values[0])
+        match = re.search(r'/expire/(\d+)', parsed.path)
+        if match:
+            return int(match.group(1))
+    except (ValueError, TypeError):
+        pass
     return None
 
-# Detecta FFmpeg na inicialização
-FFMPEG_PATH = get_ffmpeg_path()
 
-@app.route('/')
-def home():
+def choose_audio_format(info):
+    """Escolhe o melhor formato de áudio, priorizando os que permitem streaming direto"""
+    formats = info.get('formats', []) if info else []
+    # Filtra formatos de áudio
+    audio_formats = [f for f in formats if f.get('acodec') and f.get('acodec') != 'none']
+    if not audio_formats:
+        return None
+
+    # PRIORIDADE 1: Formatos que suportam streaming direto (não HLS/DASH)
+    streamable_formats = [f for f in audio_formats if f.get('url') is not None and is_streamable_protocol(f.get('protocol'))]
+
+    # Se temos formatos streamáveis, usa o melhor deles
+    if streamable_formats:
+        # Ordena por qualidade (abr) e depois por preferência de codec
+        streamable_formats.sort(key=lambda x: (
+            x.get('abr') or 0,  # bitrate
+            1 if x.get('ext') == 'webm' else 0,  # prefere não-webm
+            1 if 'opus' in (x.get('acodec') or '') else 0  # prefere não-opus
+        ), reverse=True)
+        chosen = streamable_formats[0]
+        log.debug("Usando streaming direto: %s - %skbps %s", chosen.get('format_id'), chosen.get('abr'), chosen.get('ext'))
+    else:
+        # FALLBACK: usa o melhor formato disponível (incluindo HLS/DASH)
+        audio_formats.sort(key=lambda x: (x.get('abr') or 0), reverse=True)
+        chosen = audio_formats[0]
+        log.debug("Usando formato não-streaming (fallback): %s - %skbps %s", chosen.get('format_id'), chosen.get('abr'), chosen.get('ext'))
+    return chosen
+
+
+def _format_cache_get(video_id):
+    now = time.time()
+    with FORMAT_CACHE_LOCK:
+        entry = FORMAT_CACHE.get(video_id)
+        if entry is None:
+            return None
+        if entry['expires'] <= now:
+            del FORMAT_CACHE[video_id]
+            return None
+        FORMAT_CACHE.move_to_end(video_id)
+        return entry
+
+
+def _format_cache_put(video_id, entry):
+    with FORMAT_CACHE_LOCK:
+        FORMAT_CACHE[video_id] = entry
+        FORMAT_CACHE.move_to_end(video_id)
+        while len(FORMAT_CACHE) > FORMAT_CACHE_MAX:
+            FORMAT_CACHE.popitem(last=False)
+
+
+def invalidate_audio_format(video_id):
+    with FORMAT_CACHE_LOCK:
+        FORMAT_CACHE.pop(video_id, None)
+
+
+def _format_cache_entry(entry):
+    if 'error' in entry:
+        if entry.get('not_found'):
+            raise FormatNotFound(entry['error'])
+        raise RuntimeError(entry['error'])
+    return entry
+
+
+def resolve_audio_format(video_id, url):
+    """Retorna o formato de áudio escolhido para o vídeo, usando o cache quando possível.
+    Lança FormatNotFound quando não há áudio (resultado também fica em cache por pouco tempo).
+    Pedidos simultâneos para o mesmo vídeo esperam uma única extração (single-flight).
+    """
+    entry = _format_cache_get(video_id)
+    METRICS.inc('ytapi_cache_lookups_total', cache='format', result='miss' if entry is None else 'hit')
+    if entry is not None:
+        return _format_cache_entry(entry)
+
+    with FORMAT_CACHE_LOCK:
+        future = FORMAT_INFLIGHT.get(video_id)
+        dono = future is None
+        if dono:
+            future = FORMAT_INFLIGHT[video_id] = concurrent.futures.Future()
+    if not dono:
+        return _format_cache_entry(future.result())
+
+    entry = {'error': 'Extração de formato interrompida', 'not_found': False}
+    try:
+        entry = _extrair_audio_format(video_id, url)
+    except FormatNotFound as e:
+        entry = {'error': str(e), 'not_found': True}
+        raise
+    except Exception as e:
+        entry = {'error': str(e), 'not_found': False}
+        raise
+    finally:
+        with FORMAT_CACHE_LOCK:
+            FORMAT_INFLIGHT.pop(video_id, None)
+        future.set_result(entry)
+    return entry
+
+
+def _extrair_audio_format(video_id, url):
+    try:
+        # Extrai formatos e escolhe melhor áudio
+        with EXTRACTORS.usar('info') as ydl, METRICS.cronometro('extract_format'):
+            info = ydl.extract_info(url, download=False)
+    except Exception as e:
+        _format_cache_put(video_id, {'error': str(e), 'not_found': False, 'expires': time.time() + FORMAT_CACHE_NEGATIVE_TTL})
+        raise
+
+    chosen = choose_audio_format(info)
+    if not chosen:
+        message = 'Formato de áudio não encontrado'
+        _format_cache_put(video_id, {'error': message, 'not_found': True, 'expires': time.time() + FORMAT_CACHE_NEGATIVE_TTL})
+        raise FormatNotFound(message)
+
+    stream_url = chosen.get('url')
+    ext = (chosen.get('ext') or '').lower()
+    proto = (chosen.get('protocol') or '').lower()
+    expire = url_expiry(stream_url)
+    if expire:
+        expires = expire - FORMAT_CACHE_EXPIRY_MARGIN
+    else:
+        expires = time.time() + FORMAT_CACHE_DEFAULT_TTL
+    entry = {
+        'url': stream_url,
+        'ext': ext,
+        'protocol': proto,
+        'content_type': content_type_for_ext(ext),
+        'format_id': chosen.get('format_id'),
+        'abr': chosen.get('abr'),
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'http_headers': chosen.get('http_headers') or {},
+        'streamable': bool(stream_url) and is_streamable_protocol(proto),
+        'expires': expires,
+    }
+    if expires > time.time():
+        _format_cache_put(video_id, entry)
+    return entry
+
+
+# Cache em disco do áudio convertido pelo fallback HLS/DASH do /stream
+# Arquivos: <DOWNLOAD_FOLDER>/stream_cache/<video_id>_<format_id>.mp3 (mtime = último acesso)
+STREAM_CACHE_FOLDER = os.path.join(DOWNLOAD_FOLDER, 'stream_cache')
+STREAM_CACHE_MAX_BYTES = int(os.environ.get('STREAM_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# Conversão ao vivo: o ffmpeg entrega o MP3 ao ouvinte enquanto converte (0 = baixa e converte tudo antes)
+STREAM_LIVE_TRANSCODE = os.environ.get('STREAM_LIVE_TRANSCODE', '1') != '0'
+STREAM_LIVE_START_TIMEOUT = float(os.environ.get('STREAM_LIVE_START_TIMEOUT', 20))  # seconds até o primeiro byte
+STREAM_LIVE_CHUNK_SIZE = 16 * 1024
+# Cache "tee" do proxy direto: os bytes repassados do upstream ficam em <key>.src.partial, com os intervalos
+# presentes em <key>.src.json; completo, vira <key>.src e serve de entrada para o pipeline de download
+STREAM_TEE_CACHE = os.environ.get('STREAM_TEE_CACHE', '1') != '0'
+STREAM_TEE_MAX_FILE = int(os.environ.get('STREAM_TEE_MAX_FILE', 256 * 1024 ** 2))  # não guarda faixas maiores
+STREAM_TEE_SAVE_BYTES = 4 * 1024 ** 2  # persiste os intervalos a cada N bytes novos
+STREAM_CACHE_SUFFIXES = ('.mp3', '.src', '.src.partial')
+STREAM_CACHE_EVICT_INTERVAL = int(os.environ.get('STREAM_CACHE_EVICT_INTERVAL', 30))  # seconds entre varreduras do tee
+os.makedirs(STREAM_CACHE_FOLDER, exist_ok=True)
+STREAM_CACHE_LOCKS = {}  # { chave: [lock, requisições usando] }, só enquanto alguém usa a chave
+STREAM_CACHE_LOCKS_GUARD = threading.Lock()
+
+
+def _stream_cache_key(video_id, format_id):
+    return re.sub(r'[^\w\-]', '_', f'{video_id}_{format_id}')
+
+
+@contextlib.contextmanager
+def _stream_cache_lock(key):
+    """Lock por chave do cache; a entrada sai de STREAM_CACHE_LOCKS quando o último usuário termina"""
+    with STREAM_CACHE_LOCKS_GUARD:
+        entry = STREAM_CACHE_LOCKS.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with STREAM_CACHE_LOCKS_GUARD:
+            entry[1] -= 1
+            if not entry[1]:
+                del STREAM_CACHE_LOCKS[key]
+
+
+def evict_stream_cache(keep=None):
+    """Remove os arquivos menos usados até o cache caber em STREAM_CACHE_MAX_BYTES"""
+    entries = []
+    total = 0
+    for name in os.listdir(STREAM_CACHE_FOLDER):
+        path = os.path.join(STREAM_CACHE_FOLDER, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if not name.endswith(STREAM_CACHE_SUFFIXES):
+            continue
+        # Parciais do cache tee são esparsos: conta o que ocupa de fato no disco
+        size = st.st_blocks * 512 if name.endswith('.partial') and hasattr(st, 'st_blocks') else st.st_size
+        entries.append((st.st_mtime, size, path))
+        total += size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= STREAM_CACHE_MAX_BYTES:
+            break
+        if path == keep or STORAGE.fixado(path):
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            if path.endswith('.src.partial'):
+                os.remove(path[:-len('.partial')] + '.json')
+            log.info("Cache de stream: removido %s", path)
+        except OSError:
+            pass
+
+
+def get_cached_stream_audio(video_id, url, chosen):
+    """Retorna o caminho do MP3 em cache para (video_id, format_id), baixando e convertendo só na primeira vez"""
+    key = _stream_cache_key(video_id, chosen.get('format_id'))
+    cache_path = os.path.join(STREAM_CACHE_FOLDER, f'{key}.mp3')
+    with _stream_cache_lock(key):
+        if os.path.isfile(cache_path):
+            try:
+                os.utime(cache_path)  # marca acesso para o LRU
+            except OSError:
+                pass
+            METRICS.inc('ytapi_cache_lookups_total', cache='stream_disk', result='hit')
+            return cache_path
+        METRICS.inc('ytapi_cache_lookups_total', cache='stream_disk', result='miss')
+
+        log.info("Iniciando download temporário para streaming: %s", chosen.get('format_id'))
+        part_stem = os.path.join(STREAM_CACHE_FOLDER, f'{key}.{uuid.uuid4().hex[:8]}.part')
+        # Opções otimizadas para streaming rápido
+        ydl_opts_dl = {
+            'format': chosen.get('format_id'),  # Usa exatamente o formato escolhido
+            'outtmpl': part_stem + '.%(ext)s',
+            'quiet': not log.isEnabledFor(logging.DEBUG),  # Mostra progresso com LOG_LEVEL=DEBUG
+            'noplaylist': True,
+            'ffmpeg_location': FFMPEG_PATH,
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '128',
+            }] if chosen.get('ext') != 'mp3' else [],  # Só converte se não for já mp3
+        }
+        try:
+            log.debug("Baixando para arquivo temporário: %s", part_stem)
+            with yt_dlp.YoutubeDL(ydl_opts_dl) as ydl, METRICS.cronometro('stream_cache_download'):
+                ydl.download([url])
+            os.replace(part_stem + '.mp3', cache_path)
+        finally:
+            for name in os.listdir(STREAM_CACHE_FOLDER):
+                if name.startswith(os.path.basename(part_stem)):
+                    try:
+                        os.remove(os.path.join(STREAM_CACHE_FOLDER, name))
+                    except OSError:
+                        pass
+        log.info("Download concluído: %s", cache_path)
+    evict_stream_cache(keep=cache_path)
+    return cache_path
+
+
+
+class LiveTranscode:
+    """Conversão ao vivo do fallback HLS/DASH para MP3, compartilhada entre os ouvintes da mesma faixa.
+    O ffmpeg escreve no stdout; os bytes vão para um .part no cache de stream e cada ouvinte lê o arquivo
+    do início, esperando pelo que ainda não saiu. No fim o .part vira o <key>.mp3 do cache (com Range/seek).
+    """
+
+    def __init__(self, key, url, chosen):
+        self.key = key
+        self.cache_path = os.path.join(STREAM_CACHE_FOLDER, f'{key}.mp3')
+        self.part_path = os.path.join(STREAM_CACHE_FOLDER, f'{key}.{uuid.uuid4().hex[:8]}.part')
+        self.size = 0
+        self.done = False
+        self.failed = False
+        self.listeners = 0
+        self._cond = threading.Condition()
+        self._out = open(self.part_path, 'wb', buffering=0)
+        STORAGE.fixar(self.part_path)
+        self._thread = threading.Thread(target=self._run, args=(url, chosen), daemon=True)
+        self._thread.start()
+
+    def _processos(self, url, chosen):
+        """Inicia (ffmpeg, alimentador): HLS o ffmpeg lê direto; DASH fragmentado vem do yt-dlp pelo stdout"""
+        saida = argumentos_saida('mp3-128', False) + ['-write_xing', '0', 'pipe:1']
+        proto = chosen.get('protocol') or ''
+        if 'm3u8' in proto and chosen.get('url'):
+            header_lines = ''.join(f'{k}: {v}\r\n' for k, v in (chosen.get('http_headers') or {}).items())
+            entrada = (['-headers', header_lines] if header_lines else []) + ['-i', chosen['url']]
+            feeder = None
+        else:
+            feeder = subprocess.Popen(
+                [sys.executable, '-m', 'yt_dlp', '-q', '--no-warnings', '--no-playlist',
+                 '-f', chosen.get('format_id') or 'bestaudio', '-o', '-', '--', url],
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            entrada = ['-i', 'pipe:0']
+        try:
+            ffmpeg = subprocess.Popen([FFMPEG_PATH, '-hide_banner', '-loglevel', 'error'] + entrada + saida,
+                                      stdin=feeder.stdout if feeder else subprocess.DEVNULL,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except BaseException:
+            if feeder:
+                feeder.kill()
+                feeder.wait()
+            raise
+        if feeder:
+            feeder.stdout.close()  # o ffmpeg é o único leitor
+        return ffmpeg, feeder
+
+    def _run(self, url, chosen):
+        ok = False
+        ffmpeg = feeder = None
+        stderr_tail = []
+
+        def read_stderr():
+            # Lido o tempo todo: um ffmpeg verboso não pode encher o pipe e travar a conversão
+            for line in io.TextIOWrapper(ffmpeg.stderr, encoding='utf-8', errors='replace'):
+                stderr_tail.append(line)
+                del stderr_tail[:-20]
+
+        try:
+            with METRICS.cronometro('live_transcode'):
+                ffmpeg, feeder = self._processos(url, chosen)
+                stderr_thread = threading.Thread(target=read_stderr, daemon=True)
+                stderr_thread.start()
+                for data in iter(lambda: ffmpeg.stdout.read1(STREAM_LIVE_CHUNK_SIZE), b''):
+                    self._out.write(data)
+                    with self._cond:
+                        self.size += len(data)
+                        self._cond.notify_all()
+                ffmpeg.wait()
+                if feeder:
+                    feeder.wait()
+                stderr_thread.join(timeout=5)
+            ok = ffmpeg.returncode == 0 and (feeder is None or feeder.returncode == 0) and self.size > 0
+            if not ok:
+                log.error("Falha na conversão ao vivo de %s: %s", self.key, ''.join(stderr_tail).strip())
+        except Exception as e:
+            log.exception("Erro na conversão ao vivo de %s: %s", self.key, e)
+        finally:
+            # Em caso de erro no meio, não deixa ffmpeg nem o yt-dlp rodando sem leitor
+            for process in (ffmpeg, feeder):
+                if process is not None and process.poll() is None:
+                    process.kill()
+                if process is not None:
+                    process.wait()
+            self._out.close()
+            with self._cond:
+                # Rename sob o lock: um ouvinte novo abre o .part antes ou o .mp3 depois, nunca nenhum dos dois
+                if ok:
+                    os.replace(self.part_path, self.cache_path)
+                else:
+                    try:
+                        os.remove(self.part_path)
+                    except OSError:
+                        pass
+                self.done = True
+                self.failed = not ok
+                self._cond.notify_all()
+            with LIVE_TRANSCODES_LOCK:
+                if LIVE_TRANSCODES.get(self.key) is self:
+                    del LIVE_TRANSCODES[self.key]
+            STORAGE.soltar(self.part_path)
+            METRICS.inc('ytapi_outputs_total', profile='mp3-128', mode='live', result='ok' if ok else 'error')
+        if ok:
+            log.info("Conversão ao vivo concluída: %s (%d bytes)", self.cache_path, self.size)
+            evict_stream_cache(keep=self.cache_path)
+
+    def aguardar_inicio(self, timeout=STREAM_LIVE_START_TIMEOUT):
+        """Espera o primeiro bloco convertido (no máximo `timeout`). False só se a conversão falhou"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.size > 0 or self.done, timeout)
+            return not self.failed
+
+    def _abrir(self):
+        with self._cond:
+            if self.failed:
+                return None
+            self.listeners += 1
+            return open(self.cache_path if self.done else self.part_path, 'rb')
+
+    def ouvir(self):
+        """Gerador com o MP3 desde o byte 0, acompanhando a conversão até o fim"""
+        f = self._abrir()
+        if f is None:
+            return
+        enviados = 0
+        METRICS.inc('ytapi_active_streams')
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self.size > enviados or self.done)
+                    disponivel, terminou, falhou = self.size, self.done, self.failed
+                if falhou or (terminou and enviados >= disponivel):
+                    break
+                data = f.read(min(disponivel - enviados, STREAM_LIVE_CHUNK_SIZE))
+                if not data:
+                    break
+                enviados += len(data)
+                yield data
+        finally:
+            f.close()
+            with self._cond:
+                self.listeners -= 1
+            METRICS.dec('ytapi_active_streams')
+            METRICS.inc('ytapi_stream_bytes_total', enviados, source='live_transcode')
+
+
+LIVE_TRANSCODES = {}  # { chave do cache de stream: LiveTranscode em andamento }
+LIVE_TRANSCODES_LOCK = threading.Lock()
+
+
+def live_stream_audio(video_id, url, chosen):
+    """Retorna ('file', caminho) se o MP3 já está no cache ou ('live', LiveTranscode) anexado à conversão da faixa"""
+    key = _stream_cache_key(video_id, chosen.get('format_id'))
+    cache_path = os.path.join(STREAM_CACHE_FOLDER, f'{key}.mp3')
+    with LIVE_TRANSCODES_LOCK:
+        live = LIVE_TRANSCODES.get(key)
+        if live is not None:
+            METRICS.inc('ytapi_cache_lookups_total', cache='stream_disk', result='live')
+            return 'live', live
+        if os.path.isfile(cache_path):
+            try:
+                os.utime(cache_path)  # marca acesso para o LRU
+            except OSError:
+                pass
+            METRICS.inc('ytapi_cache_lookups_total', cache='stream_disk', result='hit')
+            return 'file', cache_path
+        METRICS.inc('ytapi_cache_lookups_total', cache='stream_disk', result='miss')
+        log.info("Iniciando conversão ao vivo para streaming: %s", key)
+        live = LIVE_TRANSCODES[key] = LiveTranscode(key, url, chosen)
+        return 'live', live
+
+
+
+def _juntar_intervalo(ranges, start, end):
+    """Insere [start, end) na lista ordenada de intervalos disjuntos, unindo os que se tocam"""
+    merged = []
+    for a, b in ranges:
+        if b < start or a > end:
+            merged.append([a, b])
+        else:
+            start, end = min(a, start), max(b, end)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+
+class RangeCache:
+    """Arquivo de origem de uma faixa (video_id + format_id) montado a partir dos bytes que o /stream repassa.
+    Os trechos são gravados nas suas posições em um arquivo esparso; `ranges` guarda os intervalos
+    [início, fim) já presentes. Compartilhado pelas requisições abertas via abrir_range_cache.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.path = os.path.join(STREAM_CACHE_FOLDER, f'{key}.src')
+        self.partial_path = self.path + '.partial'
+        self.meta_path = os.path.join(STREAM_CACHE_FOLDER, f'{key}.src.json')
+        self.size = None
+        self.ranges = []
+        self.complete = os.path.isfile(self.path)
+        self.refs = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._novos = 0
+        if not self.complete:
+            try:
+                with open(self.meta_path) as f:
+                    meta = json.load(f)
+                if os.path.isfile(self.partial_path):
+                    self.size, self.ranges = meta['size'], meta['ranges']
+            except (OSError, ValueError, KeyError):
+                pass
+        else:
+            self.size = os.path.getsize(self.path)
+        STORAGE.fixar(self.partial_path)
+
+    def definir_tamanho(self, size):
+        """Tamanho total informado pelo upstream; se mudou, o parcial antigo é descartado"""
+        with self._lock:
+            if self.size == size or self.complete:
+                return
+            if self.size is not None:
+                log.warning("Cache tee: tamanho de %s mudou (%s -> %s), descartando", self.key, self.size, size)
+            self.size, self.ranges, self._novos = size, [], 0
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.partial_path, 'w+b')
+            self._file.truncate(size)
+
+    def segmentos(self, start, end):
+        """Divide [start, end] (inclusivo) em trechos (a, b, local) na ordem, local=True se já está no disco"""
+        with self._lock:
+            if self.complete:
+                return [(start, end, True)]
+            ranges = [list(r) for r in self.ranges]
+        result = []
+        pos = start
+        for a, b in ranges:
+            if b <= pos:
+                continue
+            if a > end:
+                break
+            if a > pos:
+                result.append((pos, a - 1, False))
+            result.append((max(a, pos), min(b - 1, end), True))
+            pos = b
+            if pos > end:
+                break
+        if pos <= end:
+            result.append((pos, end, False))
+        return result
+
+    def _arquivo(self):
+        if self._file is None:
+            self._file = open(self.path if self.complete else self.partial_path, 'rb' if self.complete else 'r+b')
+        return self._file
+
+    def gravar(self, offset, data):
+        with self._lock:
+            if self.complete or self.size is None or offset + len(data) > self.size:
+                return
+            f = self._arquivo()
+            f.seek(offset)
+            f.write(data)
+            self.ranges = _juntar_intervalo(self.ranges, offset, offset + len(data))
+            self._novos += len(data)
+            if self.ranges == [[0, self.size]]:
+                self._finalizar()
+            elif self._novos >= STREAM_TEE_SAVE_BYTES:
+                self._salvar()
+
+    def ler(self, start, end):
+        """Gera os bytes de [start, end] (inclusivo) já presentes no disco"""
+        pos = start
+        while pos <= end:
+            with self._lock:
+                f = self._arquivo()
+                f.seek(pos)
+                data = f.read(min(end - pos + 1, FILE_CHUNK_SIZE))
+            if not data:
+                raise IOError(f'cache tee de {self.key} terminou antes do esperado')
+            pos += len(data)
+            yield data
+
+    def _salvar(self):
+        self._novos = 0
+        if self._file is not None:
+            self._file.flush()
+        tmp = self.meta_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'size': self.size, 'ranges': self.ranges}, f)
+        os.replace(tmp, self.meta_path)
+
+    def _finalizar(self):
+        self._file.flush()
+        os.replace(self.partial_path, self.path)  # o descritor aberto continua válido após o rename
+        self.complete = True
+        try:
+            os.remove(self.meta_path)
+        except OSError:
+            pass
+        log.info("Cache tee completo: %s (%d bytes)", self.path, self.size)
+
+    def fechar(self):
+        with self._lock:
+            if not self.complete and self.size is not None and self._novos:
+                self._salvar()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        STORAGE.soltar(self.partial_path)
+
+
+RANGE_CACHES = {}  # { chave do cache de stream: RangeCache com requisições abertas }
+RANGE_CACHES_LOCK = threading.Lock()
+
+
+def abrir_range_cache(key):
+    with RANGE_CACHES_LOCK:
+        rc = RANGE_CACHES.get(key)
+        if rc is None:
+            rc = RANGE_CACHES[key] = RangeCache(key)
+        rc.refs += 1
+        return rc
+
+
+STREAM_CACHE_SUJO = threading.Event()  # o cache tee recebeu bytes desde a última varredura
+
+
+def fechar_range_cache(rc):
+    with RANGE_CACHES_LOCK:
+        rc.refs -= 1
+        if rc.refs > 0:
+            return
+        del RANGE_CACHES[rc.key]
+        # Fecha (e salva os intervalos) antes de soltar o lock: quem abrir a mesma chave em seguida
+        # lê o .json atualizado em vez de truncar o parcial que este ainda está gravando
+        rc.fechar()
+    STREAM_CACHE_SUJO.set()
+
+
+def _stream_cache_janitor():
+    """Aplica STREAM_CACHE_MAX_BYTES ao cache tee fora das requisições, no máximo uma vez por intervalo"""
+    while True:
+        STREAM_CACHE_SUJO.wait()
+        time.sleep(STREAM_CACHE_EVICT_INTERVAL)
+        STREAM_CACHE_SUJO.clear()
+        try:
+            evict_stream_cache()
+        except Exception as e:
+            log.exception("Erro ao limpar o cache de stream: %s", e)
+
+
+threading.Thread(target=_stream_cache_janitor, name='stream-cache-janitor', daemon=True).start()
+
+
+def fonte_em_cache(video_id, format_id):
+    """Caminho do arquivo de origem completo montado pelo cache tee, ou None"""
+    if not video_id or not format_id:
+        return None
+    path = os.path.join(STREAM_CACHE_FOLDER, f'{_stream_cache_key(video_id, format_id)}.src')
+    return path if os.path.isfile(path) else None
+
+
+def _tamanho_upstream(upstream):
+    """(offset, total) da resposta do upstream a partir de Content-Range/Content-Length"""
+    content_range = upstream.getheader('Content-Range')
+    if content_range:
+        match = re.match(r'bytes (\d+)-\d+/(\d+)', content_range)
+        return (int(match.group(1)), int(match.group(2))) if match else (None, None)
+    length = upstream.getheader('Content-Length')
+    if upstream.getcode() == 200 and length and length.isdigit():
+        return 0, int(length)
+    return None, None
+
+
+def _repassar_com_tee(upstream, rc, offset):
+    """Repassa o corpo do upstream gravando cada bloco no cache tee a partir de `offset`"""
+    try:
+        while True:
+            chunk = upstream.read(8192)
+            if not chunk:
+                break
+            if rc is not None:
+                rc.gravar(offset, chunk)
+            offset += len(chunk)
+            yield chunk
+    finally:
+        try:
+            upstream.close()
+        except Exception:
+            pass
+
+
+# Pool de conexões keep-alive para o upstream do /stream (um pool por host)
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 16))  # conexões ociosas por host
+UPSTREAM_IDLE_TIMEOUT = int(os.environ.get('UPSTREAM_IDLE_TIMEOUT', 60))  # seconds
+UPSTREAM_TIMEOUT = int(os.environ.get('UPSTREAM_TIMEOUT', 15))
+UPSTREAM_DRAIN_LIMIT = 64 * 1024  # drena restos pequenos para reaproveitar a conexão
+UPSTREAM_MAX_REDIRECTS = 5
+
+
+class UpstreamConnectionPool:
+    """Conexões HTTP(S) persistentes agrupadas por (scheme, host, port)"""
+
+    def __init__(self, max_idle=UPSTREAM_POOL_SIZE, idle_timeout=UPSTREAM_IDLE_TIMEOUT, timeout=UPSTREAM_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}  # { (scheme, host, port): [(last_used, conn), ...] }
+        self._lock = threading.Lock()
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return http_client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http_client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def acquire(self, key):
+        """Retorna (conn, reused)"""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                last_used, conn = idle.pop()
+                if now - last_used < self.idle_timeout and conn.sock is not None:
+                    return conn, True
+                conn.close()
+        return self._new_connection(key), False
+
+    def release(self, key, conn):
+        if conn.sock is None:
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) >= self.max_idle:
+                conn.close()
+                return
+            idle.append((time.time(), conn))
+
+    def prune(self):
+        """Fecha conexões ociosas há mais de idle_timeout"""
+        now = time.time()
+        with self._lock:
+            for key, idle in list(self._idle.items()):
+                alive = []
+                for last_used, conn in idle:
+                    if now - last_used < self.idle_timeout:
+                        alive.append((last_used, conn))
+                    else:
+                        conn.close()
+                if alive:
+                    self._idle[key] = alive
+                else:
+                    del self._idle[key]
+
+    def stats(self):
+        with self._lock:
+            return {f'{k[0]}://{k[1]}:{k[2]}': len(v) for k, v in self._idle.items()}
+
+    def request(self, url, headers=None):
+        """GET seguindo redirects; retorna UpstreamResponse. Lança urllib_error.HTTPError para status >= 400"""
+        with METRICS.cronometro('upstream_open'):
+            return self._request(url, headers)
+
+    def _request(self, url, headers=None):
+        headers = dict(headers or {})
+        headers.setdefault('Connection', 'keep-alive')
+        headers.setdefault('User-Agent', 'Mozilla/5.0')
+        for _ in range(UPSTREAM_MAX_REDIRECTS + 1):
+            parsed = urllib_parse.urlsplit(url)
+            scheme = parsed.scheme.lower()
+            port = parsed.port or (443 if scheme == 'https' else 80)
+            key = (scheme, parsed.hostname, port)
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+
+            conn, reused = self.acquire(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            except (http_client.RemoteDisconnected, ConnectionError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                # Conexão ociosa foi fechada pelo servidor: tenta de novo com uma nova
+                conn = self._new_connection(key)
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+
+            upstream = UpstreamResponse(self, key, conn, resp)
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location'):
+                url = urllib_parse.urljoin(url, resp.getheader('Location'))
+                upstream.close()
+                continue
+            if resp.status >= 400:
+                upstream.close()
+                raise urllib_error.HTTPError(url, resp.status, resp.reason, resp.msg, None)
+            return upstream
+        raise urllib_error.URLError('Redirecionamentos demais no upstream')
+
+
+class UpstreamResponse:
+    """Resposta do upstream; close() devolve a conexão ao pool quando possível"""
+
+    def __init__(self, pool, key, conn, resp):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._closed = False
+
+    def getheader(self, name, default=None):
+        return self._resp.getheader(name, default)
+
+    def getcode(self):
+        return self._resp.status
+
+    def read(self, amt=None):
+        return self._resp.read(amt)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        resp, conn = self._resp, self._conn
+        try:
+            # Cliente desconectou no meio: drena o resto se for pequeno, senão descarta a conexão
+            if not resp.isclosed() and resp.length is not None and resp.length <= UPSTREAM_DRAIN_LIMIT:
+                resp.read()
+            if resp.isclosed() and not resp.will_close:
+                self._pool.release(self._key, conn)
+                return
+        except Exception:
+            pass
+        resp.close()
+        conn.close()
+
+
+UPSTREAM_POOL = UpstreamConnectionPool()
+
+
+def _upstream_pool_janitor():
+    while True:
+        time.sleep(max(UPSTREAM_IDLE_TIMEOUT / 2, 1))
+        UPSTREAM_POOL.prune()
+
+
+threading.Thread(target=_upstream_pool_janitor, daemon=True).start()
+
+
+# Saídas reaproveitáveis do /baixar, identificadas por (video_id, profile)
+# Nome do arquivo: <titulo>__<video_id>__<profile>.<ext do perfil>
+DEFAULT_PROFILE = 'mp3-128'
+# Perfis de saída: formato final e os codecs de origem que podem ser copiados (-c:a copy) sem reencode
+OUTPUT_PROFILES = {
+    'mp3-128': {'ext': 'mp3', 'muxer': 'mp3', 'codec': 'libmp3lame', 'bitrate': '128k',
+                'encode_args': ['-ar', '44100', '-ac', '2'], 'mux_args': [], 'copy': ('mp3',), 'max_copy_abr': 160},
+    'mp3-320': {'ext': 'mp3', 'muxer': 'mp3', 'codec': 'libmp3lame', 'bitrate': '320k',
+                'encode_args': ['-ar', '44100', '-ac', '2'], 'mux_args': [], 'copy': ('mp3',)},
+    'm4a': {'ext': 'm4a', 'muxer': 'ipod', 'codec': 'aac', 'bitrate': '192k',
+            'encode_args': [], 'mux_args': ['-movflags', '+faststart'], 'copy': ('mp4a', 'aac')},
+    'opus': {'ext': 'opus', 'muxer': 'opus', 'codec': 'libopus', 'bitrate': '160k',
+             'encode_args': [], 'mux_args': [], 'copy': ('opus',)},
+}
+PROFILE_ALIASES = {'mp3': 'mp3-128', 'aac': 'm4a'}
+OUTPUT_EXTS = ('.mp3', '.m4a', '.opus', '.zip')  # arquivos finais em DOWNLOAD_FOLDER (índice e limpeza de disco)
+VIDEO_ID_RE = re.compile(r'(?:v=|youtu\.be/|shorts/|embed/|live/)([A-Za-z0-9_-]{11})')
+OUTPUT_NAME_RE = re.compile(r'__(?P<video_id>[A-Za-z0-9_-]{11})__(?P<profile>[a-z0-9-]+)\.\w+$')
+OUTPUT_INDEX = {}  # { (video_id, profile): filename }
+INFLIGHT = {}  # { (video_id, profile): _Flight }
+INFLIGHT_LOCK = threading.Lock()
+
+
+def extrair_video_id(link):
+    match = VIDEO_ID_RE.search(link or '')
+    if match:
+        return match.group(1)
+    if link and re.fullmatch(r'[A-Za-z0-9_-]{11}', link):
+        return link
+    return None
+
+
+def nome_saida(safe_title, video_id, profile):
+    return f"{safe_title}__{video_id}__{profile}.{OUTPUT_PROFILES[profile]['ext']}"
+
+
+def resolver_perfil(name):
+    """Perfil pedido pelo cliente -> chave de OUTPUT_PROFILES (ValueError se desconhecido)"""
+    name = (name or DEFAULT_PROFILE).strip().lower()
+    name = PROFILE_ALIASES.get(name, name)
+    if name not in OUTPUT_PROFILES:
+        raise ValueError(f"Perfil desconhecido: {name} (opções: {', '.join(OUTPUT_PROFILES)})")
+    return name
+
+
+def nome_exibicao(filename):
+    """Nome do arquivo sem o sufixo __<video_id>__<profile>"""
+    match = OUTPUT_NAME_RE.search(filename)
+    if match:
+        return filename[:match.start()] + os.path.splitext(filename)[1]
+    return filename
+
+
+def saida_pronta(key):
+    """Caminho do arquivo já convertido para (video_id, profile), ou None"""
+    filename = OUTPUT_INDEX.get(key)
+    if filename:
+        path = os.path.join(DOWNLOAD_FOLDER, filename)
+        if os.path.isfile(path):
+            return path
+        OUTPUT_INDEX.pop(key, None)
+    # Fora do índice deste processo: outro worker pode ter gerado a saída depois que ele foi montado
+    filename = biblioteca_saida(*key)
+    if filename:
+        path = os.path.join(DOWNLOAD_FOLDER, filename)
+        if os.path.isfile(path):
+            OUTPUT_INDEX[key] = filename
+            return path
+    return None
+
+
+def indexar_saidas():
+    for name in os.listdir(DOWNLOAD_FOLDER):
+        match = OUTPUT_NAME_RE.search(name)
+        if match:
+            OUTPUT_INDEX[(match.group('video_id'), match.group('profile'))] = name
+
+
+indexar_saidas()
+
+
+# Índice persistente (SQLite) dos arquivos em DOWNLOAD_FOLDER usado pelo /offline
+# Fica fora de DOWNLOAD_FOLDER para o banco (e os -wal/-shm) nunca ser servido pelo /download
+LIBRARY_DB = os.environ.get('LIBRARY_DB', 'library.sqlite3')
+_LIBRARY_DB_ANTIGO = os.path.join(DOWNLOAD_FOLDER, 'library.sqlite3')
+if 'LIBRARY_DB' not in os.environ and os.path.exists(_LIBRARY_DB_ANTIGO) and not os.path.exists(LIBRARY_DB):
+    # Migra o banco do local antigo (dentro de DOWNLOAD_FOLDER) com os arquivos auxiliares do SQLite
+    for sufixo in ('', '-wal', '-shm'):
+        if os.path.exists(_LIBRARY_DB_ANTIGO + sufixo):
+            os.replace(_LIBRARY_DB_ANTIGO + sufixo, LIBRARY_DB + sufixo)
+LIBRARY_SORT_KEYS = ('created_at', 'last_access', 'title', 'size', 'duration', 'filename')
+LIBRARY_LOCK = threading.Lock()
+LIBRARY_CONN = sqlite3.connect(LIBRARY_DB, check_same_thread=False)
+LIBRARY_CONN.row_factory = sqlite3.Row
+with LIBRARY_LOCK, LIBRARY_CONN:
+    LIBRARY_CONN.execute("""
+        CREATE TABLE IF NOT EXISTS arquivos (
+            filename TEXT PRIMARY KEY,
+            video_id TEXT,
+            profile TEXT,
+            title TEXT,
+            duration REAL,
+            size INTEGER,
+            bitrate INTEGER,
+            created_at REAL,
+            last_access REAL
+        )
+    """)
+    LIBRARY_CONN.execute("CREATE INDEX IF NOT EXISTS idx_arquivos_created ON arquivos (created_at)")
+    LIBRARY_CONN.execute("CREATE INDEX IF NOT EXISTS idx_arquivos_access ON arquivos (last_access)")
+    LIBRARY_CONN.execute("CREATE INDEX IF NOT EXISTS idx_arquivos_video ON arquivos (video_id, profile)")
+
+
+def _bitrate_do_profile(profile):
+    if profile in OUTPUT_PROFILES:
+        return int(OUTPUT_PROFILES[profile]['bitrate'].rstrip('k'))
+    match = re.search(r'(\d+)$', profile or '')
+    return int(match.group(1)) if match else None
+
+
+def biblioteca_registrar(path, video_id=None, profile=None, title=None, duration=None, last_access=None):
+    """Insere/atualiza o arquivo no índice (chamado pelo pipeline quando grava uma saída)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    filename = os.path.basename(path)
+    now = last_access or time.time()
+    with LIBRARY_LOCK, LIBRARY_CONN:
+        LIBRARY_CONN.execute("""
+            INSERT INTO arquivos (filename, video_id, profile, title, duration, size, bitrate, created_at, last_access)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(filename) DO UPDATE SET
+                video_id = COALESCE(excluded.video_id, video_id),
+                profile = COALESCE(excluded.profile, profile),
+                title = COALESCE(excluded.title, title),
+                duration = COALESCE(excluded.duration, duration),
+                size = excluded.size,
+                bitrate = COALESCE(excluded.bitrate, bitrate),
+                last_access = excluded.last_access
+        """, (filename, video_id, profile, title, duration, st.st_size, _bitrate_do_profile(profile), st.st_mtime, now))
+
+
+def biblioteca_acesso(filename):
+    with LIBRARY_LOCK, LIBRARY_CONN:
+        LIBRARY_CONN.execute("UPDATE arquivos SET last_access = ? WHERE filename = ?", (time.time(), filename))
+
+
+def biblioteca_remover(filename):
+    with LIBRARY_LOCK, LIBRARY_CONN:
+        LIBRARY_CONN.execute("DELETE FROM arquivos WHERE filename = ?", (filename,))
+
+
+def biblioteca_reconciliar():
+    """Sincroniza o índice com a pasta: adiciona arquivos novos e remove os que sumiram"""
+    presentes = {}
+    for name in os.listdir(DOWNLOAD_FOLDER):
+        if name.lower().endswith(OUTPUT_EXTS):
+            path = os.path.join(DOWNLOAD_FOLDER, name)
+            if os.path.isfile(path):
+                presentes[name] = path
+    with LIBRARY_LOCK:
+        indexados = {row['filename'] for row in LIBRARY_CONN.execute("SELECT filename FROM arquivos")}
+    for name in indexados - set(presentes):
+        biblioteca_remover(name)
+    for name in set(presentes) - indexados:
+        match = OUTPUT_NAME_RE.search(name)
+        if match:
+            biblioteca_registrar(presentes[name], match.group('video_id'), match.group('profile'),
+                                 os.path.splitext(nome_exibicao(name))[0], last_access=os.path.getmtime(presentes[name]))
+        else:
+            biblioteca_registrar(presentes[name], title=os.path.splitext(name)[0],
+                                 last_access=os.path.getmtime(presentes[name]))
+    log.info("Índice da biblioteca: %s arquivos", len(presentes))
+
+
+def biblioteca_saida(video_id, profile):
+    """Nome do arquivo mais recente indexado para (video_id, profile), inclusive os gravados por outros workers"""
+    with LIBRARY_LOCK:
+        row = LIBRARY_CONN.execute(
+            "SELECT filename FROM arquivos WHERE video_id = ? AND profile = ? ORDER BY created_at DESC LIMIT 1",
+            (video_id, profile),
+        ).fetchone()
+    return row['filename'] if row else None
+
+
+def biblioteca_listar(offset=0, limit=None, sort='created_at', order='desc', q=None, ext=None, video_id=None):
+    """Retorna (total, arquivos) do índice com filtro, ordenação e paginação"""
+    where = []
+    params = []
+    if q:
+        where.append("(title LIKE ? OR filename LIKE ?)")
+        params += [f'%{q}%', f'%{q}%']
+    if ext:
+        where.append("filename LIKE ?")
+        params.append(f'%.{ext.lstrip(".")}')
+    if video_id:
+        where.append("video_id = ?")
+        params.append(video_id)
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+    order_sql = f"ORDER BY {sort} {'ASC' if order == 'asc' else 'DESC'}, filename"
+    with LIBRARY_LOCK:
+        total = LIBRARY_CONN.execute(f"SELECT COUNT(*) FROM arquivos {where_sql}", params).fetchone()[0]
+        rows = LIBRARY_CONN.execute(
+            f"SELECT * FROM arquivos {where_sql} {order_sql} LIMIT ? OFFSET ?",
+            params + [limit if limit is not None else -1, offset],
+        ).fetchall()
+    files = []
+    for row in rows:
+        item = dict(row)
+        item['path'] = os.path.join(DOWNLOAD_FOLDER, row['filename'])
+        files.append(item)
+    return total, files
+
+
+biblioteca_reconciliar()
+
+
+# Cota de disco de DOWNLOAD_FOLDER: acima da marca alta remove os arquivos menos acessados até a marca baixa,
+# nunca tocando nos que estão em uso (jobs rodando, downloads/streams ativos); também varre temp_*/.part esquecidos
+STORAGE_MAX_BYTES = int(os.environ.get('STORAGE_MAX_BYTES', 10 * 1024 ** 3))
+STORAGE_HIGH_WATERMARK = float(os.environ.get('STORAGE_HIGH_WATERMARK', 0.9))
+STORAGE_LOW_WATERMARK = float(os.environ.get('STORAGE_LOW_WATERMARK', 0.75))
+STORAGE_CHECK_INTERVAL = int(os.environ.get('STORAGE_CHECK_INTERVAL', 60))  # seconds
+STORAGE_STALE_TEMP_AGE = int(os.environ.get('STORAGE_STALE_TEMP_AGE', 3600))  # seconds sem escrita
+
+
+class StorageManager:
+    def __init__(self, folder, max_bytes=STORAGE_MAX_BYTES, high=STORAGE_HIGH_WATERMARK, low=STORAGE_LOW_WATERMARK):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.high = high
+        self.low = low
+        self._pins = {}  # { caminho absoluto: contagem }
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._last = {'used_bytes': 0, 'files': 0, 'evicted_files': 0, 'evicted_bytes': 0, 'swept_files': 0}
+
+    def fixar(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            self._pins[path] = self._pins.get(path, 0) + 1
+
+    def soltar(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            count = self._pins.get(path, 0) - 1
+            if count > 0:
+                self._pins[path] = count
+            else:
+                self._pins.pop(path, None)
+
+    @contextlib.contextmanager
+    def em_uso(self, path):
+        self.fixar(path)
+        try:
+            yield
+        finally:
+            self.soltar(path)
+
+    def fixado(self, path):
+        with self._lock:
+            return os.path.abspath(path) in self._pins
+
+    def acordar(self):
+        self._wake.set()
+
+    def _protegidos(self):
+        """Arquivos que não podem ser removidos agora"""
+        with self._lock:
+            protegidos = set(self._pins)
+        # Saídas de playlists ainda em andamento ou entregues via /zip em streaming
+        for task_id, state in list(PLAYLIST_STATE.items()):
+            if state.get('zip_stream') or not _tarefa_terminada(task_id, state):
+                protegidos.update(os.path.abspath(a) for a in list(state['arquivos']) if a)
+        return protegidos
+
+    @staticmethod
+    def _temporario(name):
+        return name.startswith('temp_') or name.endswith('.part') or '.part.' in name
+
+    def _varrer(self):
+        """Lista (atime, size, path) dos candidatos a remoção e remove temporários abandonados"""
+        candidatos = []
+        usado = 0
+        arquivos = 0
+        varridos = 0
+        now = time.time()
+        acessos = {}
+        with LIBRARY_LOCK:
+            for row in LIBRARY_CONN.execute("SELECT filename, last_access FROM arquivos"):
+                acessos[row['filename']] = row['last_access']
+        protegidos = self._protegidos()
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                path = os.path.abspath(os.path.join(root, name))
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if self._temporario(name):
+                    if now - st.st_mtime > STORAGE_STALE_TEMP_AGE and path not in protegidos:
+                        try:
+                            os.remove(path)
+                            varridos += 1
+                            log.info("Limpeza de disco: temporário abandonado removido %s", path)
+                            continue
+                        except OSError:
+                            pass
+                usado += st.st_size
+                arquivos += 1
+                if path in protegidos or not name.endswith(OUTPUT_EXTS):
+                    continue
+                candidatos.append((acessos.get(name) or st.st_mtime, st.st_size, path))
+        candidatos.sort()
+        return usado, arquivos, varridos, candidatos
+
+    def verificar(self):
+        usado, arquivos, varridos, candidatos = self._varrer()
+        removidos = 0
+        bytes_removidos = 0
+        if usado > self.max_bytes * self.high:
+            alvo = self.max_bytes * self.low
+            for _, size, path in candidatos:
+                if usado <= alvo:
+                    break
+                if path in self._protegidos():
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                usado -= size
+                removidos += 1
+                bytes_removidos += size
+                if os.path.dirname(path) == os.path.abspath(self.folder):
+                    biblioteca_remover(os.path.basename(path))
+                log.info("Limpeza de disco: removido %s (%s bytes)", path, size)
+        with self._lock:
+            self._last['used_bytes'] = usado
+            self._last['files'] = arquivos - removidos
+            self._last['evicted_files'] += removidos
+            self._last['evicted_bytes'] += bytes_removidos
+            self._last['swept_files'] += varridos
+
+    def uso(self):
+        with self._lock:
+            return dict(self._last, budget_bytes=self.max_bytes, high_watermark=self.high,
+                        low_watermark=self.low, pinned=len(self._pins))
+
+    def run(self):
+        while True:
+            try:
+                self.verificar()
+            except Exception as e:
+                log.exception("Erro na limpeza de disco: %s", e)
+            self._wake.wait(STORAGE_CHECK_INTERVAL)
+            self._wake.clear()
+
+
+STORAGE = StorageManager(DOWNLOAD_FOLDER)
+
+
+# Camada única de envio de arquivos (/download e fallback do /stream): Range (RFC 7233), ETag/Last-Modified,
+# 304 condicional e envio fora do interpretador (X-Accel-Redirect/X-Sendfile atrás de proxy, ou sendfile do servidor WSGI)
+FILE_ACCEL = os.environ.get('FILE_ACCEL', '').lower()  # '', 'nginx' (X-Accel-Redirect) ou 'sendfile' (X-Sendfile)
+FILE_ACCEL_PREFIX = os.environ.get('FILE_ACCEL_PREFIX', '/_downloads/')  # location internal do nginx para DOWNLOAD_FOLDER
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(range_header, size):
+    """Interpreta um header Range (RFC 7233) para um recurso de `size` bytes.
+    Retorna None (ignorar: servir tudo), (start, end) inclusivo, ou 'unsatisfiable' (416).
+    Múltiplos intervalos são ignorados (permitido pela RFC) e o arquivo inteiro é servido.
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    specs = [part.strip() for part in spec.split(',') if part.strip()]
+    if len(specs) != 1:
+        return None
+    first, sep, last = specs[0].partition('-')
+    first, last = first.strip(), last.strip()
+    if not sep or not (first.isdigit() or last.isdigit()) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # Sufixo: bytes=-N são os últimos N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            return 'unsatisfiable'
+        return max(size - length, 0), size - 1
+    start = int(first)
+    if start >= size:
+        return 'unsatisfiable'
+    end = int(last) if last else size - 1
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def _etag_de(st):
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _nao_modificado(etag, mtime):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        return '*' in tags or etag in tags or f'W/{etag}' in tags
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since:
+        try:
+            return int(mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _ler_intervalo(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(FILE_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def servir_arquivo(path, mimetype, download_name=None):
+    """Resposta para o arquivo em `path` com Range, ETag, Last-Modified e 304/416.
+    O arquivo fica protegido da limpeza de disco até a resposta terminar.
+    """
+    st = os.stat(path)
+    size = st.st_size
+    etag = _etag_de(st)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': email.utils.formatdate(st.st_mtime, usegmt=True),
+        'Accept-Ranges': 'bytes',
+    }
+    if download_name:
+        headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{urllib_parse.quote(download_name)}"
+
+    if _nao_modificado(etag, st.st_mtime):
+        return Response(status=304, headers=headers)
+
+    if FILE_ACCEL == 'nginx':
+        # nginx envia o arquivo (e trata Range) a partir da location internal
+        rel = os.path.relpath(os.path.abspath(path), os.path.abspath(DOWNLOAD_FOLDER)).replace(os.sep, '/')
+        headers['X-Accel-Redirect'] = FILE_ACCEL_PREFIX.rstrip('/') + '/' + urllib_parse.quote(rel)
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    if FILE_ACCEL == 'sendfile':
+        headers['X-Sendfile'] = os.path.abspath(path)
+        return Response(status=200, headers=headers, mimetype=mimetype)
+
+    # If-Range com validador diferente: ignora o Range e manda o arquivo inteiro
+    if_range = request.headers.get('If-Range')
+    byte_range = None
+    if not if_range or if_range.strip() in (etag, headers['Last-Modified']):
+        byte_range = parse_range(request.headers.get('Range'), size)
+    if byte_range == 'unsatisfiable':
+        headers['Content-Range'] = f'bytes */{size}'
+        return Response(status=416, headers=headers)
+
+    status = 200
+    start, end = 0, size - 1
+    if byte_range:
+        start, end = byte_range
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    length = end - start + 1 if size else 0
+    headers['Content-Length'] = str(length)
+
+    STORAGE.fixar(path)
+    try:
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and end == size - 1:
+            # Até o fim do arquivo: o servidor WSGI (ex.: gunicorn) envia com os.sendfile a partir do offset atual
+            f = open(path, 'rb')
+            f.seek(start)
+            body = file_wrapper(f, FILE_CHUNK_SIZE)
+        else:
+            body = _ler_intervalo(path, start, length)
+        response = Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+    except Exception:
+        STORAGE.soltar(path)
+        raise
+    response.call_on_close(lambda: STORAGE.soltar(path))
+    return response
+
+
+# Pipeline de download -> conversão em uma única passada:
+# os bytes baixados vão direto para o stdin do ffmpeg (sem arquivo temp_* e sem ffmpeg extra só para a duração)
+PIPELINE_CHUNK_SIZE = 64 * 1024
+FFMPEG_TIME_RE = re.compile(r'time=(\d+):(\d+):(\d+\.\d+)')
+
+
+def parse_ffmpeg_time(line):
+    time_match = FFMPEG_TIME_RE.search(line)
+    if time_match:
+        h, m, s = time_match.groups()
+        return int(h) * 3600 + int(m) * 60 + float(s)
+    return None
+
+
+def safe_filename(title):
+    return re.sub(r'[^\w\-_\. ]', '_', title)[:60]
+
+
+def iter_http_audio(info, on_bytes=None, start=0):
+    """Gera os bytes do formato escolhido por HTTP (a partir do byte `start`), em blocos de Range quando
+    o yt-dlp indica (http_chunk_size evita o throttling do YouTube em conexões longas)"""
+    url = info['url']
+    headers = dict(info.get('http_headers') or {})
+    chunk_size = (info.get('downloader_options') or {}).get('http_chunk_size')
+    total = info.get('filesize') or info.get('filesize_approx')
+    downloaded = start
+    while True:
+        req_headers = dict(headers)
+        if chunk_size:
+            req_headers['Range'] = f'bytes={downloaded}-{downloaded + chunk_size - 1}'
+        upstream = UPSTREAM_POOL.request(url, headers=req_headers)
+        try:
+            content_range = upstream.getheader('Content-Range')
+            if content_range and '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+                total = int(content_range.rsplit('/', 1)[1])
+            elif not chunk_size and upstream.getheader('Content-Length'):
+                total = int(upstream.getheader('Content-Length'))
+            received = 0
+            while True:
+                data = upstream.read(PIPELINE_CHUNK_SIZE)
+                if not data:
+                    break
+                received += len(data)
+                downloaded += len(data)
+                if on_bytes:
+                    on_bytes(downloaded, total)
+                yield data
+        finally:
+            upstream.close()
+        if not chunk_size or received < chunk_size or (total and downloaded >= total):
+            break
+
+
+# Download paralelo: arquivos grandes são buscados em vários Ranges ao mesmo tempo (o upstream limita a
+# velocidade por conexão) e remontados em ordem direto no stdin do ffmpeg, sem arquivo intermediário
+DOWNLOAD_PARALLEL_PARTS = int(os.environ.get('DOWNLOAD_PARALLEL_PARTS', 4))  # Ranges simultâneos por arquivo (1 = sequencial)
+DOWNLOAD_SEGMENT_SIZE = int(os.environ.get('DOWNLOAD_SEGMENT_SIZE', 4 * 1024 ** 2))
+DOWNLOAD_PARALLEL_MIN_BYTES = int(os.environ.get('DOWNLOAD_PARALLEL_MIN_BYTES', 16 * 1024 ** 2))
+DOWNLOAD_PARALLEL_MIN_SECONDS = int(os.environ.get('DOWNLOAD_PARALLEL_MIN_SECONDS', 600))  # HLS/DASH: fragmentos em paralelo
+DOWNLOAD_SEGMENT_RETRIES = int(os.environ.get('DOWNLOAD_SEGMENT_RETRIES', 2))
+SEGMENT_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('DOWNLOAD_SEGMENT_WORKERS', 32)), thread_name_prefix='segment')
+
+
+def _baixar_segmento(url, headers, start, end, progresso, parar):
+    """Busca bytes start..end (inclusivo) com novas tentativas; None se a transferência foi interrompida"""
+    for tentativa in range(DOWNLOAD_SEGMENT_RETRIES + 1):
+        partes = []
+        recebidos = 0
+        try:
+            upstream = UPSTREAM_POOL.request(url, headers=dict(headers, Range=f'bytes={start}-{end}'))
+            try:
+                if upstream.getcode() != 206:
+                    raise IOError(f'upstream ignorou o Range (HTTP {upstream.getcode()})')
+                while True:
+                    if parar():
+                        return None
+                    data = upstream.read(PIPELINE_CHUNK_SIZE)
+                    if not data:
+                        break
+                    partes.append(data)
+                    recebidos += len(data)
+                    progresso(len(data))
+            finally:
+                upstream.close()
+            if recebidos != end - start + 1:
+                raise IOError(f'segmento {start}-{end} incompleto ({recebidos} bytes)')
+            return b''.join(partes)
+        except Exception as e:
+            progresso(-recebidos)  # o progresso não conta bytes de uma tentativa descartada
+            if tentativa == DOWNLOAD_SEGMENT_RETRIES or parar():
+                raise
+            log.debug("Repetindo segmento %s-%s: %s", start, end, e)
+
+
+def iter_http_audio_paralelo(info, on_bytes=None, cancel_event=None, parts=None):
+    """Como iter_http_audio, mas com até `parts` Ranges em andamento ao mesmo tempo.
+    Os segmentos são entregues em ordem; no máximo `parts` ficam em memória.
+    Arquivos pequenos, tamanho desconhecido ou origem sem suporte a Range: cai no modo sequencial.
+    """
+    parts = DOWNLOAD_PARALLEL_PARTS if parts is None else parts
+    url = info['url']
+    headers = dict(info.get('http_headers') or {})
+    known = info.get('filesize') or info.get('filesize_approx')
+    if parts <= 1 or (known and known < DOWNLOAD_PARALLEL_MIN_BYTES):
+        yield from iter_http_audio(info, on_bytes)
+        return
+    seg = DOWNLOAD_SEGMENT_SIZE
+    chunk_size = (info.get('downloader_options') or {}).get('http_chunk_size')
+    if chunk_size:
+        seg = min(seg, chunk_size)
+
+    lock = threading.Lock()
+    estado = {'baixados': 0, 'total': known}
+    interrompido = threading.Event()
+
+    def parar():
+        return interrompido.is_set() or (cancel_event is not None and cancel_event.is_set())
+
+    def progresso(n):
+        with lock:
+            estado['baixados'] += n
+            if on_bytes and n > 0:
+                on_bytes(estado['baixados'], estado['total'])
+
+    # O primeiro segmento também descobre o tamanho real (Content-Range) e se a origem aceita Range
+    primeiro = UPSTREAM_POOL.request(url, headers=dict(headers, Range=f'bytes=0-{seg - 1}'))
+    pendentes = deque()
+    try:
+        content_range = primeiro.getheader('Content-Range') or ''
+        total = content_range.rsplit('/', 1)[1] if '/' in content_range else ''
+        paralelo = primeiro.getcode() == 206 and total.isdigit()
+        if paralelo:
+            estado['total'] = total = int(total)
+            paralelo = total >= DOWNLOAD_PARALLEL_MIN_BYTES
+        proximo = seg
+
+        def agendar():
+            nonlocal proximo
+            while paralelo and len(pendentes) < parts - 1 and proximo < total:
+                fim = min(proximo + seg, total) - 1
+                pendentes.append(SEGMENT_POOL.submit(_baixar_segmento, url, headers, proximo, fim, progresso, parar))
+                proximo = fim + 1
+
+        agendar()
+        while True:
+            data = primeiro.read(PIPELINE_CHUNK_SIZE)
+            if not data:
+                break
+            progresso(len(data))
+            yield data
+        if not paralelo:
+            baixados = estado['baixados']
+            if primeiro.getcode() == 206 and baixados == seg and not (isinstance(total, int) and baixados >= total):
+                # Origem com Range mas arquivo pequeno: continua sequencial a partir do fim do primeiro bloco
+                yield from iter_http_audio(dict(info, downloader_options={'http_chunk_size': seg}), on_bytes, start=baixados)
+            return
+        while pendentes:
+            data = pendentes.popleft().result()
+            if data is None:
+                raise JobCancelled(url)
+            agendar()
+            yield data
+    finally:
+        interrompido.set()
+        for future in pendentes:
+            future.cancel()
+        primeiro.close()
+
+
+def _baixar_para_arquivo(video_url, info, temp_id, on_progress, cancel_event=None):
+    """Fallback para protocolos fragmentados (DASH): baixa com o yt-dlp para um arquivo temporário"""
+    def progress_hook(d):
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled(video_url)
+        if d['status'] == 'downloading':
+            percent = d.get('downloaded_bytes', 0) / max(d.get('total_bytes') or d.get('total_bytes_estimate') or 1, 1)
+            on_progress(int(percent * 80))
+        elif d['status'] == 'finished':
+            on_progress(80)
+    ydl_opts = {
+        'format': info.get('format_id') or 'bestaudio/best',
+        'outtmpl': os.path.join(DOWNLOAD_FOLDER, f'temp_{temp_id}.%(ext)s'),
+        'quiet': True,
+        'ffmpeg_location': FFMPEG_PATH,
+        'noplaylist': True,
+        'progress_hooks': [progress_hook],
+        'concurrent_fragment_downloads': max(DOWNLOAD_PARALLEL_PARTS, 1),  # fragmentos DASH/HLS em paralelo
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl, METRICS.cronometro('download'):
+        ydl.download([video_url])
+    temp_files = [f for f in os.listdir(DOWNLOAD_FOLDER) if f.startswith(f'temp_{temp_id}')]
+    if not temp_files:
+        log.warning("Arquivo temporário não encontrado para: %s", temp_id)
+        return None
+    return os.path.join(DOWNLOAD_FOLDER, temp_files[0])
+
+
+# Estágio de conversão separado do download: no máximo TRANSCODE_WORKERS ffmpeg rodando ao mesmo tempo
+# (um por núcleo); enquanto a música N converte, o worker de download já busca a N+1
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', os.cpu_count() or 2))
+TRANSCODE_SPOOL_MAX = int(os.environ.get('TRANSCODE_SPOOL_MAX', 32 * 1024 ** 2))  # acima disso o buffer vai para disco
+TRANSCODE_SLOTS = threading.BoundedSemaphore(TRANSCODE_WORKERS)
+# Buffers baixados (spool/temp_*) esperando conversão: cheio, o estágio de download espera antes de baixar mais
+TRANSCODE_QUEUE_MAX = int(os.environ.get('TRANSCODE_QUEUE_MAX', TRANSCODE_WORKERS * 2))
+TRANSCODE_QUEUE_SLOTS = threading.BoundedSemaphore(TRANSCODE_QUEUE_MAX)
+TRANSCODE_STALL_TIMEOUT = float(os.environ.get('TRANSCODE_STALL_TIMEOUT', 5))  # seconds sem bytes: solta o núcleo do pipe direto
+TRANSCODE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix='transcode')
+
+
+def _done_future(value):
+    future = concurrent.futures.Future()
+    future.set_result(value)
+    return future
+
+
+def pode_copiar(fmt, profile):
+    """True se o áudio do formato de origem já serve para o perfil e pode ir para o arquivo sem reencode"""
+    perfil = OUTPUT_PROFILES[profile]
+    acodec = (fmt.get('acodec') or '').lower()
+    if not acodec.startswith(perfil['copy']):
+        return False
+    abr = fmt.get('abr')
+    return not (perfil.get('max_copy_abr') and abr and abr > perfil['max_copy_abr'])
+
+
+def escolher_fonte(info, profile):
+    """Formato de origem para o perfil -> (formato, copiar).
+    Prefere um formato só de áudio que permita -c:a copy (HTTP direto antes de HLS/DASH);
+    sem nenhum, fica com o que o yt-dlp escolheu (bestaudio) e reencoda.
+    """
+    copiaveis = [f for f in info.get('formats') or [] if f.get('url') and pode_copiar(f, profile)]
+    if copiaveis:
+        copiaveis.sort(key=lambda f: (
+            is_streamable_protocol(f.get('protocol')),
+            (f.get('vcodec') or 'none') == 'none',
+            f.get('abr') or 0,
+        ), reverse=True)
+        return copiaveis[0], True
+    return info, pode_copiar(info, profile)
+
+
+def argumentos_saida(profile, copiar):
+    """Argumentos de saída do ffmpeg para o perfil (cópia do stream ou reencode)"""
+    perfil = OUTPUT_PROFILES[profile]
+    if copiar:
+        codec = ['-c:a', 'copy']
+    else:
+        codec = ['-c:a', perfil['codec'], '-b:a', perfil['bitrate']] + perfil['encode_args']
+    return ['-vn'] + codec + perfil['mux_args'] + ['-f', perfil['muxer']]
+
+
+def _run_ffmpeg(source_args, out_path, total_duration, on_progress, cancel_event=None, feed=None, output_args=None,
+                entrada_local=False):
+    """Roda o ffmpeg para gerar o arquivo final (o chamador precisa segurar um TRANSCODE_SLOTS se for reencode).
+    feed(stdin) escreve a entrada quando source_args é pipe:0 e reporta o progresso do download.
+    entrada_local=True: o feed só copia um buffer já baixado, então o time= do ffmpeg vale como progresso desde o início.
+    output_args vem de argumentos_saida (padrão: MP3 128k). Retorna True se o arquivo foi gerado.
+    """
+    piped = source_args[-1] == 'pipe:0'
+    # Escreve em um .part exclusivo e renomeia no fim: um arquivo com o nome final está sempre completo,
+    # mesmo com outro worker convertendo a mesma (video_id, profile) ao mesmo tempo
+    part_path = f'{out_path}.{uuid.uuid4().hex[:8]}.part'
+    output_args = output_args or argumentos_saida(DEFAULT_PROFILE, False)
+    cmd = [FFMPEG_PATH, '-y'] + source_args + output_args + [part_path]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE if piped else subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    download_done = threading.Event()
+    if entrada_local:
+        on_progress(80)
+        download_done.set()
+    stderr_tail = []
+
+    def read_stderr():
+        for line in io.TextIOWrapper(process.stderr, encoding='utf-8', errors='replace'):
+            stderr_tail.append(line)
+            del stderr_tail[:-20]
+            current = parse_ffmpeg_time(line)
+            if current is not None and download_done.is_set():
+                percent = min(1.0, current / total_duration)
+                on_progress(80 + int(percent * 19))
+
+    stderr_thread = threading.Thread(target=read_stderr, daemon=True)
+    stderr_thread.start()
+
+    if cancel_event is not None:
+        def watch_cancel():
+            while process.poll() is None:
+                if cancel_event.wait(0.5):
+                    process.kill()
+                    return
+        threading.Thread(target=watch_cancel, daemon=True).start()
+
+    if piped:
+        try:
+            feed(process.stdin)
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            process.kill()
+            process.wait()
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+            raise
+        finally:
+            try:
+                process.stdin.close()
+            except Exception:
+                pass
+    on_progress(80)
+    download_done.set()
+
+    process.wait()
+    stderr_thread.join(timeout=5)
+    if process.returncode == 0 and os.path.isfile(part_path):
+        os.replace(part_path, out_path)
+        return True
+    log.error("Erro na conversão FFmpeg: %s", ''.join(stderr_tail))
+    try:
+        os.remove(part_path)
+    except OSError:
+        pass
+    return False
+
+
+def _transcode_stage(source_args, out_path, total_duration, on_progress, cancel_event, spool=None, audio_path=None,
+                     profile=DEFAULT_PROFILE, copiar=False, vaga_fila=False):
+    """Estágio de conversão (roda no TRANSCODE_POOL). vaga_fila=True: libera a vaga de TRANSCODE_QUEUE_SLOTS
+    do buffer baixado quando termina"""
+    try:
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        def feed(stdin):
+            shutil.copyfileobj(spool, stdin, PIPELINE_CHUNK_SIZE)
+        # Cópia do stream não ocupa núcleo: não disputa os TRANSCODE_SLOTS
+        slot = contextlib.nullcontext() if copiar else TRANSCODE_SLOTS
+        with slot, METRICS.cronometro('remux' if copiar else 'transcode'):
+            ok = _run_ffmpeg(source_args, out_path, total_duration, on_progress, cancel_event,
+                             feed if spool is not None else None, argumentos_saida(profile, copiar), entrada_local=True)
+        METRICS.inc('ytapi_outputs_total', profile=profile, mode='copy' if copiar else 'encode', result='ok' if ok else 'error')
+        if ok:
+            on_progress(100)
+            return out_path
+        return None
+    except Exception as e:
+        log.exception("Erro na conversão de %s: %s", out_path, e)
+        return None
+    finally:
+        if spool is not None:
+            spool.close()
+        if audio_path:
+            try:
+                os.remove(audio_path)
+            except Exception as cleanup_error:
+                log.warning("Erro ao remover arquivo temporário: %s", cleanup_error)
+        if vaga_fila:
+            TRANSCODE_QUEUE_SLOTS.release()
+
+
+def _aguardar(semaforo, cancel_event, video_url):
+    """Adquire `semaforo` esperando o tempo que for preciso; JobCancelled se a tarefa for cancelada antes"""
+    while not semaforo.acquire(timeout=0.5):
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled(video_url)
+
+
+class _SlotDireto:
+    """Slot de TRANSCODE_SLOTS de um download ligado direto no stdin do ffmpeg. Se a origem fica
+    TRANSCODE_STALL_TIMEOUT segundos sem mandar bytes, o núcleo é devolvido (o ffmpeg está parado esperando
+    entrada) e é pedido de volta quando os bytes voltam, antes de entregá-los ao ffmpeg."""
+
+    def __init__(self, cancel_event, video_url):
+        self.cancel_event = cancel_event
+        self.video_url = video_url
+        self._lock = threading.Lock()
+        self._held = True
+        self._entregando = False  # escrevendo no stdin: o ffmpeg é que está ocupado, não a origem
+        self._ultimo = time.monotonic()
+        self._fim = threading.Event()
+        threading.Thread(target=self._vigiar, daemon=True).start()
+
+    def _vigiar(self):
+        while not self._fim.wait(min(TRANSCODE_STALL_TIMEOUT, 1)):
+            with self._lock:
+                parado = not self._entregando and time.monotonic() - self._ultimo > TRANSCODE_STALL_TIMEOUT
+                if self._held and parado and not self._fim.is_set():
+                    self._held = False
+                    TRANSCODE_SLOTS.release()
+                    log.debug("Download parado, núcleo de conversão liberado: %s", self.video_url)
+
+    def entregar(self, stdin, data):
+        """Escreve um bloco no ffmpeg, recuperando o núcleo antes se ele foi devolvido"""
+        with self._lock:
+            recuperar = not self._held
+            self._entregando = True
+        try:
+            if recuperar:
+                _aguardar(TRANSCODE_SLOTS, self.cancel_event, self.video_url)
+                with self._lock:
+                    self._held = True
+            stdin.write(data)
+        finally:
+            with self._lock:
+                self._entregando = False
+                self._ultimo = time.monotonic()
+
+    def download_terminou(self):
+        """Daqui em diante o ffmpeg só converte o que já recebeu: o núcleo fica com ele até fechar()"""
+        self._fim.set()
+
+    def fechar(self):
+        self._fim.set()
+        with self._lock:
+            if self._held:
+                self._held = False
+                TRANSCODE_SLOTS.release()
+
+
+def _baixar_converter_async(video_url, title, on_progress, cancel_event, profile, video_id):
+    """Baixa o áudio (estágio de I/O, na thread chamadora) e agenda a conversão para o perfil
+    no TRANSCODE_POOL. Retorna um Future com o caminho do arquivo ou None em caso de erro/cancelamento.
+    Se a origem já está no codec do perfil, o áudio só é copiado para o contêiner final (sem reencode).
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        return _done_future(None)
+    temp_id = str(uuid.uuid4())[:8]
+    audio_path = None
+    spool = None
+    vaga_fila = False
+    try:
+        with EXTRACTORS.usar('download') as ydl, METRICS.cronometro('extract_download'):
+            info = ydl.extract_info(video_url, download=False)
+        if not info:
+            log.warning("Não foi possível extrair informações para: %s", video_url)
+            return _done_future(None)
+        safe_title = safe_filename(title or info.get('title') or f'audio_{temp_id}')
+        video_id = video_id or info.get('id')
+        if video_id:
+            pronto = saida_pronta((video_id, profile))
+            if pronto:
+                return _done_future(pronto)
+            out_path = os.path.join(DOWNLOAD_FOLDER, nome_saida(safe_title, video_id, profile))
+        else:
+            out_path = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_{temp_id}.{OUTPUT_PROFILES[profile]['ext']}")
+        # Formato de origem: um que dispense reencode para o perfil, se existir
+        fonte, copiar = escolher_fonte(info, profile)
+        if fonte is not info:
+            info = dict(info, **fonte)
+        saida = argumentos_saida(profile, copiar)
+        # Duração vem do próprio info do yt-dlp (sem rodar ffmpeg -i só para isso)
+        total_duration = info.get('duration') or 1
+
+        proto = (info.get('protocol') or '').lower()
+        fonte_local = fonte_em_cache(video_id, info.get('format_id'))
+        if fonte_local:
+            # O /stream já montou a origem inteira no cache tee: converte direto dela, sem baixar de novo
+            log.info("Usando origem do cache de stream: %s", fonte_local)
+            METRICS.inc('ytapi_cache_lookups_total', cache='stream_source', result='hit')
+            STORAGE.fixar(fonte_local)
+            on_progress(80)
+            source_args = ['-i', fonte_local]
+        elif info.get('url') and proto in ('http', 'https'):
+            def on_bytes(downloaded, total):
+                if total:
+                    on_progress(int(min(1.0, downloaded / total) * 80))
+
+            def feed(stdin, slot=None):
+                for data in iter_http_audio_paralelo(info, on_bytes, cancel_event):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise JobCancelled(video_url)
+                    if slot is not None:
+                        slot.entregar(stdin, data)
+                    else:
+                        stdin.write(data)
+                if slot is not None:
+                    slot.download_terminou()
+
+            slot = None if copiar or not TRANSCODE_SLOTS.acquire(blocking=False) else _SlotDireto(cancel_event, video_url)
+            if copiar or slot:
+                # Há núcleo livre (ou é só cópia do stream, sem custo de CPU): download direto no stdin do ffmpeg
+                try:
+                    with METRICS.cronometro('download_remux' if copiar else 'download_transcode'):
+                        ok = _run_ffmpeg(['-i', 'pipe:0'], out_path, total_duration, on_progress, cancel_event,
+                                         lambda stdin: feed(stdin, slot), saida)
+                finally:
+                    if slot:
+                        slot.fechar()
+                METRICS.inc('ytapi_outputs_total', profile=profile, mode='copy' if copiar else 'encode',
+                            result='ok' if ok else 'error')
+                if ok:
+                    on_progress(100)
+                    biblioteca_registrar(out_path, video_id, profile, title or info.get('title'), info.get('duration'))
+                return _done_future(out_path if ok else None)
+
+            # Conversores ocupados: baixa para um buffer (em memória até TRANSCODE_SPOOL_MAX) e entra na fila de
+            # conversão; com TRANSCODE_QUEUE_MAX buffers já esperando, aguarda aqui antes de baixar mais um
+            _aguardar(TRANSCODE_QUEUE_SLOTS, cancel_event, video_url)
+            vaga_fila = True
+            spool = tempfile.SpooledTemporaryFile(max_size=TRANSCODE_SPOOL_MAX, dir=DOWNLOAD_FOLDER, prefix=f'temp_{temp_id}')
+            with METRICS.cronometro('download'):
+                feed(spool)
+            spool.seek(0)
+            on_progress(80)
+            source_args = ['-i', 'pipe:0']
+        elif info.get('url') and 'm3u8' in proto and (DOWNLOAD_PARALLEL_PARTS <= 1 or total_duration < DOWNLOAD_PARALLEL_MIN_SECONDS):
+            # HLS curto: o próprio ffmpeg lê a playlist e os fragmentos
+            # (os longos vão para o yt-dlp, que baixa vários fragmentos ao mesmo tempo)
+            header_lines = ''.join(f'{k}: {v}\r\n' for k, v in (info.get('http_headers') or {}).items())
+            source_args = (['-headers', header_lines] if header_lines else []) + ['-i', info['url']]
+        else:
+            _aguardar(TRANSCODE_QUEUE_SLOTS, cancel_event, video_url)
+            vaga_fila = True
+            audio_path = _baixar_para_arquivo(video_url, info, temp_id, on_progress, cancel_event)
+            if not audio_path:
+                return _done_future(None)
+            source_args = ['-i', audio_path]
+
+        future = TRANSCODE_POOL.submit(_transcode_stage, source_args, out_path, total_duration,
+                                       on_progress, cancel_event, spool, audio_path, profile, copiar, vaga_fila)
+        if fonte_local:
+            future.add_done_callback(lambda f: STORAGE.soltar(fonte_local))
+        spool = audio_path = None  # agora pertencem ao estágio de conversão
+        vaga_fila = False
+        registro = (video_id, profile, title or info.get('title'), info.get('duration'))
+
+        def registrar(f):
+            if f.result():
+                biblioteca_registrar(f.result(), *registro)
+                STORAGE.acordar()
+        future.add_done_callback(registrar)
+        return future
+    except JobCancelled:
+        log.info("Download cancelado: %s", video_url)
+        return _done_future(None)
+    except Exception as e:
+        log.exception("Erro ao processar %s: %s", video_url, e)
+        return _done_future(None)
+    finally:
+        if spool is not None:
+            spool.close()
+        if audio_path:
+            try:
+                os.remove(audio_path)
+            except Exception as cleanup_error:
+                log.warning("Erro ao remover arquivo temporário: %s", cleanup_error)
+        if vaga_fila:
+            TRANSCODE_QUEUE_SLOTS.release()
+
+
+class _FlightCancel:
+    """Cancelamento de um download compartilhado: só cancela quando todas as tarefas anexadas cancelaram"""
+
+    def __init__(self):
+        self.events = []
+
+    def is_set(self):
+        return bool(self.events) and all(e.is_set() for e in self.events)
+
+    def wait(self, timeout=None):
+        deadline = time.time() + (timeout or 0)
+        while not self.is_set():
+            if timeout is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+
+class _Flight:
+    """Download/conversão em andamento para uma (video_id, profile), compartilhado entre requisições"""
+
+    def __init__(self):
+        self.future = concurrent.futures.Future()
+        self.listeners = []
+        self.cancel = _FlightCancel()
+        self.percent = 0
+
+    def attach(self, on_progress, cancel_event):
+        self.listeners.append(on_progress)
+        self.cancel.events.append(cancel_event if cancel_event is not None else threading.Event())
+        on_progress(self.percent)
+
+    def report(self, percent):
+        self.percent = percent
+        for listener in list(self.listeners):
+            try:
+                listener(percent)
+            except Exception as e:
+                log.warning("Erro ao reportar progresso: %s", e)
+
+
+def baixar_converter_async(video_url, title=None, on_progress=None, cancel_event=None, profile=DEFAULT_PROFILE):
+    """Baixa e converte o áudio de video_url para o perfil. Retorna um Future com o caminho do arquivo ou None.
+    Saídas são identificadas por (video_id, profile): se já existe um arquivo pronto ele é devolvido na hora,
+    e se outro pedido já está processando o mesmo vídeo este se anexa ao progresso dele (single-flight).
+    on_progress(percent) recebe 0-80 durante o download e 80-99 durante a conversão.
+    cancel_event (threading.Event) interrompe o download/conversão quando setado.
+    """
+    on_progress = on_progress or (lambda percent: None)
+    video_id = extrair_video_id(video_url)
+    if not video_id:
+        return _baixar_converter_async(video_url, title, on_progress, cancel_event, profile, None)
+    key = (video_id, profile)
+    with INFLIGHT_LOCK:
+        pronto = saida_pronta(key)
+        if pronto:
+            on_progress(100)
+            return _done_future(pronto)
+        flight = INFLIGHT.get(key)
+        if flight is not None:
+            flight.attach(on_progress, cancel_event)
+            return flight.future
+        flight = INFLIGHT[key] = _Flight()
+        flight.attach(on_progress, cancel_event)
+
+    def done(f):
+        try:
+            path = f.result()
+        except Exception:
+            path = None
+        with INFLIGHT_LOCK:
+            INFLIGHT.pop(key, None)
+            if path:
+                OUTPUT_INDEX[key] = os.path.basename(path)
+        flight.future.set_result(path)
+
+    try:
+        inner = _baixar_converter_async(video_url, title, flight.report, flight.cancel, profile, video_id)
+    except Exception:
+        inner = _done_future(None)
+    inner.add_done_callback(done)
+    return flight.future
+
+
+def baixar_converter(video_url, title=None, on_progress=None, cancel_event=None, profile=DEFAULT_PROFILE):
+    """Versão síncrona de baixar_converter_async: retorna o caminho do arquivo ou None"""
+    return baixar_converter_async(video_url, title, on_progress, cancel_event, profile).result()
+
+
+# Agendador global das tarefas do /baixar: orçamento único de workers, fila FIFO por cliente
+# (round-robin entre clientes) e prioridade de vídeos únicos sobre músicas de playlist
+JOB_MAX_WORKERS = int(os.environ.get('JOB_MAX_WORKERS', 8))  # workers de I/O (download); conversão usa TRANSCODE_WORKERS
+JOB_MAX_QUEUE = int(os.environ.get('JOB_MAX_QUEUE', 200))
+# Limite próprio das músicas avulsas: não disputam vaga com playlists, mas também não crescem sem limite
+JOB_MAX_QUEUE_SINGLE = int(os.environ.get('JOB_MAX_QUEUE_SINGLE', JOB_MAX_QUEUE))
+JOB_RETRY_AFTER = int(os.environ.get('JOB_RETRY_AFTER', 5))  # seconds, Retry-After do 503 com a fila cheia
+PRIORITY_SINGLE = 0
+PRIORITY_PLAYLIST = 1
+
+
+class QueueFull(Exception):
+    """Fila do agendador cheia (controle de admissão)"""
+
+
+class JobCancelled(Exception):
+    """Tarefa cancelada pelo cliente"""
+
+
+class JobScheduler:
+    def __init__(self, max_workers=JOB_MAX_WORKERS, max_queue=JOB_MAX_QUEUE, max_queue_single=JOB_MAX_QUEUE_SINGLE):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_queue_single = max_queue_single
+        self._cond = threading.Condition()
+        # { priority: OrderedDict({ client: deque([(task_id, fn, force), ...]) }) }
+        self._queues = {PRIORITY_SINGLE: OrderedDict(), PRIORITY_PLAYLIST: OrderedDict()}
+        self._queued = 0
+        # { priority: jobs na fila que contam para o limite } (sem os filhos de tarefas já admitidas)
+        self._admitidos = {PRIORITY_SINGLE: 0, PRIORITY_PLAYLIST: 0}
+        self._running = {}  # { task_id: jobs em execução }
+        self._cancel_events = {}  # { task_id: threading.Event }
+        for i in range(max_workers):
+            threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True).start()
+
+    def submit(self, task_id, client, priority, fn, force=False):
+        """Enfileira fn(). Tarefas novas passam pelo limite da sua prioridade (max_queue_single para músicas
+        avulsas, max_queue para playlists); force=True (jobs filhos de uma tarefa já admitida) não conta."""
+        with self._cond:
+            limite = self.max_queue_single if priority == PRIORITY_SINGLE else self.max_queue
+            if not force and self._admitidos[priority] >= limite:
+                raise QueueFull()
+            self._queues[priority].setdefault(client, deque()).append((task_id, fn, force))
+            self._queued += 1
+            if not force:
+                self._admitidos[priority] += 1
+            self._cancel_events.setdefault(task_id, threading.Event())
+            self._cond.notify()
+
+    def _next(self):
+        for priority in sorted(self._queues):
+            clients = self._queues[priority]
+            if clients:
+                client, lane = next(iter(clients.items()))
+                job = lane.popleft()
+                if lane:
+                    clients.move_to_end(client)
+                else:
+                    del clients[client]
+                self._queued -= 1
+                if not job[2]:
+                    self._admitidos[priority] -= 1
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._queued == 0:
+                    self._cond.wait()
+                task_id, fn, _ = self._next()
+                self._running[task_id] = self._running.get(task_id, 0) + 1
+            try:
+                fn()
+            except Exception as e:
+                log.exception("Erro em job da tarefa %s: %s", task_id, e)
+            finally:
+                with self._cond:
+                    self._running[task_id] -= 1
+                    if not self._running[task_id]:
+                        del self._running[task_id]
+
+    def _ordered(self):
+        """task_ids na ordem em que serão executados"""
+        order = []
+        for priority in sorted(self._queues):
+            lanes = [list(lane) for lane in self._queues[priority].values()]
+            while any(lanes):
+                for lane in lanes:
+                    if lane:
+                        order.append(lane.pop(0)[0])
+        return order
+
+    def queue_position(self, task_id):
+        """0 se já está rodando, 1..N se aguardando na fila, None se desconhecida"""
+        with self._cond:
+            if task_id in self._running:
+                return 0
+            order = self._ordered()
+        if task_id in order:
+            return order.index(task_id) + 1
+        return None
+
+    def cancel_event(self, task_id):
+        with self._cond:
+            return self._cancel_events.setdefault(task_id, threading.Event())
+
+    def cancel(self, task_id):
+        """Remove os jobs da tarefa que ainda estão na fila e sinaliza os que estão rodando"""
+        with self._cond:
+            for priority, clients in self._queues.items():
+                for client, lane in list(clients.items()):
+                    kept = deque(job for job in lane if job[0] != task_id)
+                    self._queued -= len(lane) - len(kept)
+                    self._admitidos[priority] -= sum(1 for job in lane if job[0] == task_id and not job[2])
+                    if kept:
+                        clients[client] = kept
+                    else:
+                        del clients[client]
+            event = self._cancel_events.setdefault(task_id, threading.Event())
+        event.set()
+
+    def forget(self, task_id):
+        with self._cond:
+            self._cancel_events.pop(task_id, None)
+
+    def stats(self):
+        with self._cond:
+            return {'workers': self.max_workers, 'queued': self._queued, 'running': sum(self._running.values())}
+
+
+SCHEDULER = JobScheduler()
+
+
+class SWRCache:
+    """Cache LRU com TTL, stale-while-revalidate e coalescência de requisições idênticas.
+    get(key, loader) retorna (valor, status) com status em 'hit', 'stale' ou 'miss'.
+    """
+
+    def __init__(self, name, max_entries, ttl, stale_ttl=0, backend=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        # Com backend compartilhado, o que um worker busca fica disponível para os outros
+        self.backend = backend if backend is not None and backend.compartilhado else None
+        self._entries = OrderedDict()  # { key: (timestamp, value) }
+        self._inflight = {}  # { key: Future }
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'stale': 0, 'coalesced': 0, 'refreshes': 0, 'errors': 0, 'shared_hits': 0}
+
+    def _store(self, key, value, timestamp=None):
+        timestamp = timestamp or time.time()
+        with self._lock:
+            self._entries[key] = (timestamp, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _publish(self, key, value):
+        try:
+            self.backend.set(self.name, key, {'t': time.time(), 'v': value}, self.ttl + self.stale_ttl)
+        except Exception as e:
+            log.warning("Erro ao publicar cache %s no backend de estado: %s", self.name, e)
+
+    def _fetch_shared(self, key):
+        """Traz para o cache local a entrada publicada por outro processo, se houver"""
+        try:
+            entry = self.backend.get(self.name, key)
+        except Exception as e:
+            log.warning("Erro ao ler cache %s do backend de estado: %s", self.name, e)
+            return
+        if entry is not None and time.time() - entry['t'] < self.ttl + self.stale_ttl:
+            self._store(key, entry['v'], entry['t'])
+            with self._lock:
+                self._counters['shared_hits'] += 1
+
+    def _load(self, key, loader, future):
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                self._counters['errors'] += 1
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            return
+        self._store(key, value)
+        if self.backend is not None:
+            self._publish(key, value)
+        with self._lock:
+            self._inflight.pop(key, None)
+        future.set_result(value)
+
+    def _refresh(self, key, loader):
+        future = concurrent.futures.Future()
+        self._counters['refreshes'] += 1
+        threading.Thread(target=self._load, args=(key, loader, future), daemon=True).start()
+        return future
+
+    def get(self, key, loader):
+        if self.backend is not None:
+            with self._lock:
+                local = key in self._entries or key in self._inflight
+            if not local:
+                self._fetch_shared(key)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry[0]
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self._counters['hits'] += 1
+                    return entry[1], 'hit'
+                if age < self.ttl + self.stale_ttl:
+                    # Serve o valor vencido e atualiza em background (uma única atualização por chave)
+                    self._entries.move_to_end(key)
+                    self._counters['stale'] += 1
+                    if key not in self._inflight:
+                        self._inflight[key] = self._refresh(key, loader)
+                    return entry[1], 'stale'
+                del self._entries[key]
+            future = self._inflight.get(key)
+            if future is not None:
+                self._counters['coalesced'] += 1
+                leader = False
+            else:
+                future = self._inflight[key] = concurrent.futures.Future()
+                self._counters['misses'] += 1
+                leader = True
+        if leader:
+            self._load(key, loader, future)
+        return future.result(), 'miss'
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), max_entries=self.max_entries,
+                        ttl=self.ttl, stale_ttl=self.stale_ttl, shared=self.backend is not None)
+
+
+@app.route('/')
+def home():
+    return jsonify({
+        'status': 'ok',
+        'message': 'YouTube Downloader API',
+        'ffmpeg_available': FFMPEG_PATH is not None,
+        'version': '1.0.0'
+    })
+
+@app.route('/health')
+def health():
+    return jsonify({'status': 'healthy'})
+
+PLAYLIST_MAX_TRACKS = int(os.environ.get('PLAYLIST_MAX_TRACKS', 500))
+PLAYLIST_PAGE_SIZE = 50
+
+
+def parametros_pagina(data, max_limit, default_limit=None):
+    """Lê offset/limit do corpo JSON (ValueError se inválidos)"""
+    offset = int(data.get('offset') or 0)
+    limit = data.get('limit')
+    limit = int(limit) if limit is not None else (default_limit or max_limit)
+    if offset < 0 or limit <= 0:
+        raise ValueError('offset/limit inválidos')
+    return offset, min(limit, max_limit)
+
+
+def normalizar_entrada(entry):
+    """Entrada flat da playlist -> {'id', 'title', 'url', 'duration'} (None se inválida)"""
+    if not entry or not (entry.get('url') or entry.get('id')):
+        return None
+    url = entry.get('url') or entry.get('id')
+    if not url.startswith('http'):
+        url = f"https://www.youtube.com/watch?v={url}"
+    return {
+        'id': entry.get('id'),
+        'title': entry.get('title') or url,
+        'url': url,
+        'duration': entry.get('duration'),
+    }
+
+
+def iterar_playlist(playlist_link, offset=0, limit=None):
+    """Gera primeiro {'title', 'id'} da playlist e depois as entradas normalizadas, página a página,
+    à medida que o yt-dlp as busca (process=False mantém `entries` como gerador)"""
+    with EXTRACTORS.usar('playlist') as ydl:
+        with METRICS.cronometro('extract_playlist'):
+            info = ydl.extract_info(playlist_link, download=False, process=False)
+        yield {'title': info.get('title') or 'Playlist', 'id': info.get('id')}
+        entries = info.get('entries') or []
+        stop = offset + limit if limit is not None else None
+        for entry in itertools.islice(iter(entries), offset, stop):
+            item = normalizar_entrada(entry)
+            if item:
+                yield item
+
+
+def obter_info(link, offset=0, limit=10):
+    """Título (e as músicas offset..offset+limit, se for playlist) do link"""
+    # Detecta playlist e monta link correto
+    is_playlist, playlist_link = detectar_playlist(link)
+    if is_playlist:
+        # Para playlist: extração super rápida, só da página pedida
+        entradas = iterar_playlist(playlist_link, offset, limit)
+        header = next(entradas)
+        entry_titles = [e['title'] for e in entradas]
+        return {'title': header['title'], 'is_playlist': True, 'entries': entry_titles}
+    else:
+        # Para vídeo único: extração rápida sem download
+        with EXTRACTORS.usar('info') as ydl, METRICS.cronometro('extract_info'):
+            info = ydl.extract_info(link, download=False)
+        title = info.get('title', '')
+        return {'title': title, 'is_playlist': False}
+
+
+INFO_CACHE = SWRCache('info', int(os.environ.get('INFO_CACHE_MAX', 2000)),
+                      int(os.environ.get('INFO_CACHE_TTL', 1800)), int(os.environ.get('INFO_CACHE_STALE_TTL', 3600)),
+                      backend=STATE)
+
+
+@app.route('/info', methods=['POST'])
+def info_video():
+    data = request.get_json()
+    link = data.get('link')
+    if not link:
+        return jsonify({'error': 'Link não fornecido'}), 400
+    try:
+        offset, limit = parametros_pagina(data, PLAYLIST_MAX_TRACKS, default_limit=10)
+    except ValueError:
+        return jsonify({'error': 'offset/limit inválidos'}), 400
+    try:
+        result, _ = INFO_CACHE.get(f'{link.strip()}|{offset}|{limit}', lambda: obter_info(link, offset, limit))
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def buscar_videos(query):
+    """Executa a busca no YouTube (5 resultados, extração flat)"""
+    # Usa yt_dlp para pesquisa
+    # Reduce to 5 results and use a flatter, faster extraction when possible
+    with EXTRACTORS.usar('search') as ydl, METRICS.cronometro('extract_search'):
+        search_url = f"ytsearch5:{query}"
+        info = ydl.extract_info(search_url, download=False)
+    entries = info.get('entries', []) if info else []
+    results = []
+    for e in entries[:5]:
+        if not e:
+            continue
+        results.append({
+            'id': e.get('id'),
+            'title': e.get('title'),
+            'url': f"https://www.youtube.com/watch?v={e.get('id')}",
+            'duration': e.get('duration'),
+            'thumbnail': e.get('thumbnail')
+        })
+    return results
+
+
+SEARCH_CACHE = SWRCache('search', SEARCH_CACHE_MAX, SEARCH_CACHE_TTL, SEARCH_CACHE_STALE_TTL, backend=STATE)
+
+
+@app.route('/search', methods=['POST'])
+def search_videos():
+    data = request.get_json()
+    query = data.get('query')
+    if not query:
+        return jsonify({'error': 'Query não fornecida'}), 400
+    key = query.strip().lower()
+    try:
+        results, status = SEARCH_CACHE.get(key, lambda: buscar_videos(query))
+        return jsonify({'results': results, 'cached': status != 'miss'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Variantes em lote de /search e /info: resolvidas em paralelo, respostas em NDJSON à medida que ficam prontas
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 8))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+BATCH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+
+
+def resolver_lote(items, resolve):
+    """Gera uma linha NDJSON por item assim que ele termina; erros são por item e não derrubam o lote"""
+    futures = {BATCH_POOL.submit(resolve, item): idx for idx, item in enumerate(items)}
+    for future in concurrent.futures.as_completed(futures):
+        idx = futures[future]
+        try:
+            line = dict(future.result(), index=idx)
+        except Exception as e:
+            line = {'index': idx, 'error': str(e)}
+        yield json.dumps(line) + '\n'
+
+
+def _itens_lote(data, field):
+    items = data.get(field) if data else None
+    if not isinstance(items, list) or not items:
+        return None, (jsonify({'error': f'Lista "{field}" não fornecida'}), 400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return None, (jsonify({'error': f'Máximo de {BATCH_MAX_ITEMS} itens por lote'}), 400)
+    return items, None
+
+
+@app.route('/playlist', methods=['POST'])
+def playlist_entries():
+    """Entradas da playlist em NDJSON enquanto são extraídas: uma linha 'playlist', uma 'entry' por música e 'end'"""
+    data = request.get_json() or {}
+    link = data.get('link')
+    if not link:
+        return jsonify({'error': 'Link não fornecido'}), 400
+    is_playlist, playlist_link = detectar_playlist(link)
+    if not is_playlist:
+        return jsonify({'error': 'Link não é uma playlist'}), 400
+    try:
+        offset, limit = parametros_pagina(data, PLAYLIST_MAX_TRACKS, default_limit=PLAYLIST_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'offset/limit inválidos'}), 400
+
+    def generate():
+        count = 0
+        try:
+            entradas = iterar_playlist(playlist_link, offset, limit)
+            header = next(entradas)
+            yield json.dumps(dict(header, type='playlist', offset=offset, limit=limit)) + '\n'
+            for item in entradas:
+                yield json.dumps(dict(item, type='entry', index=offset + count)) + '\n'
+                count += 1
+        except Exception as e:
+            yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+        # next_offset é None quando a página veio incompleta (fim da playlist)
+        next_offset = offset + count if count == limit else None
+        yield json.dumps({'type': 'end', 'count': count, 'next_offset': next_offset}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    items, error = _itens_lote(request.get_json(), 'queries')
+    if error:
+        return error
+
+    def resolve(query):
+        if not isinstance(query, str) or not query.strip():
+            raise ValueError('Query não fornecida')
+        results, status = SEARCH_CACHE.get(query.strip().lower(), lambda: buscar_videos(query))
+        return {'query': query, 'results': results, 'cached': status != 'miss'}
+
+    return Response(stream_with_context(resolver_lote(items, resolve)), mimetype='application/x-ndjson')
+
+
+@app.route('/info/batch', methods=['POST'])
+def info_batch():
+    items, error = _itens_lote(request.get_json(), 'links')
+    if error:
+        return error
+
+    def resolve(link):
+        if not isinstance(link, str) or not link.strip():
+            raise ValueError('Link não fornecido')
+        result, status = INFO_CACHE.get(f'{link.strip()}|0|10', lambda: obter_info(link))
+        return dict(result, link=link, cached=status != 'miss')
+
+    return Response(stream_with_context(resolver_lote(items, resolve)), mimetype='application/x-ndjson')
+
+
+@app.route('/storage')
+def storage_usage():
+    return jsonify(STORAGE.uso())
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    with FORMAT_CACHE_LOCK:
+        format_entries = len(FORMAT_CACHE)
     return jsonify({
-        'status': 'ok',
-        'message': 'YouTube Downloader API',
-        'ffmpeg_available': FFMPEG_PATH is not None,
-        'version': '1.0.0'
+        'search': SEARCH_CACHE.stats(),
+        'info': INFO_CACHE.stats(),
+        'formats': {'entries': format_entries, 'max_entries': FORMAT_CACHE_MAX},
+        'extractors': EXTRACTORS.stats(),
+        'state': STATE.stats(),
+        'prefetch': PREFETCH.stats(),
     })
 
-@app.route('/health')
-def health():
-    return jsonify({'status': 'healthy'})
 
-@app.route('/info', methods=['POST'])
-def info_video():
-    data = request.get_json()
-    link = data.get('link')
-    if not link:
-        return jsonify({'error': 'Link não fornecido'}), 400
-    try:
-        # Detecta playlist e monta link correto
-        is_playlist = 'playlist' in link or 'list=' in link
-        playlist_id = None
-        if 'list=' in link:
-            match = re.search(r'list=([A-Za-z0-9_-]+)', link)
-            if match:
-                playlist_id = match.group(1)
-        if is_playlist and playlist_id:
-            playlist_link = f'https://www.youtube.com/playlist?list={playlist_id}'
-        else:
-            playlist_link = link
-
-        if is_playlist and playlist_id:
-            # Para playlist: extração super rápida
-            with yt_dlp.YoutubeDL({'quiet': True, 'extract_flat': True, 'playlist_end': 10}) as ydl:
-                info = ydl.extract_info(playlist_link, download=False)
-            title = info.get('title', 'Playlist')
-            entries = info.get('entries', [])[:10]
-            entry_titles = [e.get('title', e.get('url', '')) for e in entries if e]
-            return jsonify({'title': title, 'is_playlist': True, 'entries': entry_titles})
-        else:
-            # Para vídeo único: extração rápida sem download
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                info = ydl.extract_info(link, download=False)
-            title = info.get('title', '')
-            return jsonify({'title': title, 'is_playlist': False})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+@app.before_request
+def _marcar_inicio():
+    g.inicio = time.perf_counter()
 
 
-@app.route('/search', methods=['POST'])
-def search_videos():
-    data = request.get_json()
-    query = data.get('query')
-    if not query:
-        return jsonify({'error': 'Query não fornecida'}), 400
-    key = query.strip().lower()
-    # check cache
-    cached = SEARCH_CACHE.get(key)
-    if cached:
-        ts, results = cached
-        if time.time() - ts < SEARCH_CACHE_TTL:
-            return jsonify({'results': results, 'cached': True})
-        else:
-            del SEARCH_CACHE[key]
-    try:
-        # Usa yt_dlp para pesquisa
-        # Reduce to 5 results and use a flatter, faster extraction when possible
-        with yt_dlp.YoutubeDL({'quiet': True, 'skip_download': True, 'extract_flat': True}) as ydl:
-            search_url = f"ytsearch5:{query}"
-            info = ydl.extract_info(search_url, download=False)
-        entries = info.get('entries', []) if info else []
-        results = []
-        for e in entries[:5]:
-            if not e:
-                continue
-            results.append({
-                'id': e.get('id'),
-                'title': e.get('title'),
-                'url': f"https://www.youtube.com/watch?v={e.get('id')}",
-                'duration': e.get('duration'),
-                'thumbnail': e.get('thumbnail')
-            })
-        # store in cache
-        try:
-            SEARCH_CACHE[key] = (time.time(), results)
-        except Exception:
-            pass
-        return jsonify({'results': results, 'cached': False})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+@app.after_request
+def _medir_requisicao(response):
+    inicio = getattr(g, 'inicio', None)
+    if inicio is not None:
+        rota = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        METRICS.observe('ytapi_http_request_duration_seconds', time.perf_counter() - inicio, route=rota)
+        METRICS.inc('ytapi_http_responses_total', route=rota, status=response.status_code)
+    return response
+
+
+@METRICS.coletor
+def _metricas_do_processo():
+    """Valores lidos na hora do scrape de quem já os mantém (fila, pools, caches, disco)"""
+    fila = SCHEDULER.stats()
+    uso = STORAGE.uso()
+    with FORMAT_CACHE_LOCK:
+        format_entries = len(FORMAT_CACHE)
+    swr = [('search', SEARCH_CACHE.stats()), ('info', INFO_CACHE.stats())]
+    swr_eventos = ('hits', 'misses', 'stale', 'coalesced', 'refreshes', 'errors', 'shared_hits')
+    extratores = EXTRACTORS.stats()
+    return [
+        ('ytapi_jobs_queued', 'gauge', 'Jobs esperando no agendador', [({}, fila['queued'])]),
+        ('ytapi_jobs_running', 'gauge', 'Jobs em execução no agendador', [({}, fila['running'])]),
+        ('ytapi_tasks', 'gauge', 'Entradas no armazenamento de tarefas deste processo', [({}, len(progress))]),
+        ('ytapi_swr_cache_events_total', 'counter', 'Eventos dos caches de /search e /info',
+         [({'cache': name, 'event': event}, st[event]) for name, st in swr for event in swr_eventos]),
+        ('ytapi_cache_entries', 'gauge', 'Entradas nos caches em memória',
+         [({'cache': name}, st['entries']) for name, st in swr] + [({'cache': 'format'}, format_entries)]),
+        ('ytapi_extractor_instances', 'gauge', 'Instâncias YoutubeDL do pool por perfil e estado',
+         [({'profile': name, 'state': state}, st[state]) for name, st in extratores.items() for state in ('idle', 'live')]),
+        ('ytapi_upstream_idle_connections', 'gauge', 'Conexões keep-alive ociosas para o upstream',
+         [({}, sum(UPSTREAM_POOL.stats().values()))]),
+        ('ytapi_storage_used_bytes', 'gauge', 'Bytes em downloads/ na última verificação', [({}, uso['used_bytes'])]),
+        ('ytapi_storage_budget_bytes', 'gauge', 'Orçamento de disco', [({}, uso['budget_bytes'])]),
+        ('ytapi_storage_evicted_bytes_total', 'counter', 'Bytes removidos pela limpeza de disco', [({}, uso['evicted_bytes'])]),
+    ]
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/offline', methods=['GET'])
 def list_offline():
-    files = []
+    """Arquivos salvos, direto do índice. Parâmetros opcionais: offset, limit, sort, order, q, ext, video_id"""
     try:
-        for f in os.listdir(DOWNLOAD_FOLDER):
-            if f.lower().endswith('.mp3') or f.lower().endswith('.zip'):
-                files.append({'filename': f, 'path': os.path.join(DOWNLOAD_FOLDER, f)})
-        return jsonify({'files': files})
+        offset = int(request.args.get('offset', 0))
+        limit = request.args.get('limit')
+        limit = int(limit) if limit is not None else None
+        if offset < 0 or (limit is not None and limit <= 0):
+            raise ValueError()
+    except ValueError:
+        return jsonify({'error': 'offset/limit inválidos'}), 400
+    sort = request.args.get('sort', 'created_at')
+    if sort not in LIBRARY_SORT_KEYS:
+        return jsonify({'error': f'sort deve ser um de: {", ".join(LIBRARY_SORT_KEYS)}'}), 400
+    order = 'asc' if request.args.get('order', 'desc').lower() == 'asc' else 'desc'
+    try:
+        total, files = biblioteca_listar(offset, limit, sort, order, q=request.args.get('q'),
+                                         ext=request.args.get('ext'), video_id=request.args.get('video_id'))
+        return jsonify({'files': files, 'total': total, 'offset': offset, 'limit': limit})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def _abrir_upstream(video_id, url, headers):
+    try:
+        return UPSTREAM_POOL.request(url, headers=headers)
+    except urllib_error.HTTPError as e:
+        # URL assinada expirou/foi revogada: descarta do cache para a próxima tentativa
+        if e.code in (403, 404, 410):
+            invalidate_audio_format(video_id)
+        raise
+
+
+def _corpo_stream(partes):
+    """Junta os trechos (origem, blocos) da resposta do /stream, medindo os bytes por origem"""
+    enviados = {}
+    METRICS.inc('ytapi_active_streams')
+    try:
+        for origem, blocos in partes:
+            for chunk in blocos:
+                enviados[origem] = enviados.get(origem, 0) + len(chunk)
+                yield chunk
+    finally:
+        METRICS.dec('ytapi_active_streams')
+        for origem, total in enviados.items():
+            METRICS.inc('ytapi_stream_bytes_total', total, source=origem)
+
+
+def _stream_com_tee(video_id, chosen, content_type):
+    """Proxy direto pelo cache tee: trechos já gravados saem do disco e só os que faltam vêm do upstream
+    (e ficam gravados para a próxima vez). Com a faixa completa, vira um arquivo comum com Range/ETag.
+    """
+    stream_url = chosen.get('url')
+    range_header = request.headers.get('Range')
+    rc = abrir_range_cache(_stream_cache_key(video_id, chosen.get('format_id')))
+    try:
+        if rc.complete:
+            METRICS.inc('ytapi_cache_lookups_total', cache='stream_tee', result='hit')
+            response = servir_arquivo(rc.path, content_type)
+            if response.content_length:
+                METRICS.inc('ytapi_stream_bytes_total', response.content_length, source='tee_cache')
+        elif rc.size is None:
+            # Primeiro acesso: o tamanho total só é conhecido pela resposta do upstream
+            METRICS.inc('ytapi_cache_lookups_total', cache='stream_tee', result='miss')
+            upstream = _abrir_upstream(video_id, stream_url, {'Range': range_header} if range_header else {})
+            offset, total = _tamanho_upstream(upstream)
+            if offset is not None and total <= STREAM_TEE_MAX_FILE:
+                rc.definir_tamanho(total)
+            response_headers = {}
+            for name in ('Content-Range', 'Accept-Ranges', 'Content-Length'):
+                value = upstream.getheader(name)
+                if value:
+                    response_headers[name] = value
+            corpo = _repassar_com_tee(upstream, rc if rc.size is not None else None, offset or 0)
+            response = Response(stream_with_context(_corpo_stream([('upstream', corpo)])),
+                                headers=response_headers, status=upstream.getcode(), mimetype=content_type)
+        else:
+            byte_range = parse_range(range_header, rc.size)
+            if byte_range == 'unsatisfiable':
+                response = Response(status=416, headers={'Content-Range': f'bytes */{rc.size}'})
+            else:
+                start, end = byte_range or (0, rc.size - 1)
+                segmentos = rc.segmentos(start, end)
+                faltando = [seg for seg in segmentos if not seg[2]]
+                METRICS.inc('ytapi_cache_lookups_total', cache='stream_tee',
+                            result='partial' if faltando else 'hit')
+
+                def partes():
+                    for a, b, local in segmentos:
+                        if local:
+                            yield 'tee_cache', rc.ler(a, b)
+                            continue
+                        upstream = _abrir_upstream(video_id, stream_url, {'Range': f'bytes={a}-{b}'})
+                        if _tamanho_upstream(upstream)[0] != a:
+                            upstream.close()
+                            raise IOError(f'upstream ignorou o Range bytes={a}-{b}')
+                        yield 'upstream', _repassar_com_tee(upstream, rc, a)
+
+                response_headers = {'Accept-Ranges': 'bytes', 'Content-Length': str(end - start + 1)}
+                if byte_range:
+                    response_headers['Content-Range'] = f'bytes {start}-{end}/{rc.size}'
+                response = Response(stream_with_context(_corpo_stream(partes())), headers=response_headers,
+                                    status=206 if byte_range else 200, mimetype=content_type)
+    except BaseException:
+        fechar_range_cache(rc)
+        raise
+    response.call_on_close(lambda: fechar_range_cache(rc))
+    return response
+
+
 @app.route('/stream/<video_id>')
 def stream_video_audio(video_id):
     """Proxy stream do áudio do YouTube para reprodução imediata.
@@ -158,54 +3232,23 @@ def stream_video_audio(video_id):
     """
     try:
         url = request.args.get('url') or f'https://www.youtube.com/watch?v={video_id}'
-        # Extrai formatos e escolhe melhor áudio
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-        formats = info.get('formats', [])
-        # Filtra formatos de áudio
-        audio_formats = [f for f in formats if f.get('acodec') and f.get('acodec') != 'none']
-        if not audio_formats:
-            return jsonify({'error': 'Formato de áudio não encontrado'}), 404
-
-        # PRIORIDADE 1: Formatos que suportam streaming direto (não HLS/DASH)
-        streamable_formats = []
-        for fmt in audio_formats:
-            proto = (fmt.get('protocol') or '').lower()
-            has_url = fmt.get('url') is not None
-            # Exclui HLS (m3u8) e DASH fragmentado
-            if has_url and 'm3u8' not in proto and 'dash' not in proto and 'fragmented' not in proto:
-                streamable_formats.append(fmt)
-
-        # Se temos formatos streamáveis, usa o melhor deles
-        if streamable_formats:
-            # Ordena por qualidade (abr) e depois por preferência de codec
-            streamable_formats.sort(key=lambda x: (
-                x.get('abr') or 0,  # bitrate
-                1 if x.get('ext') == 'webm' else 0,  # prefere não-webm
-                1 if 'opus' in (x.get('acodec') or '') else 0  # prefere não-opus
-            ), reverse=True)
-            chosen = streamable_formats[0]
-            print(f"Usando streaming direto: {chosen.get('format_id')} - {chosen.get('abr')}kbps {chosen.get('ext')}")
-        else:
-            # FALLBACK: usa o melhor formato disponível (incluindo HLS/DASH)
-            audio_formats.sort(key=lambda x: (x.get('abr') or 0), reverse=True)
-            chosen = audio_formats[0]
-            print(f"Usando formato não-streaming (fallback): {chosen.get('format_id')} - {chosen.get('abr')}kbps {chosen.get('ext')}")
+        # Formato escolhido vem do cache (evita extract_info a cada Range/seek)
+        try:
+            chosen = resolve_audio_format(video_id, url)
+        except FormatNotFound as e:
+            return jsonify({'error': str(e)}), 404
 
         stream_url = chosen.get('url')
-        ext = chosen.get('ext', '').lower()
-        content_type = 'audio/mpeg'
-        if ext in ['m4a', 'mp4']:
-            content_type = 'audio/mp4'
-        elif ext in ['webm', 'opus']:
-            content_type = 'audio/webm'
+        content_type = chosen.get('content_type', 'audio/mpeg')
 
         # Verifica se pode fazer streaming direto
-        use_temp_file = False
-        proto = (chosen.get('protocol') or '').lower()
-        if not stream_url or ('m3u8' in proto) or ('dash' in proto) or ('fragmented' in proto):
-            use_temp_file = True
-            print(f"Forçado download temporário devido ao protocolo: {proto}")
+        use_temp_file = not chosen.get('streamable')
+        if use_temp_file:
+            log.debug("Forçado download temporário devido ao protocolo: %s", chosen.get('protocol'))
+
+        # Stream direto com o cache tee: o que já passou pelo proxy sai do disco
+        if not use_temp_file and STREAM_TEE_CACHE:
+            return _stream_com_tee(video_id, chosen, content_type)
 
         # Se for para usar stream direto da URL
         if not use_temp_file:
@@ -215,8 +3258,7 @@ def stream_video_audio(video_id):
             if range_header:
                 headers['Range'] = range_header
 
-            req_up = urllib_request.Request(stream_url, headers=headers)
-            upstream = urllib_request.urlopen(req_up, timeout=15)
+            upstream = _abrir_upstream(video_id, stream_url, headers)
 
             # Copiar alguns headers úteis
             response_headers = {}
@@ -231,149 +3273,575 @@ def stream_video_audio(video_id):
                 response_headers['Content-Length'] = content_length
 
             def generate():
+                enviados = 0
+                METRICS.inc('ytapi_active_streams')
                 try:
                     while True:
                         chunk = upstream.read(8192)
                         if not chunk:
                             break
+                        enviados += len(chunk)
                         yield chunk
                 finally:
+                    METRICS.dec('ytapi_active_streams')
+                    METRICS.inc('ytapi_stream_bytes_total', enviados, source='upstream')
                     try:
                         upstream.close()
                     except Exception:
                         pass
 
             return Response(stream_with_context(generate()), headers=response_headers, status=upstream.getcode(), mimetype=content_type)
-            # Suporta Range header enviado pelo navegador
-            headers = {}
-            range_header = request.headers.get('Range')
-            if range_header:
-                headers['Range'] = range_header
 
-            req_up = urllib_request.Request(stream_url, headers=headers)
-            upstream = urllib_request.urlopen(req_up, timeout=15)
+        # Caso de fallback (HLS/DASH): conversão ao vivo para MP3, compartilhada e guardada no cache em disco
+        if STREAM_LIVE_TRANSCODE and FFMPEG_PATH:
+            try:
+                modo, alvo = live_stream_audio(video_id, url, chosen)
+                if modo == 'file':
+                    response = servir_arquivo(alvo, 'audio/mpeg')
+                    if response.content_length:
+                        METRICS.inc('ytapi_stream_bytes_total', response.content_length, source='disk_cache')
+                    return response
+                if alvo.aguardar_inicio():
+                    # Tamanho final ainda desconhecido: resposta 200 desde o byte 0 (Range só depois que o arquivo fecha)
+                    return Response(stream_with_context(alvo.ouvir()), mimetype='audio/mpeg',
+                                    headers={'Cache-Control': 'no-cache'})
+                log.warning("Conversão ao vivo não iniciou para %s; usando download completo", video_id)
+            except Exception as e:
+                log.exception("Erro na conversão ao vivo: %s", e)
 
-            # Copiar alguns headers úteis
-            response_headers = {}
-            content_range = upstream.getheader('Content-Range')
-            if content_range:
-                response_headers['Content-Range'] = content_range
-            accept_ranges = upstream.getheader('Accept-Ranges')
-            if accept_ranges:
-                response_headers['Accept-Ranges'] = accept_ranges
-            content_length = upstream.getheader('Content-Length')
-            if content_length:
-                response_headers['Content-Length'] = content_length
+        # Sem conversão ao vivo: usar yt-dlp para baixar/converter para o cache em disco e servir esse arquivo
+        try:
+            temp_path = get_cached_stream_audio(video_id, url, chosen)
+            content_type = 'audio/mpeg'
 
-            def generate():
-                try:
-                    while True:
-                        chunk = upstream.read(8192)
-                        if not chunk:
-                            break
-                        yield chunk
-                finally:
-                    try:
-                        upstream.close()
-                    except Exception:
-                        pass
+            log.debug("Servindo arquivo do cache: %s", temp_path)
+            # Agora servimos o arquivo com suporte a Range/ETag
+            response = servir_arquivo(temp_path, content_type)
+            if response.content_length:
+                METRICS.inc('ytapi_stream_bytes_total', response.content_length, source='disk_cache')
+            return response
+        except Exception as e:
+            log.exception("Erro no fallback de download com yt-dlp: %s", e)
+            return jsonify({'error': 'Falha ao baixar o áudio via yt-dlp'}), 500
+    except Exception as e:
+        log.exception("Erro no stream proxy: %s", e)
+        return jsonify({'error': str(e)}), 500
 
-            return Response(stream_with_context(generate()), headers=response_headers, status=upstream.getcode(), mimetype=content_type)
+# Aquecimento dos próximos itens da fila do player (/prefetch): resolve o formato e, se pedido,
+# guarda os primeiros segundos do áudio no cache tee. Poucas threads e banda limitada, para não
+# competir com as requisições interativas.
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 1))
+PREFETCH_MAX_ITEMS = int(os.environ.get('PREFETCH_MAX_ITEMS', 5))  # itens por pedido
+PREFETCH_MAX_SECONDS = int(os.environ.get('PREFETCH_MAX_SECONDS', 60))
+PREFETCH_RATE = int(os.environ.get('PREFETCH_RATE', 512 * 1024))  # bytes/s por worker
+PREFETCH_RECENT_TTL = 300  # seconds sem repetir o mesmo vídeo
+PREFETCH_ID_RE = re.compile(r'^[\w-]{1,64}$')
 
-        # Caso de fallback: usar yt-dlp para baixar para arquivo temporário e servir esse arquivo
-        # Isso só deve acontecer para formatos muito específicos que não suportam streaming
-        print(f"Iniciando download temporário para streaming: {chosen.get('format_id')}")
-        try:
-            temp_name = f'stream_{video_id}_{uuid.uuid4().hex[:8]}.mp3'
-            temp_path = os.path.join(DOWNLOAD_FOLDER, temp_name)
-            # Opções otimizadas para streaming rápido
-            ydl_opts_dl = {
-                'format': chosen.get('format_id'),  # Usa exatamente o formato escolhido
-                'outtmpl': temp_path,
-                'quiet': False,  # Mostra progresso para debug
-                'noplaylist': True,
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '128',
-                }] if ext != 'mp3' else [],  # Só converte se não for já mp3
-            }
 
-            print(f"Baixando para arquivo temporário: {temp_path}")
-            with yt_dlp.YoutubeDL(ydl_opts_dl) as ydl:
-                ydl.download([url])
+class Prefetcher:
+    """Fila de aquecimento por cliente, atendida em rodízio.
+    Um pedido novo substitui os itens do mesmo cliente que ainda não começaram (a fila do player mudou).
+    """
 
-            print(f"Download concluído, servindo arquivo: {temp_path}")
-            # Agora servimos o arquivo com suporte a Range
-            file_size = os.path.getsize(temp_path)
-            range_header = request.headers.get('Range')
-            start = 0
-            end = file_size - 1
-            status_code = 200
-            response_headers = {'Accept-Ranges': 'bytes', 'Content-Type': content_type}
-            if range_header:
-                # Range: bytes=start-end
-                try:
-                    m = range_header.replace('bytes=', '').split('-')
-                    if m[0]: start = int(m[0])
-                    if m[1]: end = int(m[1])
-                    status_code = 206
-                    response_headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
-                    response_headers['Content-Length'] = str(end - start + 1)
-                except Exception:
-                    start = 0; end = file_size - 1
-
-            def generate_file():
-                try:
-                    with open(temp_path, 'rb') as f:
-                        f.seek(start)
-                        remaining = end - start + 1
-                        chunk_size = 8192
-                        while remaining > 0:
-                            read_size = min(chunk_size, remaining)
-                            data = f.read(read_size)
-                            if not data:
-                                break
-                            remaining -= len(data)
-                            yield data
-                finally:
-                    # remove temp file
-                    try:
-                        os.remove(temp_path)
-                        print(f"Arquivo temporário removido: {temp_path}")
-                    except Exception:
-                        pass
+    def __init__(self, workers=PREFETCH_WORKERS):
+        self._cond = threading.Condition()
+        self._lanes = OrderedDict()  # { client: deque([(video_id, url, seconds), ...]) }
+        self._recent = {}  # { video_id: (quando, seconds) }
+        self._stats = {'warmed': 0, 'bytes': 0, 'skipped': 0, 'errors': 0}
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f'prefetch-{i}', daemon=True).start()
 
-            return Response(stream_with_context(generate_file()), headers=response_headers, status=status_code, mimetype=content_type)
-        except Exception as e:
-            print(f"Erro no fallback de download com yt-dlp: {e}")
-            return jsonify({'error': 'Falha ao baixar o áudio via yt-dlp'}), 500
-    except Exception as e:
-        print(f"Erro no stream proxy: {e}")
-        return jsonify({'error': str(e)}), 500
+    def agendar(self, client, itens, seconds):
+        """Enfileira [(video_id, url)]; retorna os ids aceitos (os aquecidos há pouco ficam de fora)"""
+        now = time.time()
+        with self._cond:
+            for video_id, (quando, _) in list(self._recent.items()):
+                if now - quando > PREFETCH_RECENT_TTL:
+                    del self._recent[video_id]
+            lane = deque()
+            for video_id, url in itens:
+                recente = self._recent.get(video_id)
+                if recente and recente[1] >= seconds:
+                    self._stats['skipped'] += 1
+                    continue
+                lane.append((video_id, url, seconds))
+            self._lanes.pop(client, None)
+            if lane:
+                self._lanes[client] = lane
+                self._cond.notify_all()
+            return [item[0] for item in lane]
 
-@app.route('/progress/<task_id>')
-def get_progress(task_id):
+    def _next(self):
+        client, lane = next(iter(self._lanes.items()))
+        item = lane.popleft()
+        if lane:
+            self._lanes.move_to_end(client)
+        else:
+            del self._lanes[client]
+        return item
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._lanes:
+                    self._cond.wait()
+                video_id, url, seconds = self._next()
+            try:
+                with METRICS.cronometro('prefetch'):
+                    result = self._aquecer(video_id, url, seconds)
+            except FormatNotFound:
+                result = 'not_found'
+            except Exception as e:
+                log.warning("Prefetch de %s falhou: %s", video_id, e)
+                result = 'error'
+            with self._cond:
+                if result in ('error', 'not_found'):
+                    self._stats['errors'] += 1
+                else:
+                    self._stats['warmed'] += 1
+                    self._recent[video_id] = (time.time(), seconds)
+            METRICS.inc('ytapi_prefetch_total', result=result)
+
+    def _aquecer(self, video_id, url, seconds):
+        chosen = resolve_audio_format(video_id, url)
+        if seconds <= 0 or not STREAM_TEE_CACHE or not chosen.get('streamable'):
+            # HLS/DASH: a conversão ao vivo já começa rápido, só o formato precisa estar pronto
+            return 'format'
+        # Bytes dos primeiros `seconds` pela taxa do formato (kbps -> bytes/s), com folga para o cabeçalho
+        end = int((chosen.get('abr') or 160) * 125 * seconds) + 64 * 1024 - 1
+        rc = abrir_range_cache(_stream_cache_key(video_id, chosen.get('format_id')))
+        try:
+            if rc.complete:
+                return 'cached'
+            if rc.size is None:
+                faltando = [(0, end)]
+            else:
+                faltando = [(a, b) for a, b, local in rc.segmentos(0, min(end, rc.size - 1)) if not local]
+            if not faltando:
+                return 'cached'
+            for a, b in faltando:
+                upstream = _abrir_upstream(video_id, chosen['url'], {'Range': f'bytes={a}-{b}'})
+                offset, total = _tamanho_upstream(upstream)
+                if offset != a or total > STREAM_TEE_MAX_FILE:
+                    upstream.close()
+                    return 'format'
+                rc.definir_tamanho(total)
+                self._baixar_limitado(_repassar_com_tee(upstream, rc, a))
+            return 'audio'
+        finally:
+            fechar_range_cache(rc)
+
+    def _baixar_limitado(self, blocos):
+        """Consome os blocos (já gravados no cache tee) a no máximo PREFETCH_RATE bytes/s"""
+        inicio = time.monotonic()
+        total = 0
+        for chunk in blocos:
+            total += len(chunk)
+            atraso = inicio + total / PREFETCH_RATE - time.monotonic()
+            if atraso > 0:
+                time.sleep(atraso)
+        with self._cond:
+            self._stats['bytes'] += total
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, pending=sum(len(lane) for lane in self._lanes.values()),
+                        clients=len(self._lanes), workers=PREFETCH_WORKERS, rate=PREFETCH_RATE)
+
+
+PREFETCH = Prefetcher()
+
+
+@app.route('/prefetch', methods=['POST'])
+def prefetch_audio():
+    """Aquece os próximos itens da fila do player.
+    Corpo: {"items": [{"id": ..., "url": ...}, ...]} (ou {"ids": [...]}) e "seconds" opcional
+    para guardar também o começo do áudio. Responde 202 na hora; o trabalho segue em segundo plano.
+    """
+    data = request.get_json(silent=True) or {}
+    itens = data.get('items') or [{'id': video_id} for video_id in data.get('ids') or []]
+    if not isinstance(itens, list) or not itens:
+        return jsonify({'error': 'Nenhum item fornecido'}), 400
+    try:
+        seconds = min(max(int(data.get('seconds') or 0), 0), PREFETCH_MAX_SECONDS)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'seconds inválido'}), 400
+    validos = []
+    for item in itens[:PREFETCH_MAX_ITEMS]:
+        video_id = item.get('id') if isinstance(item, dict) else None
+        if not isinstance(video_id, str) or not PREFETCH_ID_RE.match(video_id):
+            return jsonify({'error': f'id inválido: {video_id!r}'}), 400
+        validos.append((video_id, item.get('url') or f'https://www.youtube.com/watch?v={video_id}'))
+    queued = PREFETCH.agendar(client_key(), validos, seconds)
+    return jsonify({'queued': queued, 'seconds': seconds}), 202
+
+
+def meta_tarefa(task_id):
+    """Informações da tarefa que só o worker dono conhece (publicadas junto com o progresso)"""
+    state = PLAYLIST_STATE.get(task_id) or {}
+    return {'zip_stream': bool(state.get('zip_stream')), 'queue_position': SCHEDULER.queue_position(task_id)}
+
+
+def snapshot_progresso(task_id):
+    """Estado atual da tarefa no formato de /progress (+ 'done' quando não haverá mais mudanças)"""
     prog = progress.get(task_id, 0)
     filename = progress.get(f"{task_id}_filename", "")
-    
+
     # Se for playlist, calcular progresso global dinamicamente
     if isinstance(prog, dict) and 'musicas' in prog and 'global' in prog:
         # Calcular progresso global baseado nas músicas individuais
-        if prog['global'] != 100:  # Só recalcular se não estiver 100%
+        prog = dict(prog, musicas=[dict(m) for m in prog['musicas']])
+        if prog['global'] not in (100, -1):  # Só recalcular se não estiver concluído/cancelado
             total_musicas = len(prog['musicas'])
             total_percent = sum(musica['percent'] for musica in prog['musicas'])
             if total_musicas > 0:
-                prog['global'] = total_percent // total_musicas
-    
-    # Log para debug
-    print(f"[DEBUG] Progress request para {task_id}: prog={prog}, filename={filename}")
-    
-    # Se prog é um dicionário (playlist), retorna corretamente
+                prog['global'] = min(total_percent // total_musicas, 99)
+
+    # Tarefa de outro worker: usa o que ele publicou no backend de estado
+    meta = meta_tarefa(task_id) if progress.local(task_id) else progress.meta_remota(task_id)
     if isinstance(prog, dict):
-        return jsonify({'progress': prog, 'filename': filename})
+        done = prog.get('global') == -1 or bool(filename) or (prog.get('global') == 100 and meta.get('zip_stream'))
     else:
-        return jsonify({'progress': prog, 'filename': filename})
+        done = prog == -1 or bool(filename)
+
+    # Posição na fila do agendador (0 = em execução, None = fora da fila)
+    queue_position = meta.get('queue_position')
+    return {'progress': prog, 'filename': filename, 'queue_position': queue_position, 'done': done}
+
+
+@app.route('/progress/<task_id>')
+def get_progress(task_id):
+    snapshot = snapshot_progresso(task_id)
+    del snapshot['done']
+    return jsonify(snapshot)
+
+
+SSE_KEEPALIVE = 15  # seconds
+
+
+@app.route('/progress/<task_id>/stream')
+def stream_progress(task_id):
+    """Server-Sent Events: envia o estado da tarefa só quando ele muda e fecha quando ela termina"""
+    if task_id not in progress:
+        return jsonify({'error': 'Tarefa não encontrada'}), 404
+
+    def generate():
+        last = None
+        last_sent = time.time()
+        while True:
+            snapshot = snapshot_progresso(task_id)
+            payload = json.dumps(snapshot)
+            if payload != last:
+                last = payload
+                last_sent = time.time()
+                yield f"data: {payload}\n\n"
+            elif time.time() - last_sent > SSE_KEEPALIVE:
+                last_sent = time.time()
+                yield ": ping\n\n"
+            if snapshot['done'] or task_id not in progress:
+                return
+            with TASK_COND:
+                TASK_COND.wait(0.5)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _task_store_janitor():
+    while True:
+        time.sleep(30)
+        try:
+            progress.purge()
+        except Exception as e:
+            log.exception("Erro ao limpar tarefas antigas: %s", e)
+
+
+threading.Thread(target=_task_store_janitor, daemon=True).start()
+
+
+def _sincronizar_estado():
+    """Com backend compartilhado: publica o progresso deste processo e aplica cancelamentos pedidos em outros workers"""
+    ultima_limpeza = time.time()
+    while True:
+        time.sleep(STATE_SYNC_INTERVAL)
+        try:
+            for task_id in progress.sincronizar():
+                if STATE.get('cancel', task_id):
+                    STATE.delete('cancel', task_id)
+                    cancelar_tarefa_local(task_id)
+            if time.time() - ultima_limpeza > 60:
+                ultima_limpeza = time.time()
+                STATE.limpar()
+        except Exception as e:
+            log.exception("Erro ao sincronizar o backend de estado: %s", e)
+
+
+if STATE.compartilhado:
+    threading.Thread(target=_sincronizar_estado, name='state-sync', daemon=True).start()
+
+
+def detectar_playlist(link):
+    """Retorna (is_playlist, playlist_link) para o link recebido"""
+    is_playlist = 'playlist' in link or 'list=' in link
+    playlist_id = None
+    if 'list=' in link:
+        match = re.search(r'list=([A-Za-z0-9_-]+)', link)
+        if match:
+            playlist_id = match.group(1)
+    if is_playlist and playlist_id:
+        return True, f'https://www.youtube.com/playlist?list={playlist_id}'
+    return False, link
+
+
+def processar_tarefa(task_id, link, client, zip_stream=False, offset=0, limit=None, profile=DEFAULT_PROFILE):
+    """Primeiro passo de uma tarefa do /baixar (roda dentro do agendador)"""
+    delegated = False
+    try:
+        # Usa detecção automática do FFmpeg
+        if not FFMPEG_PATH:
+            log.error("FFmpeg não encontrado!")
+            progress[task_id] = -1
+            return
+
+        progress[task_id] = 10
+        cancel_event = SCHEDULER.cancel_event(task_id)
+
+        # Detecta se é playlist e monta link correto
+        is_playlist, playlist_link = detectar_playlist(link)
+
+        if not is_playlist:
+            # Download de vídeo único
+            def on_progress(percent):
+                progress[task_id] = percent
+            future = baixar_converter_async(link, on_progress=on_progress, cancel_event=cancel_event, profile=profile)
+            future.add_done_callback(lambda f: finalizar_tarefa(task_id, False, [f.result()] if f.result() else []))
+            delegated = True
+            return
+
+        # Músicas entram na fila à medida que a playlist é lida (sem guardar a playlist inteira em memória)
+        # Cada música vira um job do agendador global (prioridade menor que vídeos únicos)
+        progress[task_id] = {'global': 0, 'musicas': []}
+        state = {'restantes': 0, 'arquivos': [], 'lock': threading.Lock(), 'zip_stream': zip_stream, 'extraindo': True,
+                 'profile': profile}
+        with TASK_COND:
+            PLAYLIST_STATE[task_id] = state
+            TASK_COND.notify_all()
+        total = 0
+        try:
+            log.debug("Iniciando extração da playlist: %s", playlist_link)
+            entradas = iterar_playlist(playlist_link, offset, limit)
+            next(entradas)  # cabeçalho com o título da playlist
+            for item in entradas:
+                if cancel_event.is_set():
+                    break
+                idx = total
+                with state['lock']:
+                    progress[task_id]['musicas'].append({'title': item['title'], 'percent': 0})
+                    state['arquivos'].append(None)
+                    state['restantes'] += 1
+                SCHEDULER.submit(task_id, client, PRIORITY_PLAYLIST,
+                                 lambda idx=idx, url=item['url']: baixar_faixa_playlist(task_id, idx, url, state),
+                                 force=True)
+                total += 1
+        except Exception as e:
+            log.exception("Falha na análise da playlist: %s", e)
+        finally:
+            with state['lock']:
+                state['extraindo'] = False
+                ultima = state['restantes'] == 0
+            notificar_tarefa()
+        if total == 0:
+            log.error("Nenhuma entrada válida encontrada na playlist: %s", playlist_link)
+            progress[task_id] = -1
+            return
+        if ultima:
+            # Todas as músicas terminaram antes do fim da leitura da playlist
+            finalizar_playlist(task_id, state)
+        delegated = True
+    except Exception as e:
+        log.exception("Erro geral no processamento: %s", e)
+        progress[task_id] = -1
+    finally:
+        if not delegated:
+            SCHEDULER.forget(task_id)
+            notificar_tarefa()
+
+
+def baixar_faixa_playlist(task_id, idx, video_url, state):
+    """Job de uma música da playlist: baixa aqui e deixa a conversão para o TRANSCODE_POOL"""
+    musica = progress[task_id]['musicas'][idx]
+
+    def on_progress(percent):
+        musica['percent'] = percent
+    try:
+        future = baixar_converter_async(video_url, title=musica['title'], on_progress=on_progress,
+                                        cancel_event=SCHEDULER.cancel_event(task_id), profile=state['profile'])
+    except Exception:
+        future = _done_future(None)
+    future.add_done_callback(lambda f: concluir_faixa_playlist(task_id, idx, f.result(), state))
+
+
+def concluir_faixa_playlist(task_id, idx, out_path, state):
+    if out_path:
+        musica = progress[task_id]['musicas'][idx]
+        musica['percent'] = 100
+        musica['filename'] = os.path.basename(out_path)
+    with state['lock']:
+        state['arquivos'][idx] = out_path
+        state['restantes'] -= 1
+        ultima = state['restantes'] == 0 and not state['extraindo']
+    notificar_tarefa()
+    # Só finaliza depois que TODAS as músicas terminaram
+    if ultima:
+        finalizar_playlist(task_id, state)
+
+
+def finalizar_playlist(task_id, state):
+    arquivos_mp3 = [a for a in state['arquivos'] if a]
+    log.debug("Todas as tarefas concluídas. %s arquivos processados.", len(arquivos_mp3))
+    finalizar_tarefa(task_id, True, arquivos_mp3)
+
+
+def finalizar_tarefa(task_id, is_playlist, arquivos_mp3):
+    try:
+        if SCHEDULER.cancel_event(task_id).is_set():
+            return
+        log.debug("is_playlist: %s, arquivos_mp3: %s", is_playlist, len(arquivos_mp3) if arquivos_mp3 else 0)
+        if is_playlist and arquivos_mp3 and PLAYLIST_STATE.get(task_id, {}).get('zip_stream'):
+            # ZIP já é entregue por /zip/<task_id> à medida que as músicas ficam prontas
+            progress[task_id]['global'] = 100
+        elif is_playlist and arquivos_mp3:
+            zip_name = f'playlist_{task_id[:8]}.zip'
+            zip_path = os.path.join(DOWNLOAD_FOLDER, zip_name)
+            log.debug("Criando ZIP: %s", zip_path)
+            log.debug("Arquivos MP3 para ZIP: %s", arquivos_mp3)
+            with zipfile.ZipFile(zip_path, 'w') as zipf, METRICS.cronometro('zip'):
+                for mp3 in arquivos_mp3:
+                    if os.path.isfile(mp3):
+                        zipf.write(mp3, nome_exibicao(os.path.basename(mp3)))
+                        log.debug("Adicionado ao ZIP: %s", os.path.basename(mp3))
+                    else:
+                        log.debug("Arquivo não encontrado: %s", mp3)
+            log.debug("ZIP criado com sucesso: %s", zip_path)
+            biblioteca_registrar(zip_path, title=zip_name)
+            STORAGE.acordar()
+            progress[task_id]['global'] = 100
+            progress[f"{task_id}_filename"] = zip_name
+            log.debug("Filename definido: %s para task_id: %s", zip_name, task_id)
+        elif arquivos_mp3:
+            progress[task_id] = 100
+            progress[f"{task_id}_filename"] = os.path.basename(arquivos_mp3[0])
+        else:
+            log.debug("Nenhum arquivo MP3 foi gerado")
+            if is_playlist:
+                progress[task_id]['global'] = -1
+            else:
+                progress[task_id] = -1
+    except Exception as e:
+        log.exception("Erro geral no processamento: %s", e)
+        progress[task_id] = -1
+    finally:
+        SCHEDULER.forget(task_id)
+        notificar_tarefa()
+
+
+def notificar_tarefa():
+    """Acorda quem espera mudanças de estado das tarefas (ex.: /zip em streaming)"""
+    with TASK_COND:
+        TASK_COND.notify_all()
+
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """Destino não-seekable do ZipFile: acumula os bytes escritos até o gerador drená-los"""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def _tarefa_terminada(task_id, state):
+    prog = progress.get(task_id)
+    if prog == -1 or (isinstance(prog, dict) and prog.get('global') == -1):
+        return True
+    return state is not None and state['restantes'] == 0 and not state['extraindo']
+
+
+def gerar_zip_stream(task_id):
+    """Gera o ZIP da playlist enquanto as músicas terminam (entradas sem compressão, nenhum arquivo intermediário)"""
+    buf = _ZipStreamBuffer()
+    enviados = set()
+    with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zipf:
+        while True:
+            with TASK_COND:
+                state = PLAYLIST_STATE.get(task_id)
+                terminado = _tarefa_terminada(task_id, state)
+                prontos = [] if state is None else [(i, a) for i, a in enumerate(state['arquivos']) if a and i not in enviados]
+                if not prontos and not terminado:
+                    TASK_COND.wait(1.0)
+                    continue
+            for idx, mp3 in prontos:
+                enviados.add(idx)
+                try:
+                    st = os.stat(mp3)
+                    src = open(mp3, 'rb')
+                except OSError as e:
+                    log.warning("Arquivo não encontrado para o ZIP: %s (%s)", mp3, e)
+                    continue
+                with STORAGE.em_uso(mp3), src:
+                    zinfo = zipfile.ZipInfo(nome_exibicao(os.path.basename(mp3)), date_time=time.localtime(st.st_mtime)[:6])
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                    zinfo.file_size = st.st_size
+                    with zipf.open(zinfo, 'w') as dst:
+                        while True:
+                            chunk = src.read(PIPELINE_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dst.write(chunk)
+                            yield from buf.drain()
+                yield from buf.drain()
+            if terminado and not prontos:
+                break
+    # Diretório central
+    yield from buf.drain()
+
+
+@app.route('/zip/<task_id>')
+def download_zip_stream(task_id):
+    if task_id not in progress:
+        return jsonify({'error': 'Tarefa não encontrada'}), 404
+    if not progress.local(task_id):
+        # As músicas prontas só são conhecidas pelo processo que executa a tarefa
+        return jsonify({'error': 'ZIP em streaming disponível apenas no worker que executa a tarefa'}), 409
+    zip_name = f'playlist_{task_id[:8]}.zip'
+    return Response(stream_with_context(gerar_zip_stream(task_id)), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{zip_name}"'})
+
+
+def client_key():
+    """Identifica o cliente para a fila justa do agendador"""
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return request.remote_addr or 'anon'
+
 
 @app.route('/baixar', methods=['POST'])
 def baixar_audio():
@@ -384,377 +3852,92 @@ def baixar_audio():
     
     # Resposta instantânea
     task_id = str(uuid.uuid4())
+    client = client_key()
+    is_playlist, _ = detectar_playlist(link)
+    # zip=stream: a playlist é baixada por /zip/<task_id> enquanto as músicas ficam prontas
+    zip_stream = is_playlist and data.get('zip') == 'stream'
+    try:
+        offset, limit = parametros_pagina(data, PLAYLIST_MAX_TRACKS)
+    except ValueError:
+        return jsonify({'error': 'offset/limit inválidos'}), 400
+    # Perfil de saída: mp3-128 (padrão), mp3-320, m4a (aac) ou opus
+    try:
+        profile = resolver_perfil(data.get('profile'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not is_playlist:
+        # Música já convertida antes: responde na hora, sem passar pelo agendador
+        video_id = extrair_video_id(link)
+        pronto = saida_pronta((video_id, profile)) if video_id else None
+        if pronto:
+            progress[task_id] = 100
+            progress[f"{task_id}_filename"] = os.path.basename(pronto)
+            return jsonify({'task_id': task_id, 'filename': os.path.basename(pronto)})
+    priority = PRIORITY_PLAYLIST if is_playlist else PRIORITY_SINGLE
     progress[task_id] = 5
+    try:
+        # Processamento em background pelo agendador global
+        SCHEDULER.submit(task_id, client, priority,
+                         lambda: processar_tarefa(task_id, link, client, zip_stream, offset, limit, profile))
+    except QueueFull:
+        del progress[task_id]
+        return jsonify({'error': 'Servidor ocupado, tente novamente em instantes'}), 503, {'Retry-After': str(JOB_RETRY_AFTER)}
     
-    def process():
-        try:
-            # Usa detecção automática do FFmpeg
-            ffmpeg_path = FFMPEG_PATH
-            if not ffmpeg_path:
-                print("[ERRO] FFmpeg não encontrado!")
-                progress[task_id] = -1
-                return
+    # Resposta imediata
+    response = {'task_id': task_id, 'queue_position': SCHEDULER.queue_position(task_id)}
+    if zip_stream:
+        response['zip_url'] = f'/zip/{task_id}'
+    return jsonify(response)
 
-            progress[task_id] = 10
-
-            # Detecta se é playlist e monta link correto
-            is_playlist = 'playlist' in link or 'list=' in link
-            playlist_id = None
-            if 'list=' in link:
-                match = re.search(r'list=([A-Za-z0-9_-]+)', link)
-                if match:
-                    playlist_id = match.group(1)
-            if is_playlist and playlist_id:
-                playlist_link = f'https://www.youtube.com/playlist?list={playlist_id}'
-            else:
-                playlist_link = link
 
-            if is_playlist and playlist_id:
-                # Extrai 20 músicas da playlist
-                try:
-                    print(f"[DEBUG] Iniciando extração da playlist: {playlist_link}")
-                    with yt_dlp.YoutubeDL({'quiet': False, 'extract_flat': True, 'playlist_end': 20}) as ydl:
-                        info = ydl.extract_info(playlist_link, download=False)
-                    print(f"[DEBUG] Info extraído: {info}")
-                    raw_entries = info.get('entries', [])[:20]
-                    print(f"[DEBUG] Entradas encontradas: {raw_entries}")
-                    entries = []
-                    titles = []
-                    for entry in raw_entries:
-                        print(f"[DEBUG] Processando entrada: {entry}")
-                        if entry and (entry.get('url') or entry.get('id')):
-                            url = entry.get('url') or entry.get('id')
-                            if not url.startswith('http'):
-                                url = f"https://www.youtube.com/watch?v={url}"
-                            entries.append(url)
-                            titles.append(entry.get('title', url))
-                    if not entries:
-                        print("[ERRO] Nenhuma entrada válida encontrada na playlist. Info extraído:")
-                        print(info)
-                        progress[task_id] = -1
-                        return
-                    # Inicializa progresso individual
-                    progress[task_id] = {'global': 0, 'musicas': [{'title': t, 'percent': 0} for t in titles]}
-                except Exception as e:
-                    print(f"[ERRO] Falha na análise da playlist: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    progress[task_id] = -1
-                    return
-            else:
-                entries = [link]
-                
-            arquivos_mp3 = []
-            total = len(entries)
-            completed = 0
-
-            def baixar_converter_playlist(idx, video_url, title):
-                temp_id = str(uuid.uuid4())[:8]
-                try:
-                    def progress_hook(d):
-                        if d['status'] == 'downloading':
-                            percent = d.get('downloaded_bytes', 0) / max(d.get('total_bytes', d.get('total_bytes_estimate', 1)), 1)
-                            progress[task_id]['musicas'][idx]['percent'] = int(percent * 80)
-                        elif d['status'] == 'finished':
-                            progress[task_id]['musicas'][idx]['percent'] = 80
-
-                    ydl_opts = {
-                        'format': 'bestaudio/best',
-                        'outtmpl': os.path.join(DOWNLOAD_FOLDER, f'temp_{temp_id}.%(ext)s'),
-                        'quiet': True,
-                        'ffmpeg_location': ffmpeg_path,
-                        'noplaylist': True,
-                        'writeinfojson': False,
-                        'writethumbnail': False,
-                        'extract_flat': False,
-                        'progress_hooks': [progress_hook],
-                    }
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        info = ydl.extract_info(video_url, download=True)
-                    if not info:
-                        print(f"Não foi possível extrair informações para: {video_url}")
-                        return None
-                    safe_title = re.sub(r'[^\w\-_\. ]', '_', title)[:60]
-                    temp_files = [f for f in os.listdir(DOWNLOAD_FOLDER) if f.startswith(f'temp_{temp_id}')]
-                    if not temp_files:
-                        print(f"Arquivo temporário não encontrado para: {temp_id}")
-                        return None
-                    audio_path = os.path.join(DOWNLOAD_FOLDER, temp_files[0])
-                    mp3_path = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_{temp_id}.mp3")
-                    def get_duration(path):
-                        try:
-                            result = subprocess.run([
-                                ffmpeg_path, '-i', path
-                            ], stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
-                            match = re.search(r'Duration: (\d+):(\d+):(\d+\.\d+)', result.stderr)
-                            if match:
-                                h, m, s = match.groups()
-                                return int(h) * 3600 + int(m) * 60 + float(s)
-                        except Exception:
-                            pass
-                        return None
-                    total_duration = get_duration(audio_path)
-                    if not total_duration:
-                        total_duration = 1
-                    cmd = [
-                        ffmpeg_path, '-i', audio_path, '-vn', '-ar', '44100', '-ac', '2', '-ab', '128k', mp3_path
-                    ]
-                    process = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True, encoding='utf-8', errors='replace')
-                    for line in process.stderr:
-                        time_match = re.search(r'time=(\d+):(\d+):(\d+\.\d+)', line)
-                        if time_match:
-                            h, m, s = time_match.groups()
-                            current = int(h) * 3600 + int(m) * 60 + float(s)
-                            percent = min(1.0, current / total_duration)
-                            progress[task_id]['musicas'][idx]['percent'] = 80 + int(percent * 19)
-                    process.wait()
-                    try:
-                        os.remove(audio_path)
-                    except Exception as cleanup_error:
-                        print(f"Erro ao remover arquivo temporário: {cleanup_error}")
-                    if process.returncode == 0 and os.path.isfile(mp3_path):
-                        progress[task_id]['musicas'][idx]['percent'] = 100
-                        progress[task_id]['musicas'][idx]['filename'] = os.path.basename(mp3_path)
-                        return mp3_path
-                    else:
-                        print(f"Erro na conversão FFmpeg: {process.stderr}")
-                        return None
-                except Exception as e:
-                    print(f"Erro ao processar {video_url}: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    return None
+@app.route('/cancel/<task_id>', methods=['POST'])
+def cancel_task(task_id):
+    if task_id not in progress:
+        return jsonify({'error': 'Tarefa não encontrada'}), 404
+    if progress.local(task_id):
+        cancelled = cancelar_tarefa_local(task_id)
+    elif snapshot_progresso(task_id)['done']:
+        cancelled = False
+    else:
+        # Tarefa de outro worker: ele aplica o cancelamento na próxima sincronização
+        STATE.set('cancel', task_id, True, TASK_TTL)
+        cancelled = True
+    return jsonify({'task_id': task_id, 'cancelled': cancelled})
 
-            # Funções definidas, agora executar lógica de download
-            if is_playlist:
-                # Download de vídeo único
-                def baixar_converter_simples(video_url):
-                    temp_id = str(uuid.uuid4())[:8]
-                    try:
-                        def progress_hook(d):
-                            if d['status'] == 'downloading':
-                                percent = d.get('downloaded_bytes', 0) / max(d.get('total_bytes', d.get('total_bytes_estimate', 1)), 1)
-                                progress[task_id] = int(percent * 80)
-                            elif d['status'] == 'finished':
-                                progress[task_id] = 80
-                        ydl_opts = {
-                            'format': 'bestaudio/best',
-                            'outtmpl': os.path.join(DOWNLOAD_FOLDER, f'temp_{temp_id}.%(ext)s'),
-                            'quiet': True,
-                            'ffmpeg_location': ffmpeg_path,
-                            'noplaylist': True,
-                            'writeinfojson': False,
-                            'writethumbnail': False,
-                            'extract_flat': False,
-                            'progress_hooks': [progress_hook],
-                        }
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            info = ydl.extract_info(video_url, download=True)
-                        if not info:
-                            print(f"Não foi possível extrair informações para: {video_url}")
-                            return None
-                        import re
-                        safe_title = re.sub(r'[^\w\-_\. ]', '_', info.get('title', f'audio_{temp_id}'))[:60]
-                        temp_files = [f for f in os.listdir(DOWNLOAD_FOLDER) if f.startswith(f'temp_{temp_id}')]
-                        if not temp_files:
-                            print(f"Arquivo temporário não encontrado para: {temp_id}")
-                            return None
-                        audio_path = os.path.join(DOWNLOAD_FOLDER, temp_files[0])
-                        mp3_path = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_{temp_id}.mp3")
-                        import subprocess
-                        def get_duration(path):
-                            try:
-                                result = subprocess.run([
-                                    ffmpeg_path, '-i', path
-                                ], stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
-                                match = re.search(r'Duration: (\d+):(\d+):(\d+\.\d+)', result.stderr)
-                                if match:
-                                    h, m, s = match.groups()
-                                    return int(h) * 3600 + int(m) * 60 + float(s)
-                            except Exception:
-                                pass
-                            return None
-                        total_duration = get_duration(audio_path)
-                        if not total_duration:
-                            total_duration = 1
-                        cmd = [
-                            ffmpeg_path, '-i', audio_path, '-vn', '-ar', '44100', '-ac', '2', '-ab', '128k', mp3_path
-                        ]
-                        process = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
-                        for line in process.stderr:
-                            time_match = re.search(r'time=(\d+):(\d+):(\d+\.\d+)', line)
-                            if time_match:
-                                h, m, s = time_match.groups()
-                                current = int(h) * 3600 + int(m) * 60 + float(s)
-                                percent = min(1.0, current / total_duration)
-                                progress[task_id] = 80 + int(percent * 19)
-                        process.wait()
-                        try:
-                            os.remove(audio_path)
-                        except Exception as cleanup_error:
-                            print(f"Erro ao remover arquivo temporário: {cleanup_error}")
-                        if process.returncode == 0 and os.path.isfile(mp3_path):
-                            progress[task_id] = 100
-                            return mp3_path
-                        else:
-                            print(f"Erro na conversão FFmpeg: {process.stderr}")
-                            return None
-                    except Exception as e:
-                        print(f"Erro ao processar {video_url}: {e}")
-                        import traceback
-                        traceback.print_exc()
-                        return None
-            
-            # Download de playlist com até 3 simultâneos
-            if is_playlist:
-                from concurrent.futures import ThreadPoolExecutor, as_completed
-                with ThreadPoolExecutor(max_workers=3) as executor:
-                    futures = [executor.submit(baixar_converter_playlist, idx, url, progress[task_id]['musicas'][idx]['title']) for idx, url in enumerate(entries)]
-                    for future in as_completed(futures):
-                        mp3 = future.result()
-                        if mp3:
-                            arquivos_mp3.append(mp3)
-                # Só marca como 100% depois que TODAS as tarefas terminaram
-                print(f"[DEBUG] Todas as tarefas concluídas. {len(arquivos_mp3)} arquivos processados.")
-                progress[task_id]['global'] = 100
-            else:
-                # Download de vídeo único
-                def baixar_converter_simples(video_url):
-                    temp_id = str(uuid.uuid4())[:8]
-                    try:
-                        def progress_hook(d):
-                            if d['status'] == 'downloading':
-                                percent = d.get('downloaded_bytes', 0) / max(d.get('total_bytes', d.get('total_bytes_estimate', 1)), 1)
-                                progress[task_id] = int(percent * 80)
-                            elif d['status'] == 'finished':
-                                progress[task_id] = 80
-                        ydl_opts = {
-                            'format': 'bestaudio/best',
-                            'outtmpl': os.path.join(DOWNLOAD_FOLDER, f'temp_{temp_id}.%(ext)s'),
-                            'quiet': True,
-                            'ffmpeg_location': ffmpeg_path,
-                            'noplaylist': True,
-                            'writeinfojson': False,
-                            'writethumbnail': False,
-                            'extract_flat': False,
-                            'progress_hooks': [progress_hook],
-                        }
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                            info = ydl.extract_info(video_url, download=True)
-                        if not info:
-                            print(f"Não foi possível extrair informações para: {video_url}")
-                            return None
-                        import re
-                        safe_title = re.sub(r'[^\w\-_\. ]', '_', info.get('title', f'audio_{temp_id}'))[:60]
-                        temp_files = [f for f in os.listdir(DOWNLOAD_FOLDER) if f.startswith(f'temp_{temp_id}')]
-                        if not temp_files:
-                            print(f"Arquivo temporário não encontrado para: {temp_id}")
-                            return None
-                        audio_path = os.path.join(DOWNLOAD_FOLDER, temp_files[0])
-                        mp3_path = os.path.join(DOWNLOAD_FOLDER, f"{safe_title}_{temp_id}.mp3")
-                        import subprocess
-                        def get_duration(path):
-                            try:
-                                result = subprocess.run([
-                                    ffmpeg_path, '-i', path
-                                ], stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
-                                match = re.search(r'Duration: (\d+):(\d+):(\d+\.\d+)', result.stderr)
-                                if match:
-                                    h, m, s = match.groups()
-                                    return int(h) * 3600 + int(m) * 60 + float(s)
-                            except Exception:
-                                pass
-                            return None
-                        total_duration = get_duration(audio_path)
-                        if not total_duration:
-                            total_duration = 1
-                        cmd = [
-                            ffmpeg_path, '-i', audio_path, '-vn', '-ar', '44100', '-ac', '2', '-ab', '128k', mp3_path
-                        ]
-                        process = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
-                        for line in process.stderr:
-                            time_match = re.search(r'time=(\d+):(\d+):(\d+\.\d+)', line)
-                            if time_match:
-                                h, m, s = time_match.groups()
-                                current = int(h) * 3600 + int(m) * 60 + float(s)
-                                percent = min(1.0, current / total_duration)
-                                progress[task_id] = 80 + int(percent * 19)
-                        process.wait()
-                        try:
-                            os.remove(audio_path)
-                        except Exception as cleanup_error:
-                            print(f"Erro ao remover arquivo temporário: {cleanup_error}")
-                        if process.returncode == 0 and os.path.isfile(mp3_path):
-                            progress[task_id] = 100
-                            return mp3_path
-                        else:
-                            print(f"Erro na conversão FFmpeg: {process.stderr}")
-                            return None
-                    except Exception as e:
-                        print(f"Erro ao processar {video_url}: {e}")
-                        import traceback
-                        traceback.print_exc()
-                        return None
-                mp3 = baixar_converter_simples(entries[0])
-                if mp3:
-                    arquivos_mp3.append(mp3)
-            
-            # Finalização
-            print(f"[DEBUG] is_playlist: {is_playlist}, arquivos_mp3: {len(arquivos_mp3) if arquivos_mp3 else 0}")
-            if is_playlist and arquivos_mp3:
-                zip_name = f'playlist_{task_id[:8]}.zip'
-                zip_path = os.path.join(DOWNLOAD_FOLDER, zip_name)
-                print(f"[DEBUG] Criando ZIP: {zip_path}")
-                print(f"[DEBUG] Arquivos MP3 para ZIP: {arquivos_mp3}")
-                with zipfile.ZipFile(zip_path, 'w') as zipf:
-                    for mp3 in arquivos_mp3:
-                        if os.path.isfile(mp3):
-                            zipf.write(mp3, os.path.basename(mp3))
-                            print(f"[DEBUG] Adicionado ao ZIP: {os.path.basename(mp3)}")
-                        else:
-                            print(f"[DEBUG] Arquivo não encontrado: {mp3}")
-                print(f"[DEBUG] ZIP criado com sucesso: {zip_path}")
-                progress[task_id]['global'] = 100
-                progress[f"{task_id}_filename"] = zip_name
-                print(f"[DEBUG] Filename definido: {zip_name} para task_id: {task_id}")
-            elif arquivos_mp3:
-                progress[task_id] = 100
-                progress[f"{task_id}_filename"] = os.path.basename(arquivos_mp3[0])
-            else:
-                print("[DEBUG] Nenhum arquivo MP3 foi gerado")
-                if is_playlist:
-                    progress[task_id]['global'] = -1
-                else:
-                    progress[task_id] = -1
-                
-        except Exception as e:
-            print(f"Erro geral no processamento: {e}")
-            import traceback
-            traceback.print_exc()
-            progress[task_id] = -1
-    
-    # Inicia processamento em background
-    threading.Thread(target=process).start()
-    
-    # Resposta imediata
-    return jsonify({'task_id': task_id})
+
+def cancelar_tarefa_local(task_id):
+    """Cancela a tarefa deste processo. False se ela já tinha terminado (concluída ou com erro): o estado fica como está"""
+    if progress.is_finished(task_id) or progress.get(f"{task_id}_filename"):
+        return False
+    SCHEDULER.cancel(task_id)
+    prog = progress.get(task_id)
+    if isinstance(prog, dict):
+        prog['global'] = -1
+    else:
+        progress[task_id] = -1
+    notificar_tarefa()
+    return True
 
 @app.route('/download/<filename>')
 def download_file(filename):
     filepath = os.path.join(DOWNLOAD_FOLDER, filename)
-    if os.path.isfile(filepath):
-        response = send_file(filepath, as_attachment=True, download_name=filename)
-        # Agenda remoção do arquivo após download
-        return response
+    # Só as saídas finais: nada de arquivos internos (.part, bancos, caches) que estejam na pasta
+    if filename.lower().endswith(OUTPUT_EXTS) and os.path.isfile(filepath):
+        biblioteca_acesso(filename)
+        ext = os.path.splitext(filename)[1][1:].lower()
+        mimetype = {'zip': 'application/zip', 'opus': 'audio/ogg'}.get(ext) or content_type_for_ext(ext)
+        return servir_arquivo(filepath, mimetype, download_name=nome_exibicao(filename))
     return jsonify({'error': 'Arquivo não encontrado'}), 404
 
+threading.Thread(target=STORAGE.run, name='storage-manager', daemon=True).start()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     debug = os.environ.get("DEBUG", "false").lower() == "true"
     host = "0.0.0.0" if os.environ.get("PRODUCTION") else "127.0.0.1"
     
-    print(f"Iniciando servidor na porta {port}")
-    print(f"Debug: {debug}")
-    print(f"Host: {host}")
+    log.info("Iniciando servidor na porta %s", port)
+    log.info("Debug: %s", debug)
+    log.info("Host: %s", host)
     
     app.run(host=host, port=port, debug=debug)
@@ -65,9 +65,6 @@ function App(){
     return title.includes(searchTerm) || id.includes(searchTerm);
   });
 
-  // prefetch state: avoid duplicate prefetches
-  const prefetchingRef = useRef(new Set()); // holds ids being prefetched
-
   const isCached = (id)=> cachedList.some(i=> i.id === id);
 
   const refreshCachedList = async ()=>{
@@ -78,64 +75,17 @@ function App(){
   }
 
   // Prefetch the next `count` tracks from the queue (default 3)
-  const prefetchNext = async (count = 3) => {
-    console.log('🔄 prefetchNext chamado com count:', count, 'queueIndex:', queueIndex, 'queue.length:', queue?.length);
+  // Só aquece no servidor (formato resolvido + começo do áudio no cache dele): baixar as próximas faixas inteiras
+  // para o IndexedDB aqui disputaria banda com a música que está tocando. O IndexedDB guarda cada faixa quando
+  // ela é tocada (playItem) ou salva offline.
+  const prefetchNext = (count = 3) => {
     try{
-      if(!queue || queue.length===0) {
-        console.log('❌ prefetchNext: queue vazia ou inexistente');
-        return;
-      }
+      if(!queue || queue.length===0) return;
       const start = (queueIndex >= 0) ? queueIndex + 1 : 0;
-      console.log('📋 prefetchNext: processando de', start, 'até', Math.min(queue.length, start + count));
-
-      for(let i = start; i < Math.min(queue.length, start + count); i++){
-        const it = queue[i];
-        if(!it) {
-          console.log('⚠️ prefetchNext: item', i, 'é null/undefined');
-          continue;
-        }
-        console.log('🎵 prefetchNext: verificando item', i, '-', it.title, '(ID:', it.id + ')');
-
-        // already cached? (checa diretamente no IDB para evitar estado desatualizado)
-        try{
-          const existing = await idb.getBlob(it.id);
-          if(existing) {
-            console.log('✅ prefetchNext: item já em cache', it.id);
-            continue;
-          }
-        }catch(e){ /* ignore and continue */ }
-
-        // already being prefetched?
-        if(prefetchingRef.current.has(it.id)) {
-          console.log('⏳ prefetchNext: item já sendo prefetched', it.id);
-          continue;
-        }
-
-        // need a source URL to fetch
-        if(!it.url) {
-          console.log('❌ prefetchNext: item sem URL', it.id);
-          continue;
-        }
-
-        prefetchingRef.current.add(it.id);
-        console.info('🚀 Prefetch: INICIANDO', it.id, it.title);
-  const streamUrl = `${API_BASE}/  con  const API_BASE = 'https://diskmen.onrender.com';tream/${it.id}?url=${encodeURIComponent(it.url)}`;
-
-        // start save in background; don't await to avoid blocking
-        saveFromFetch(it.id, streamUrl, { 
-          title: it.title,
-          thumbnail: it.thumbnail || buildYouTubeThumb(it)
-        }).then(async ()=>{
-          try{ const obj = await getObjectURL(it.id); if(obj){ setCachedURLs(prev=>({ ...prev, [it.id]: obj })); } }catch(e){}
-          try{ await refreshCachedList(); }catch(e){}
-          console.info('✅ Prefetch: CONCLUÍDO', it.id);
-        }).catch((err)=>{
-          console.warn('❌ Prefetch: FALHOU', it.id, err);
-        }).finally(()=>{
-          prefetchingRef.current.delete(it.id);
-          console.log('🧹 prefetchNext: removido da lista de prefetching', it.id);
-        });
-      }
+      const upcoming = queue.slice(start, start + count).filter(it => it && it.id && !isCached(it.id));
+      if(!upcoming.length) return;
+      console.log('🔄 prefetchNext: aquecendo no servidor', upcoming.map(it => it.id));
+      fetch(`${API_BASE}/prefetch`,{ method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({ items: upcoming.map(it=>({ id: it.id, url: it.url })), seconds: 30 }) }).catch(()=>{});
     }catch(e){ console.warn('❌ Erro em prefetchNext', e); }
   }
 
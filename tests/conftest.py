@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# server_full cria downloads/ e o índice SQLite no diretório atual ao ser importado
+os.chdir(tempfile.mkdtemp(prefix='ytapi-tests-'))
@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+import pytest
+
+import benchmark
+
+server_full = pytest.importorskip('server_full')
+server_asgi = pytest.importorskip('server_asgi')
+
+
+async def chamar(app, path, primeiro_bloco=None, desconectar=None, headers=()):
+    """Executa uma requisição GET no app ASGI; retorna (status, corpo)"""
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+        'headers': [(b'host', b'testserver')] + list(headers), 'server': ('testserver', 80),
+        'client': ('127.0.0.1', 5555),
+    }
+    pedido_enviado = False
+    resposta = {'status': None, 'body': b''}
+
+    async def receive():
+        nonlocal pedido_enviado
+        if not pedido_enviado:
+            pedido_enviado = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        if desconectar is not None:
+            await desconectar.wait()
+        else:
+            await asyncio.Event().wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            resposta['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            resposta['body'] += message.get('body', b'')
+            if primeiro_bloco is not None and resposta['body']:
+                primeiro_bloco.set()
+
+    await server_asgi.app(scope, receive, send)
+    return resposta['status'], resposta['body']
+
+
+def test_rotas_flask_nao_esperam_sse_aberto():
+    task_id = 'teste-sse-aberto'
+    server_full.progress[task_id] = 10
+
+    async def cenario():
+        primeiro_bloco = asyncio.Event()
+        desconectar = asyncio.Event()
+        sse = asyncio.ensure_future(chamar(server_asgi.app, f'/progress/{task_id}/stream', primeiro_bloco, desconectar))
+        await asyncio.wait_for(primeiro_bloco.wait(), 5)
+        try:
+            inicio = time.perf_counter()
+            respostas = await asyncio.wait_for(
+                asyncio.gather(*[chamar(server_asgi.app, '/health') for _ in range(8)]), 5)
+            decorrido = time.perf_counter() - inicio
+        finally:
+            # Termina a tarefa: o gerador do SSE envia o estado final e fecha
+            server_full.progress[task_id] = -1
+            desconectar.set()
+            status_sse, corpo_sse = await asyncio.wait_for(sse, 5)
+        return respostas, decorrido, status_sse, corpo_sse
+
+    respostas, decorrido, status_sse, corpo_sse = asyncio.run(cenario())
+    assert [status for status, _ in respostas] == [200] * 8
+    assert decorrido < 2
+    assert status_sse == 200
+    assert b'"done": true' in corpo_sse
+
+
+def test_proxy_assincrono_grava_no_cache_tee(monkeypatch):
+    audio = bytes(range(256)) * 1024
+    origin = benchmark.OriginServer(audio).start()
+    chosen = {'url': f'{origin.url}/audio/teeAsync001.wav', 'format_id': '140', 'ext': 'wav',
+              'protocol': 'https', 'content_type': 'audio/wav', 'streamable': True}
+    monkeypatch.setattr(server_asgi, 'resolve_audio_format', lambda video_id, url: dict(chosen))
+    monkeypatch.setattr(server_full, 'resolve_audio_format', lambda video_id, url: dict(chosen))
+    async def cenario():
+        primeira = await chamar(server_asgi.app, '/stream/teeAsync001', headers=[(b'range', b'bytes=1000-1999')])
+        completa_antes = server_full.fonte_em_cache('teeAsync001', '140')
+        # Segunda vez: o trecho já gravado sai do disco e o resto completa o arquivo de origem
+        segunda = await chamar(server_asgi.app, '/stream/teeAsync001')
+        terceira = await chamar(server_asgi.app, '/stream/teeAsync001', headers=[(b'range', b'bytes=-100')])
+        return primeira, completa_antes, segunda, terceira
+
+    try:
+        primeira, completa_antes, segunda, terceira = asyncio.run(cenario())
+    finally:
+        origin.shutdown()
+    assert primeira == (206, audio[1000:2000])
+    assert completa_antes is None
+    assert segunda == (200, audio)
+    path = server_full.fonte_em_cache('teeAsync001', '140')
+    assert path is not None
+    with open(path, 'rb') as f:
+        assert f.read() == audio
+    assert terceira == (206, audio[-100:])
@@ -0,0 +1,26 @@
+import benchmark
+
+
+def cenario(throughputs, p95s):
+    return {'samples': [{'throughput_rps': t, 'latency_p95': p, 'latency_p99': p} for t, p in zip(throughputs, p95s)],
+            'errors': 0}
+
+
+def test_variacao_entre_amostras_nao_e_regressao():
+    base = {'scenarios': {'playlist': cenario([10.0, 8.0, 9.5], [1.0, 1.3, 1.1])}}
+    atual = {'scenarios': {'playlist': cenario([7.9, 8.5, 9.0], [1.25, 1.3, 1.2])}}
+    assert benchmark.comparar_resultados(base, atual, 0.10) == []
+
+
+def test_piora_fora_da_variacao_e_regressao():
+    base = {'scenarios': {'search': cenario([100.0, 98.0, 102.0], [0.05, 0.051, 0.049])}}
+    atual = {'scenarios': {'search': cenario([80.0, 79.0, 81.0], [0.07, 0.071, 0.069])}}
+    metricas = [r[1] for r in benchmark.comparar_resultados(base, atual, 0.10)]
+    assert metricas == ['throughput_rps', 'latency_p95', 'latency_p99']
+
+
+def test_resultados_antigos_sem_amostras():
+    base = {'scenarios': {'info': {'throughput_rps': 100.0, 'latency_seconds': {'p95': 0.1, 'p99': 0.2}, 'errors': 0}}}
+    atual = {'scenarios': {'info': {'throughput_rps': 85.0, 'latency_seconds': {'p95': 0.1, 'p99': 0.2}, 'errors': 1}}}
+    metricas = [r[1] for r in benchmark.comparar_resultados(base, atual, 0.10)]
+    assert metricas == ['throughput_rps', 'errors']
@@ -0,0 +1,53 @@
+import threading
+import time
+
+import pytest
+
+server_full = pytest.importorskip('server_full')
+
+
+def test_resolucoes_simultaneas_extraem_uma_vez(monkeypatch):
+    chamadas = []
+
+    def extrair(video_id, url):
+        chamadas.append(video_id)
+        time.sleep(0.2)
+        entry = {'url': 'https://exemplo/audio', 'ext': 'm4a', 'expires': time.time() + 60}
+        server_full._format_cache_put(video_id, entry)
+        return entry
+
+    monkeypatch.setattr(server_full, '_extrair_audio_format', extrair)
+    server_full.invalidate_audio_format('voo1')
+    resultados = []
+    threads = [threading.Thread(target=lambda: resultados.append(server_full.resolve_audio_format('voo1', 'u')))
+               for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    assert chamadas == ['voo1']
+    assert [r['url'] for r in resultados] == ['https://exemplo/audio'] * 5
+    assert 'voo1' not in server_full.FORMAT_INFLIGHT
+
+
+def test_falha_compartilhada_com_quem_esperava(monkeypatch):
+    def extrair(video_id, url):
+        time.sleep(0.2)
+        raise server_full.FormatNotFound('sem áudio')
+
+    monkeypatch.setattr(server_full, '_extrair_audio_format', extrair)
+    server_full.invalidate_audio_format('voo2')
+    erros = []
+
+    def resolver():
+        try:
+            server_full.resolve_audio_format('voo2', 'u')
+        except server_full.FormatNotFound as e:
+            erros.append(str(e))
+
+    threads = [threading.Thread(target=resolver) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    assert erros == ['sem áudio'] * 3
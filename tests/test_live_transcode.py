@@ -0,0 +1,41 @@
+import os
+import stat
+
+import pytest
+
+server_full = pytest.importorskip('server_full')
+
+
+def ffmpeg_falso(tmp_path, corpo):
+    path = tmp_path / 'ffmpeg'
+    path.write_text('#!/bin/sh\n' + corpo)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def esperar_fim(live, timeout=10):
+    with live._cond:
+        assert live._cond.wait_for(lambda: live.done, timeout)
+
+
+def test_stderr_verboso_nao_trava_a_conversao(tmp_path, monkeypatch):
+    # Mais que o buffer de um pipe em stderr antes de escrever qualquer byte no stdout
+    script = "head -c 262144 /dev/zero | tr '\\0' 'x' >&2\nprintf 'mp3data'\n"
+    monkeypatch.setattr(server_full, 'FFMPEG_PATH', ffmpeg_falso(tmp_path, script))
+    chosen = {'protocol': 'm3u8_native', 'url': 'http://127.0.0.1:9/playlist.m3u8', 'format_id': 'hls'}
+    live = server_full.LiveTranscode('teste_live_stderr', 'https://example.com/watch?v=x', chosen)
+    esperar_fim(live)
+    assert not live.failed
+    with open(live.cache_path, 'rb') as f:
+        assert f.read() == b'mp3data'
+    os.remove(live.cache_path)
+
+
+def test_falha_da_conversao_remove_o_parcial(tmp_path, monkeypatch):
+    monkeypatch.setattr(server_full, 'FFMPEG_PATH', ffmpeg_falso(tmp_path, "echo erro >&2\nexit 1\n"))
+    chosen = {'protocol': 'm3u8_native', 'url': 'http://127.0.0.1:9/playlist.m3u8', 'format_id': 'hls'}
+    live = server_full.LiveTranscode('teste_live_falha', 'https://example.com/watch?v=x', chosen)
+    esperar_fim(live)
+    assert live.failed
+    assert not os.path.exists(live.part_path)
+    assert not os.path.exists(live.cache_path)
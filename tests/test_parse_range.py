@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+server_full = pytest.importorskip('server_full')
+
+from server_full import parse_range
+
+SIZE = 882044
+
+
+@pytest.mark.parametrize('header, esperado', [
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, SIZE - 1)),
+    ('bytes=0-', (0, SIZE - 1)),
+    ('bytes=100-99999999', (100, SIZE - 1)),
+    ('bytes=-500', (SIZE - 500, SIZE - 1)),
+    ('bytes=-99999999', (0, SIZE - 1)),
+    ('bytes=%d-' % (SIZE - 1), (SIZE - 1, SIZE - 1)),
+    ('BYTES = 5-9', (5, 9)),
+])
+def test_intervalos_validos(header, esperado):
+    assert parse_range(header, SIZE) == esperado
+
+
+@pytest.mark.parametrize('header', [
+    'bytes=%d-' % SIZE,  # start == size
+    'bytes=%d-%d' % (SIZE, SIZE + 10),
+    'bytes=5000-10',  # start além do fim, mesmo com end < start
+    'bytes=-0',  # sufixo vazio
+])
+def test_intervalos_insatisfaziveis(header):
+    size = 4096 if header == 'bytes=5000-10' else SIZE
+    assert parse_range(header, size) == 'unsatisfiable'
+
+
+def test_sufixo_em_arquivo_vazio():
+    assert parse_range('bytes=-10', 0) == 'unsatisfiable'
+    assert parse_range('bytes=0-', 0) == 'unsatisfiable'
+
+
+@pytest.mark.parametrize('header', [
+    None,
+    '',
+    'bytes=0-1,5-9',  # múltiplos intervalos: serve o arquivo inteiro
+    'bytes=10-5',  # end < start dentro do arquivo: header inválido, ignorado
+    'bytes=',
+    'bytes=-',
+    'bytes=abc-def',
+    'bytes=1-x',
+    'bytes=5',
+    'items=0-10',
+    'bytes=-1-5',
+])
+def test_headers_ignorados(header):
+    assert parse_range(header, SIZE) is None
+
+
+def test_download_responde_416_a_partir_do_fim():
+    nome = 'teste-range.mp3'
+    caminho = os.path.join(server_full.DOWNLOAD_FOLDER, nome)
+    with open(caminho, 'wb') as f:
+        f.write(b'x' * 1000)
+    try:
+        client = server_full.app.test_client()
+        resposta = client.get(f'/download/{nome}', headers={'Range': 'bytes=1000-'})
+        assert resposta.status_code == 416
+        assert resposta.headers['Content-Range'] == 'bytes */1000'
+        resposta = client.get(f'/download/{nome}', headers={'Range': 'bytes=990-'})
+        assert resposta.status_code == 206
+        assert resposta.data == b'x' * 10
+    finally:
+        os.remove(caminho)
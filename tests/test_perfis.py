@@ -0,0 +1,36 @@
+import pytest
+
+server_full = pytest.importorskip('server_full')
+
+from server_full import resolver_perfil, nome_saida, nome_exibicao, DEFAULT_PROFILE
+
+
+@pytest.mark.parametrize('pedido, perfil', [
+    (None, DEFAULT_PROFILE),
+    ('', DEFAULT_PROFILE),
+    ('mp3', 'mp3-128'),
+    ('AAC', 'm4a'),
+    (' opus ', 'opus'),
+    ('mp3-320', 'mp3-320'),
+])
+def test_resolver_perfil(pedido, perfil):
+    assert resolver_perfil(pedido) == perfil
+
+
+def test_perfil_desconhecido():
+    with pytest.raises(ValueError):
+        resolver_perfil('flac')
+
+
+def test_baixar_recusa_perfil_desconhecido():
+    resposta = server_full.app.test_client().post(
+        '/baixar', json={'link': 'https://www.youtube.com/watch?v=abcdefghijk', 'profile': 'flac'})
+    assert resposta.status_code == 400
+    assert 'flac' in resposta.get_json()['error']
+
+
+def test_nome_de_exibicao_sem_sufixo_interno():
+    filename = nome_saida('Faixa', 'abcdefghijk', 'm4a')
+    assert filename == 'Faixa__abcdefghijk__m4a.m4a'
+    assert nome_exibicao(filename) == 'Faixa.m4a'
+    assert nome_exibicao('outro.mp3') == 'outro.mp3'
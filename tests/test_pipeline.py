@@ -0,0 +1,76 @@
+import io
+import stat
+import threading
+import time
+
+import pytest
+
+server_full = pytest.importorskip('server_full')
+
+
+@pytest.fixture
+def um_nucleo(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(server_full, 'TRANSCODE_SLOTS', slots)
+    monkeypatch.setattr(server_full, 'TRANSCODE_STALL_TIMEOUT', 0.2)
+    return slots
+
+
+def test_slot_direto_devolve_o_nucleo_quando_o_download_para(um_nucleo):
+    assert um_nucleo.acquire(blocking=False)
+    slot = server_full._SlotDireto(None, 'video')
+    try:
+        slot.entregar(io.BytesIO(), b'abc')
+        assert not um_nucleo.acquire(blocking=False)
+        time.sleep(0.8)  # origem parada
+        assert um_nucleo.acquire(blocking=False)
+        um_nucleo.release()
+        # Bytes voltaram: o núcleo é pedido de volta antes de entregar ao ffmpeg
+        destino = io.BytesIO()
+        slot.entregar(destino, b'def')
+        assert destino.getvalue() == b'def'
+        assert not um_nucleo.acquire(blocking=False)
+    finally:
+        slot.fechar()
+    assert um_nucleo.acquire(blocking=False)
+
+
+def test_slot_direto_mantem_o_nucleo_depois_do_download(um_nucleo):
+    assert um_nucleo.acquire(blocking=False)
+    slot = server_full._SlotDireto(None, 'video')
+    slot.download_terminou()
+    time.sleep(0.6)  # o ffmpeg ainda converte o que recebeu
+    assert not um_nucleo.acquire(blocking=False)
+    slot.fechar()
+    assert um_nucleo.acquire(blocking=False)
+
+
+def test_aguardar_fila_cheia_respeita_o_cancelamento():
+    fila = threading.BoundedSemaphore(1)
+    fila.acquire()
+    cancelado = threading.Event()
+    threading.Timer(0.2, cancelado.set).start()
+    with pytest.raises(server_full.JobCancelled):
+        server_full._aguardar(fila, cancelado, 'video')
+
+
+def test_conversao_do_buffer_reporta_progresso(tmp_path, monkeypatch):
+    ffmpeg = tmp_path / 'ffmpeg'
+    # Reporta time= enquanto ainda lê a entrada e grava o último argumento (arquivo de saída)
+    ffmpeg.write_text('#!/bin/sh\necho "size=1kB time=00:00:05.00" >&2\ncat > /dev/null\n'
+                      'for last; do :; done\nprintf out > "$last"\n')
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(server_full, 'FFMPEG_PATH', str(ffmpeg))
+
+    class SpoolLento(io.BytesIO):
+        def read(self, *args):
+            time.sleep(0.3)
+            return super().read(*args)
+
+    vistos = []
+    out_path = str(tmp_path / 'faixa.mp3')
+    resultado = server_full._transcode_stage(['-i', 'pipe:0'], out_path, 10, vistos.append, None,
+                                             spool=SpoolLento(b'x' * 1024))
+    assert resultado == out_path
+    assert 89 in vistos
+    assert vistos[-1] == 100
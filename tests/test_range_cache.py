@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+server_full = pytest.importorskip('server_full')
+
+from server_full import abrir_range_cache, fechar_range_cache, _juntar_intervalo
+
+DADOS = bytes(range(200))
+
+
+def test_juntar_intervalo_une_vizinhos():
+    ranges = _juntar_intervalo([], 10, 20)
+    ranges = _juntar_intervalo(ranges, 40, 50)
+    assert ranges == [[10, 20], [40, 50]]
+    assert _juntar_intervalo(ranges, 20, 40) == [[10, 50]]
+    assert _juntar_intervalo(ranges, 0, 5) == [[0, 5], [10, 20], [40, 50]]
+
+
+def test_monta_o_arquivo_a_partir_de_trechos_fora_de_ordem():
+    rc = abrir_range_cache('teste_rc_montagem')
+    try:
+        rc.definir_tamanho(len(DADOS))
+        rc.gravar(50, DADOS[50:100])
+        assert rc.segmentos(0, 199) == [(0, 49, False), (50, 99, True), (100, 199, False)]
+        assert b''.join(rc.ler(60, 69)) == DADOS[60:70]
+        rc.gravar(150, DADOS[150:])
+        rc.gravar(0, DADOS[:50])
+        assert rc.segmentos(0, 199) == [(0, 99, True), (100, 149, False), (150, 199, True)]
+        assert not rc.complete
+        rc.gravar(100, DADOS[100:150])
+        assert rc.complete
+        assert rc.segmentos(0, 199) == [(0, 199, True)]
+    finally:
+        fechar_range_cache(rc)
+    path = server_full.fonte_em_cache('teste', 'rc_montagem')
+    assert path is not None
+    with open(path, 'rb') as f:
+        assert f.read() == DADOS
+    assert not os.path.exists(rc.meta_path)
+
+
+def test_intervalos_sobrevivem_ao_fechar_e_reabrir():
+    rc = abrir_range_cache('teste_rc_reabrir')
+    rc.definir_tamanho(len(DADOS))
+    rc.gravar(10, DADOS[10:30])
+    fechar_range_cache(rc)
+
+    rc = abrir_range_cache('teste_rc_reabrir')
+    try:
+        assert rc.size == len(DADOS)
+        assert rc.ranges == [[10, 30]]
+        # Mesmo tamanho: o parcial é mantido
+        rc.definir_tamanho(len(DADOS))
+        assert b''.join(rc.ler(10, 29)) == DADOS[10:30]
+        # Tamanho diferente no upstream: o parcial antigo é descartado
+        rc.definir_tamanho(len(DADOS) + 1)
+        assert rc.ranges == []
+    finally:
+        fechar_range_cache(rc)
+
+
+def test_ignora_escrita_alem_do_tamanho():
+    rc = abrir_range_cache('teste_rc_limite')
+    try:
+        rc.definir_tamanho(10)
+        rc.gravar(5, b'x' * 10)
+        assert rc.ranges == []
+    finally:
+        fechar_range_cache(rc)
@@ -0,0 +1,69 @@
+import os
+import threading
+
+import pytest
+
+server_full = pytest.importorskip('server_full')
+
+
+def test_saida_gravada_por_outro_worker_e_encontrada():
+    key = ('outroWorker', 'mp3-128')
+    path = os.path.join(server_full.DOWNLOAD_FOLDER, server_full.nome_saida('Faixa', *key))
+    with open(path, 'wb') as f:
+        f.write(b'mp3')
+    try:
+        # Registrada só no índice em disco, como faz o worker que converteu
+        server_full.biblioteca_registrar(path, *key, title='Faixa')
+        assert key not in server_full.OUTPUT_INDEX
+        assert server_full.saida_pronta(key) == path
+        assert server_full.OUTPUT_INDEX[key] == os.path.basename(path)
+    finally:
+        os.remove(path)
+        server_full.biblioteca_remover(os.path.basename(path))
+    assert server_full.saida_pronta(key) is None
+
+
+def test_download_usa_o_titulo_como_nome():
+    filename = server_full.nome_saida('Minha Faixa', 'nomeExibir1', 'mp3-128')
+    path = os.path.join(server_full.DOWNLOAD_FOLDER, filename)
+    with open(path, 'wb') as f:
+        f.write(b'mp3')
+    try:
+        resposta = server_full.app.test_client().get(f'/download/{filename}')
+        assert resposta.status_code == 200
+        assert resposta.headers['Content-Disposition'] == "attachment; filename*=UTF-8''Minha%20Faixa.mp3"
+    finally:
+        os.remove(path)
+
+
+def test_locks_do_cache_de_stream_nao_acumulam():
+    dentro = threading.Event()
+    liberar = threading.Event()
+
+    def segurar():
+        with server_full._stream_cache_lock('chave-lock'):
+            dentro.set()
+            liberar.wait(5)
+
+    thread = threading.Thread(target=segurar)
+    thread.start()
+    assert dentro.wait(5)
+    assert 'chave-lock' in server_full.STREAM_CACHE_LOCKS
+    liberar.set()
+    thread.join(5)
+    for i in range(100):
+        with server_full._stream_cache_lock(f'video{i}'):
+            pass
+    assert server_full.STREAM_CACHE_LOCKS == {}
+
+
+def test_download_nao_serve_arquivos_internos():
+    assert not os.path.abspath(server_full.LIBRARY_DB).startswith(os.path.abspath(server_full.DOWNLOAD_FOLDER) + os.sep)
+    path = os.path.join(server_full.DOWNLOAD_FOLDER, 'interno.sqlite3-wal')
+    with open(path, 'wb') as f:
+        f.write(b'wal')
+    try:
+        resposta = server_full.app.test_client().get('/download/interno.sqlite3-wal')
+        assert resposta.status_code == 404
+    finally:
+        os.remove(path)
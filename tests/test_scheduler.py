@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+server_full = pytest.importorskip('server_full')
+
+from server_full import JobScheduler, QueueFull, PRIORITY_PLAYLIST, PRIORITY_SINGLE
+
+
+def nada():
+    pass
+
+
+def test_filhos_de_tarefa_admitida_nao_enchem_a_fila():
+    scheduler = JobScheduler(max_workers=0, max_queue=2)
+    scheduler.submit('playlist-a', 'cliente-a', PRIORITY_PLAYLIST, nada)
+    for _ in range(300):
+        scheduler.submit('playlist-a', 'cliente-a', PRIORITY_PLAYLIST, nada, force=True)
+    scheduler.submit('playlist-b', 'cliente-b', PRIORITY_PLAYLIST, nada)
+    assert scheduler.stats()['queued'] == 302
+
+
+def test_playlist_nova_recusada_com_a_fila_cheia():
+    scheduler = JobScheduler(max_workers=0, max_queue=2)
+    scheduler.submit('p1', 'cliente-a', PRIORITY_PLAYLIST, nada)
+    scheduler.submit('p2', 'cliente-b', PRIORITY_PLAYLIST, nada)
+    with pytest.raises(QueueFull):
+        scheduler.submit('p3', 'cliente-c', PRIORITY_PLAYLIST, nada)
+
+
+def test_musica_avulsa_tem_limite_proprio():
+    scheduler = JobScheduler(max_workers=0, max_queue=1, max_queue_single=2)
+    scheduler.submit('p1', 'cliente-a', PRIORITY_PLAYLIST, nada)
+    scheduler.submit('s1', 'cliente-b', PRIORITY_SINGLE, nada)
+    scheduler.submit('s2', 'cliente-b', PRIORITY_SINGLE, nada)
+    assert scheduler.queue_position('s1') == 1
+    assert scheduler.queue_position('p1') == 3
+    with pytest.raises(QueueFull):
+        scheduler.submit('s3', 'cliente-c', PRIORITY_SINGLE, nada)
+    scheduler.cancel('s1')
+    scheduler.submit('s3', 'cliente-c', PRIORITY_SINGLE, nada)
+
+
+def test_baixar_com_fila_cheia_responde_503_com_retry_after(monkeypatch):
+    monkeypatch.setattr(server_full, 'SCHEDULER', JobScheduler(max_workers=0, max_queue_single=0))
+    resposta = server_full.app.test_client().post('/baixar', json={'link': 'https://youtu.be/filaCheia01'})
+    assert resposta.status_code == 503
+    assert resposta.headers['Retry-After'] == str(server_full.JOB_RETRY_AFTER)
+
+
+def test_cancelar_libera_a_admissao():
+    scheduler = JobScheduler(max_workers=0, max_queue=1)
+    scheduler.submit('p1', 'cliente-a', PRIORITY_PLAYLIST, nada)
+    scheduler.submit('p1', 'cliente-a', PRIORITY_PLAYLIST, nada, force=True)
+    scheduler.cancel('p1')
+    assert scheduler.stats()['queued'] == 0
+    scheduler.submit('p2', 'cliente-a', PRIORITY_PLAYLIST, nada)
+
+
+def test_clientes_alternados_dentro_da_prioridade():
+    scheduler = JobScheduler(max_workers=0)
+    for i in range(3):
+        scheduler.submit(f'a{i}', 'cliente-a', PRIORITY_PLAYLIST, nada, force=True)
+    scheduler.submit('b0', 'cliente-b', PRIORITY_PLAYLIST, nada)
+    scheduler.submit('s0', 'cliente-c', PRIORITY_SINGLE, nada)
+    assert [scheduler.queue_position(t) for t in ('s0', 'a0', 'b0', 'a1', 'a2')] == [1, 2, 3, 4, 5]
+
+
+def test_executa_musica_avulsa_antes_da_playlist():
+    scheduler = JobScheduler(max_workers=0)
+    ordem = []
+    scheduler.submit('p1', 'cliente-a', PRIORITY_PLAYLIST, lambda: ordem.append('p1'))
+    scheduler.submit('s1', 'cliente-b', PRIORITY_SINGLE, lambda: ordem.append('s1'))
+    pronto = threading.Event()
+    scheduler.submit('fim', 'cliente-b', PRIORITY_PLAYLIST, pronto.set)
+    threading.Thread(target=scheduler._worker, daemon=True).start()
+    assert pronto.wait(5)
+    assert ordem == ['s1', 'p1']
+
+
+def test_cancelar_tarefa_concluida_nao_altera_o_estado():
+    client = server_full.app.test_client()
+    server_full.progress['cancelar-concluida'] = 100
+    server_full.progress['cancelar-concluida_filename'] = 'faixa.mp3'
+    resposta = client.post('/cancel/cancelar-concluida')
+    assert resposta.get_json()['cancelled'] is False
+    assert server_full.progress['cancelar-concluida'] == 100
+
+    server_full.progress['cancelar-em-andamento'] = 40
+    resposta = client.post('/cancel/cancelar-em-andamento')
+    assert resposta.get_json()['cancelled'] is True
+    assert server_full.progress['cancelar-em-andamento'] == -1